@@ -26,6 +26,17 @@ look_forward_days = long_term_next_date_range
 look_back_days = long_term_past_date_range
 previous_action_look_back_days = 7
 top_k = 5
+# collapse syndicated copies of a day's news before they are embedded and stored, None keeps every story
+near_duplicate_params = dict(threshold=0.6, window_days=2)
+# save the rendered prompts and responses of every stage as html, for debugging
+if_save_html = False
+# token budgets of the retrieved sections of the prompts, the best ranked items that fit are kept, None is unbounded
+token_budgets = dict(
+    latest_market_intelligence=3000,
+    past_market_intelligence=2000,
+    past_low_level_reflection=1500,
+    past_high_level_reflection=1500,
+)
 
 train_latest_market_intelligence_summary_template_path = "res/prompts/template/train/trading/latest_market_intelligence_summary.html"
 train_past_market_intelligence_summary_template_path = "res/prompts/template/train/trading/past_market_intelligence_summary.html"
@@ -97,23 +108,34 @@ memory = dict(
     memory_path="memory",
     embedding_dim=None,
     max_recent_steps=5,
+    index_params=dict(
+        index_type="flat", # flat, ivf_flat, hnsw or ivf_pq, promoted from flat at promote_threshold vectors
+        promote_threshold=10000,
+        nprobe=8,
+        ef_search=64,
+    ),
+    retention_params=None, # per memory type, e.g. dict(market_intelligence=dict(max_items=20000, max_age_days=730, duplicate_threshold=0.97))
     workdir=workdir,
     tag=tag
 )
 
 latest_market_intelligence_summary = dict(
     type="LatestMarketIntelligenceSummaryTrading",
-    model = "gpt-4-1106-preview"
+    model = "gpt-4-1106-preview",
+    if_save_html=if_save_html,
+    near_duplicate_params=near_duplicate_params
 )
 
 past_market_intelligence_summary = dict(
     type="PastMarketIntelligenceSummaryTrading",
-    model = "gpt-4-1106-preview"
+    model = "gpt-4-1106-preview",
+    if_save_html=if_save_html
 )
 
 low_level_reflection = dict(
     type="LowLevelReflectionTrading",
     model = "gpt-4-vision-preview",
+    if_save_html=if_save_html,
     short_term_past_date_range=short_term_past_date_range,
     medium_term_past_date_range=medium_term_past_date_range,
     long_term_past_date_range=long_term_past_date_range,
@@ -127,12 +149,14 @@ low_level_reflection = dict(
 high_level_reflection = dict(
     type="HighLevelReflectionTrading",
     model = "gpt-4-vision-preview",
+    if_save_html=if_save_html,
     previous_action_look_back_days=previous_action_look_back_days
 )
 
 decision = dict(
     type="DecisionTrading",
     model = "gpt-4-1106-preview",
+    if_save_html=if_save_html,
 )
 
 provider = dict(
@@ -26,6 +26,8 @@ look_forward_days = long_term_next_date_range
 look_back_days = long_term_past_date_range
 previous_action_look_back_days = 14
 top_k = 5
+# collapse syndicated copies of a day's news before they are embedded and stored, None keeps every story
+near_duplicate_params = dict(threshold=0.6, window_days=2)
 
 train_latest_market_intelligence_summary_template_path = "res/prompts/template/train/trading_mi-w-low-w-decision/latest_market_intelligence_summary.html"
 train_past_market_intelligence_summary_template_path = "res/prompts/template/train/trading_mi-w-low-w-decision/past_market_intelligence_summary.html"
@@ -101,7 +103,8 @@ memory = dict(
 
 latest_market_intelligence_summary = dict(
     type="LatestMarketIntelligenceSummaryTrading",
-    model = "gpt-4-1106-preview"
+    model = "gpt-4-1106-preview",
+    near_duplicate_params=near_duplicate_params
 )
 
 past_market_intelligence_summary = dict(
@@ -30,6 +30,7 @@ processor = dict(
     end_date = "2024-01-01",
     interval = "1d",
     stocks_path = "configs/_stock_list_/dj30.txt",
+    near_duplicate_params = dict(threshold=0.6, window_days=2), # collapse syndicated news, None only drops exact duplicates
     workdir = workdir,
     tag = tag
 )
\ No newline at end of file
@@ -25,6 +25,7 @@ processor = dict(
     interval = "1d",
     if_parse_url = False,
     stocks_path = "configs/_stock_list_/exp_forexs.txt",
+    near_duplicate_params = dict(threshold=0.6, window_days=2), # collapse syndicated news, None only drops exact duplicates
     workdir = workdir,
     tag = tag
 )
\ No newline at end of file
@@ -1,11 +1,25 @@
 import os
+import json
+import hashlib
+import tempfile
 from finagent.data import BaseDataset
 from finagent.registry import DATASET
 import pandas as pd
+import pyarrow.feather as feather
 
 pd.set_option('display.max_columns', 100000)
 pd.set_option('display.max_rows', 100000)
 
+# bump when a loader changes its output, so that older caches are rebuilt
+CACHE_VERSION = 1
+
+def normalize_timestamp(timestamp):
+    """Truncate timestamps to their date, without formatting them to strings and parsing them back."""
+    timestamp = pd.to_datetime(timestamp)
+    if timestamp.dt.tz is not None:
+        timestamp = timestamp.dt.tz_localize(None)
+    return timestamp.dt.normalize()
+
 @DATASET.register_module(force=True)
 class Dataset(BaseDataset):
     def __init__(self,
@@ -19,6 +33,8 @@ class Dataset(BaseDataset):
                  interval: str = "day",
                  workdir: str = None,
                  tag: str = None,
+                 if_use_cache: bool = True,
+                 cache_path: str = None,
                  ):
         super(Dataset, self).__init__()
 
@@ -48,11 +64,17 @@ class Dataset(BaseDataset):
         self.exp_path = os.path.join(self.root, self.workdir, self.tag)
         os.makedirs(self.exp_path, exist_ok=True)
 
+        self.if_use_cache = if_use_cache
+        if cache_path is not None:
+            self.cache_path = os.path.join(root, cache_path)
+        else:
+            self.cache_path = os.path.join(self.root, self.workdir, "cache", "dataset")
+
         self.assets = self._init_assets()
-        self.prices = self._load_prices()
-        self.news = self._load_news()
-        self.guidances = self._load_guidances()
-        self.sentiments = self._load_sentiments()
+        self.prices = self._load_cached("prices", self.price_path, self._load_prices)
+        self.news = self._load_cached("news", self.news_path, self._load_news)
+        self.guidances = self._load_cached("guidances", self.guidance_path, self._load_guidances)
+        self.sentiments = self._load_cached("sentiments", self.sentiment_path, self._load_sentiments)
         self.economics = self._load_economics()
 
     def _init_assets(self):
@@ -60,6 +82,65 @@ class Dataset(BaseDataset):
             assets = [line.strip() for line in op.readlines()]
         return assets
 
+    def _load_cached(self, name, path, load_func):
+        """Load one kind of data through a consolidated cache.
+
+        The normalized frames of all assets are stored in one uncompressed Feather
+        file with a symbol column. Opening it converts the whole table to pandas
+        once, without decompressing or parsing it, and splits it per asset by
+        offsets. The cache is rebuilt when the asset list or any source parquet
+        changed.
+        """
+        if path is None:
+            return None
+        if not self.if_use_cache:
+            return load_func()
+
+        sources = [os.path.join(path, "{}.parquet".format(asset)) for asset in self.assets]
+        fingerprint = {
+            "version": CACHE_VERSION,
+            "assets": self.assets,
+            "sources": [[os.stat(source).st_mtime_ns, os.stat(source).st_size] for source in sources],
+        }
+        key = hashlib.sha256("{}\n{}".format(os.path.abspath(path), json.dumps(self.assets)).encode("utf-8")).hexdigest()[:16]
+        data_path = os.path.join(self.cache_path, "{}-{}.feather".format(name, key))
+        meta_path = os.path.join(self.cache_path, "{}-{}.json".format(name, key))
+
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            with open(meta_path) as op:
+                meta = json.load(op)
+            if meta["fingerprint"] == fingerprint:
+                df = feather.read_table(data_path, memory_map=True).to_pandas()
+                df = df.drop(columns=["symbol"])
+                return {
+                    asset: df.iloc[start: end].reset_index(drop=True)
+                    for asset, (start, end) in zip(self.assets, meta["offsets"])
+                }
+
+        frames = load_func()
+
+        offsets = []
+        start = 0
+        for asset in self.assets:
+            offsets.append([start, start + len(frames[asset])])
+            start += len(frames[asset])
+
+        df = pd.concat([frames[asset].assign(symbol=asset) for asset in self.assets], ignore_index=True)
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        # write to temporary files of this process first, a run reading the cache never sees a partial file,
+        # also when several runs rebuild it at the same time
+        fd, data_tmp_path = tempfile.mkstemp(dir=self.cache_path, suffix=".tmp")
+        os.close(fd)
+        feather.write_feather(df, data_tmp_path, compression="uncompressed")
+        os.replace(data_tmp_path, data_path)
+        fd, meta_tmp_path = tempfile.mkstemp(dir=self.cache_path, suffix=".tmp")
+        with os.fdopen(fd, "w") as op:
+            json.dump({"fingerprint": fingerprint, "offsets": offsets}, op)
+        os.replace(meta_tmp_path, meta_path)
+
+        return frames
+
     def _load_prices(self):
 
         prices = {}
@@ -68,9 +149,7 @@ class Dataset(BaseDataset):
             path = os.path.join(self.price_path, "{}.parquet".format(asset))
             df = pd.read_parquet(path)
 
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
-            df["timestamp"] = df["timestamp"].apply(lambda x: x.strftime("%Y-%m-%d"))
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
+            df["timestamp"] = normalize_timestamp(df["timestamp"])
 
             df = df.sort_values(by="timestamp")
             df = df.reset_index(drop=True)
@@ -91,19 +170,20 @@ class Dataset(BaseDataset):
             path = os.path.join(self.news_path, "{}.parquet".format(asset))
             df = pd.read_parquet(path)
 
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
-            df["timestamp"] = df["timestamp"].apply(lambda x: x.strftime("%Y-%m-%d"))
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
+            df["timestamp"] = normalize_timestamp(df["timestamp"])
 
             df = df.dropna(axis=0, how="any")
             df = df.sort_values(by="timestamp")
             df = df.reset_index(drop=True)
 
-            df["id"] = df.index + global_id
-            df["id"] = df["id"].apply(lambda x: "{:06d}".format(x))
+            df["id"] = [f"{i:06d}" for i in range(global_id, global_id + len(df))]
             global_id += len(df)
 
-            df = df[["timestamp", "id", "type", "source", "title", "text"]]
+            # news processed before near duplicates were collapsed is one source per row
+            if "source_count" not in df.columns:
+                df["source_count"] = 1
+
+            df = df[["timestamp", "id", "type", "source", "title", "text", "source_count"]]
 
             news[asset] = df
 
@@ -120,9 +200,7 @@ class Dataset(BaseDataset):
             path = os.path.join(self.guidance_path, "{}.parquet".format(asset))
             df = pd.read_parquet(path)
 
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
-            df["timestamp"] = df["timestamp"].apply(lambda x: x.strftime("%Y-%m-%d"))
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
+            df["timestamp"] = normalize_timestamp(df["timestamp"])
 
             df = df.dropna(axis=0, how="any")
             df = df.sort_values(by="timestamp")
@@ -145,9 +223,7 @@ class Dataset(BaseDataset):
             path = os.path.join(self.sentiment_path, "{}.parquet".format(asset))
             df = pd.read_parquet(path)
 
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
-            df["timestamp"] = df["timestamp"].apply(lambda x: x.strftime("%Y-%m-%d"))
-            df["timestamp"] = pd.to_datetime(df["timestamp"])
+            df["timestamp"] = normalize_timestamp(df["timestamp"])
 
             df = df.dropna(axis=0, how="any")
             df = df.sort_values(by="timestamp")
@@ -173,9 +249,7 @@ class Dataset(BaseDataset):
 
         economics = pd.read_parquet(path)
 
-        economics["timestamp"] = pd.to_datetime(economics["timestamp"])
-        economics["timestamp"] = economics["timestamp"].apply(lambda x: x.strftime("%Y-%m-%d"))
-        economics["timestamp"] = pd.to_datetime(economics["timestamp"])
+        economics["timestamp"] = normalize_timestamp(economics["timestamp"])
 
         economics = economics.sort_values(by="timestamp")
         economics = economics.reset_index(drop=True)
@@ -1,10 +1,31 @@
 import os
 from datetime import datetime
-from typing import Any
+from typing import Any, Callable, Dict
+from collections.abc import Mapping
 import numpy as np
 import gym
 from finagent.registry import ENVIRONMENT
 
+STATE_KEYS = ["price", "news", "guidance", "sentiment", "economic"]
+
+class LazyState(Mapping):
+    """A state that only materializes the frames a stage actually reads."""
+
+    def __init__(self, loaders: Dict[str, Callable[[], Any]]):
+        self._loaders = loaders
+        self._frames = {}
+
+    def __getitem__(self, key):
+        if key not in self._frames:
+            self._frames[key] = self._loaders[key]()
+        return self._frames[key]
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
 @ENVIRONMENT.register_module(force=True)
 class EnvironmentTrading(gym.Env):
     def __init__(self,
@@ -19,6 +40,7 @@ class EnvironmentTrading(gym.Env):
                  initial_amount: float = 1e4,
                  transaction_cost_pct: float = 1e-3,
                  discount: float = 1.0,
+                 lazy_state: bool = False,
                  ):
         super(EnvironmentTrading, self).__init__()
 
@@ -62,6 +84,7 @@ class EnvironmentTrading(gym.Env):
         self.initial_amount = initial_amount
         self.transaction_cost_pct = transaction_cost_pct
         self.discount = discount
+        self.lazy_state = lazy_state
 
         self.prices_df = self.prices_df.reset_index(drop=True)
         self.news_df = self.news_df.reset_index(drop=True)
@@ -86,6 +109,8 @@ class EnvironmentTrading(gym.Env):
         if self.economics_df is not None:
             self.economics_df = self.economics_df.set_index("timestamp")
 
+        self.state_offsets = self._init_state_offsets()
+
         self.day = self.init_day
         self.value = self.initial_amount
         self.cash = self.initial_amount
@@ -114,42 +139,58 @@ class EnvironmentTrading(gym.Env):
     def current_value(self, price):
         return self.cash + self.position * price
 
-    def get_state(self):
-
-        state = {}
-
-        days_ago = self.prices_df.index[self.day - self.look_back_days]
-        days_future = self.prices_df.index[min(self.day + self.look_forward_days, len(self.prices_df) - 1)]
-
-        price = self.prices_df[self.prices_df.index <= days_future]
-        price = price[price.index >= days_ago]
+    def _get_state_frames(self) -> Dict[str, Any]:
+        return {
+            "price": self.prices_df,
+            "news": self.news_df,
+            "guidance": self.guidances_df,
+            "sentiment": self.sentiments_df,
+            "economic": self.economics_df,
+        }
 
-        news = self.news_df[self.news_df.index <= days_future]
-        news = news[news.index >= days_ago]
+    def _init_state_offsets(self) -> Dict[str, np.ndarray]:
+        """Precompute the [start, end) row offsets of every frame for every trading day.
+
+        The window of a day covers the timestamps between
+        prices_df.index[day - look_back_days] and prices_df.index[day + look_forward_days],
+        both inclusive, which is found with a binary search on each sorted timestamp index.
+        """
+        for name, df in self._get_state_frames().items():
+            if df is not None and not df.index.is_monotonic_increasing:
+                raise ValueError(f"The timestamp index of {name} should be sorted.")
+
+        days = np.arange(len(self.prices_df))
+        days_ago = self.prices_df.index.values[days - self.look_back_days]
+        days_future = self.prices_df.index.values[np.minimum(days + self.look_forward_days, len(self.prices_df) - 1)]
+
+        state_offsets = {}
+        for name, df in self._get_state_frames().items():
+            if df is None:
+                continue
+            index = df.index.values
+            start = np.searchsorted(index, days_ago, side="left")
+            end = np.searchsorted(index, days_future, side="right")
+            state_offsets[name] = np.stack([start, np.maximum(start, end)], axis=1)
+
+        return state_offsets
+
+    def _get_state_frame(self, name: str, day: int):
+        df = self._get_state_frames()[name]
+        if df is None:
+            return None
+        start, end = self.state_offsets[name][day]
+        return df.iloc[start:end]
 
-        if self.guidances_df is not None:
-            guidance = self.guidances_df[self.guidances_df.index <= days_future]
-            guidance = guidance[guidance.index >= days_ago]
-        else:
-            guidance = None
+    def get_state(self):
 
-        if self.sentiments_df is not None:
-            sentiment = self.sentiments_df[self.sentiments_df.index <= days_future]
-            sentiment = sentiment[sentiment.index >= days_ago]
-        else:
-            sentiment = None
+        day = self.day
 
-        if self.economics_df is not None:
-            economic = self.economics_df[self.economics_df.index <= days_future]
-            economic = economic[economic.index >= days_ago]
-        else:
-            economic = None
+        if self.lazy_state:
+            return LazyState({name: (lambda name=name: self._get_state_frame(name, day)) for name in STATE_KEYS})
 
-        state["price"] = price
-        state["news"] = news
-        state["guidance"] = guidance
-        state["sentiment"] = sentiment
-        state["economic"] = economic
+        state = {}
+        for name in STATE_KEYS:
+            state[name] = self._get_state_frame(name, day)
 
         return state
 
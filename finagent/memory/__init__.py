@@ -1,12 +1,20 @@
 from .base import VectorStore, BaseMemory
 from .faiss import FAISS
-from .basic_memory import BasicMemory
+from .basic_memory import BasicMemory, migrate_memory
+from .journal import MemoryJournal
+from .retention import RetentionPolicy
 from .interface import MemoryInterface
+from .server import RemoteMemoryInterface, serve_memory
 
 __all__ = [
     "VectorStore",
     "FAISS",
     "BaseMemory",
     "BasicMemory",
+    "migrate_memory",
+    "MemoryJournal",
+    "RetentionPolicy",
     "MemoryInterface",
+    "RemoteMemoryInterface",
+    "serve_memory",
 ]
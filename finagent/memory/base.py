@@ -51,6 +51,15 @@ class VectorStore(abc.ABC):
     ) -> List[Tuple[str, float]]:
         """Return keys most similar to query."""
 
+    def similarity_search_batch(
+        self,
+        embeddings: List[List[float]],
+        top_k: int,
+        **kwargs: Any,
+    ) -> List[List[Tuple[str, float]]]:
+        """Return the keys most similar to every query, stores with a batched search override this."""
+        return [self.similarity_search(embedding, top_k, **kwargs) for embedding in embeddings]
+
     def save_local(self, memory_path = None) -> None:
         """Save FAISS index and index_to_key to disk."""
 
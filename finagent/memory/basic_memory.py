@@ -10,8 +10,102 @@ from typing import (
 import time
 import json
 import os
+import numpy as np
 
 from finagent.memory.base import VectorStore, BaseMemory, Image
+from finagent.memory.faiss import time_to_day
+from finagent.memory.retention import RetentionPolicy
+
+RECORDS_FILE = "records.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+LEGACY_MEMORY_FILE = "memory.json"
+
+def infer_embedding_key(data: Dict) -> Optional[str]:
+    """Guess the embedding field of a record saved by an old version, which did not store it."""
+    if isinstance(data.get("embedding", None), list):
+        return "embedding"
+    for key, value in data.items():
+        if isinstance(value, list) and len(value) > 0 and all(isinstance(v, float) for v in value[:8]):
+            return key
+    return None
+
+def split_embedding(data: Dict, embedding_key: Optional[str]) -> Tuple[Dict, Optional[np.ndarray]]:
+    """Return the record without its embedding and the embedding as a float32 vector."""
+    if embedding_key is None or embedding_key not in data:
+        return data, None
+    embedding = np.array(data[embedding_key], dtype=np.float32)
+    return {k: v for k, v in data.items() if k != embedding_key}, embedding
+
+def save_records(memory_path: str,
+                 memory: Dict[str, Dict],
+                 embedding_keys: Dict[str, Optional[str]],
+                 embeddings: Dict[str, np.ndarray]) -> None:
+    """Save the records, which hold no embeddings, as compact JSON and the embeddings as one float32 .npy matrix."""
+    names = list(memory.keys())
+    rows = []
+    vectors = []
+    for name in names:
+        if name in embeddings:
+            rows.append(len(vectors))
+            vectors.append(embeddings[name])
+        else:
+            rows.append(-1)
+
+    records = {
+        "names": names,
+        "embedding_keys": [embedding_keys.get(name, None) if row >= 0 else None for name, row in zip(names, rows)],
+        "rows": rows,
+        "datas": [memory[name] for name in names],
+    }
+    with open(os.path.join(memory_path, RECORDS_FILE), "w") as f:
+        json.dump(records, f, separators=(",", ":"))
+
+    # the loaded embeddings may be a memmap of the file being replaced, so write a new file instead of truncating it
+    embeddings_path = os.path.join(memory_path, EMBEDDINGS_FILE)
+    with open(embeddings_path + ".tmp", "wb") as f:
+        np.save(f, np.asarray(vectors, dtype=np.float32))
+    os.replace(embeddings_path + ".tmp", embeddings_path)
+
+def load_records(memory_path: str) -> Tuple[Dict[str, Dict], Dict[str, Optional[str]], Dict[str, np.ndarray]]:
+    """Load the records saved by save_records, or migrate a legacy memory.json in memory.
+
+    The embeddings are rows of a memmap of embeddings.npy, they are only read
+    from disk when used, e.g. by the duplicate check of a retention policy.
+    """
+    memory = {}
+    embedding_keys = {}
+    embeddings = {}
+    if not os.path.exists(os.path.join(memory_path, RECORDS_FILE)):
+        with open(os.path.join(memory_path, LEGACY_MEMORY_FILE), "r") as rf:
+            legacy = json.load(rf)
+        for name, data in legacy.items():
+            embedding_key = infer_embedding_key(data)
+            memory[name], embedding = split_embedding(data, embedding_key)
+            embedding_keys[name] = embedding_key
+            if embedding is not None:
+                embeddings[name] = embedding
+        return memory, embedding_keys, embeddings
+
+    with open(os.path.join(memory_path, RECORDS_FILE), "r") as rf:
+        records = json.load(rf)
+    matrix = np.load(os.path.join(memory_path, EMBEDDINGS_FILE), mmap_mode="r")
+
+    for name, embedding_key, row, data in zip(records["names"], records["embedding_keys"], records["rows"], records["datas"]):
+        if row >= 0:
+            embeddings[name] = matrix[row]
+        memory[name] = data
+        embedding_keys[name] = embedding_key
+    return memory, embedding_keys, embeddings
+
+def migrate_memory(memory_path: str, remove_legacy: bool = True) -> bool:
+    """Convert a legacy memory.json in memory_path to the binary format, return whether anything was migrated."""
+    if not os.path.exists(os.path.join(memory_path, LEGACY_MEMORY_FILE)):
+        return False
+    if not os.path.exists(os.path.join(memory_path, RECORDS_FILE)):
+        save_records(memory_path, *load_records(memory_path))
+    if remove_legacy:
+        os.remove(os.path.join(memory_path, LEGACY_MEMORY_FILE))
+    return True
 
 
 class BasicMemory(BaseMemory):
@@ -20,46 +114,131 @@ class BasicMemory(BaseMemory):
             memory_path: str,
             vectorstore: VectorStore,
             memory: Optional[Dict] = None,
+            time_key: str = "date",
+            retention: Optional[RetentionPolicy] = None,
     ) -> None:
-        if memory is None:
-            self.memory = {}
-        else:
-            self.memory = memory
+        self.memory = {}
+        # the field of every record holding its embedding, the records are kept without it
+        self.embedding_keys = {}
+        # the float32 embedding of every record, by name
+        self.embeddings: Dict[str, np.ndarray] = {}
+        for name, data in (memory or {}).items():
+            embedding_key = infer_embedding_key(data)
+            self.memory[name], embedding = split_embedding(data, embedding_key)
+            self.embedding_keys[name] = embedding_key
+            if embedding is not None:
+                self.embeddings[name] = embedding
         self.memory_path = memory_path
         self.vectorstore = vectorstore
+        # the field holding the date of a record, for searches restricted to a date range
+        self.time_key = time_key
+        # bounds the size of the memory, None keeps every record
+        self.retention = retention
+        # numbers the records added within a second, so their names stay unique
+        self._num_added = 0
+
+    def _new_names(self, num: int) -> List[str]:
+        """Names of new records, unique across calls even within one second."""
+        prefix = time.strftime("%Y-%m-%d-%H:%M:%S", time.localtime())
+        names = []
+        while len(names) < num:
+            name = f"{prefix}-{self._num_added:06d}"
+            self._num_added += 1
+            # a restarted process counts from 0 again
+            if name not in self.memory:
+                names.append(name)
+        return names
 
     def add(
             self,
             data: Dict,
             embedding_key: str,
             **kwargs,
-    ) -> None:
+    ) -> Optional[str]:
+        """
+        Add data to memory, return its key or None if the retention policy dropped it as a duplicate.
+        """
+        return self.add_batch([data], embedding_key)[0]
+
+    def add_batch(
+            self,
+            datas: List[Dict],
+            embedding_key: str,
+            names: Optional[List[str]] = None,
+            if_check_duplicates: bool = True,
+            **kwargs,
+    ) -> List[Optional[str]]:
         """
-        Add data to memory.
+        Add a batch of data to memory with a single vectorstore insert, return their keys.
+        The key of a record the retention policy dropped as a duplicate is None.
+        Replaying a journal passes the original keys as names, and does not check
+        for duplicates as the journal only holds the records that were kept.
         """
-        name = time.strftime("%Y-%m-%d-%H:%M:%S", time.localtime())  # the unique id of the added unit.
-        self.memory[name] = data
+        if len(datas) == 0:
+            return []
+
+        if names is None:
+            names = self._new_names(len(datas))  # the unique ids of the added units.
+
+        for data in datas:
+            assert embedding_key in data, f"embedding_key {embedding_key} not in data"
+        records = [split_embedding(data, embedding_key) for data in datas]
+        embeddings = [embedding for _, embedding in records]
+
+        duplicates = [False] * len(datas)
+        if self.retention is not None and if_check_duplicates:
+            duplicates = self.retention.find_duplicates(self.vectorstore, self.embeddings, embeddings)
+
+        added_names = []
+        added_embeddings = []
+        added_times = []
+        for name, (data, embedding), duplicate in zip(names, records, duplicates):
+            if duplicate:
+                continue
+            self.memory[name] = data
+            self.embedding_keys[name] = embedding_key
+            self.embeddings[name] = embedding
+            added_names.append(name)
+            added_embeddings.append(embedding)
+            added_times.append(data.get(self.time_key, None))
 
-        assert embedding_key in data, f"embedding_key {embedding_key} not in data"
-        embeddings = data[embedding_key]
+        self.vectorstore.add_embeddings(added_names, added_embeddings, times=added_times)
 
-        self.vectorstore.add_embeddings([name], [embeddings])
+        if self.retention is not None:
+            latest_times = [value for value in added_times if value is not None]
+            latest_time = max(latest_times, key=time_to_day) if len(latest_times) > 0 else None
+            self.delete(self.retention.select_expired(self.memory, self.time_key, latest_time))
+
+        return [None if duplicate else name for name, duplicate in zip(names, duplicates)]
+
+    def delete(self, names: List[str]) -> None:
+        """Delete the records of names, the index drops their vectors once enough of them are deleted."""
+        if len(names) == 0:
+            return
+        for name in names:
+            del self.memory[name]
+            del self.embedding_keys[name]
+            self.embeddings.pop(name, None)
+        self.vectorstore.delete(names)
 
     def similarity_search(
             self,
             data: Dict,
             embedding_query: str,
             top_k: int = 3,
+            start_date: Any = None,
+            end_date: Any = None,
             **kwargs) -> Tuple[List[Dict[str, Any]], List[float]]:
         """
-        Retrieve the keys from the vectorstores.
+        Retrieve the keys from the vectorstores, only of the records with start_date <= date < end_date if given.
         """
         assert embedding_query in data, f"embedding_query {embedding_query} not in data"
 
         query_embedding = data[embedding_query]
 
         try:
-            key_and_score = self.vectorstore.similarity_search(query_embedding, top_k)
+            key_and_score = self.vectorstore.similarity_search(query_embedding, top_k,
+                                                               start_time=start_date, end_time=end_date)
             items = [self.memory[k] for k, score in key_and_score]
             scores = [score for k, score in key_and_score]
         except:
@@ -68,6 +247,34 @@ class BasicMemory(BaseMemory):
 
         return items, scores
 
+    def similarity_search_batch(
+            self,
+            datas: List[Dict],
+            embedding_query: str,
+            top_k: int = 3,
+            start_date: Any = None,
+            end_date: Any = None,
+            **kwargs) -> List[Tuple[List[Dict[str, Any]], List[float]]]:
+        """
+        Retrieve the keys of several queries from the vectorstores with one search.
+        """
+        for data in datas:
+            assert embedding_query in data, f"embedding_query {embedding_query} not in data"
+
+        query_embeddings = [data[embedding_query] for data in datas]
+
+        try:
+            results = []
+            for key_and_score in self.vectorstore.similarity_search_batch(query_embeddings, top_k,
+                                                                          start_time=start_date, end_time=end_date):
+                items = [self.memory[k] for k, score in key_and_score]
+                scores = [score for k, score in key_and_score]
+                results.append((items, scores))
+        except:
+            results = [([], []) for _ in datas]
+
+        return results
+
     def query(self,
               data: Dict,
               embedding_query: str,
@@ -76,6 +283,13 @@ class BasicMemory(BaseMemory):
         items, scores = self.similarity_search(data, embedding_query, top_k=top_k, **kwargs)
         return items, scores
 
+    def query_batch(self,
+                    datas: List[Dict],
+                    embedding_query: str,
+                    top_k: int = 3,
+                    **kwargs) -> List[Tuple[List[Dict[str, Any]], List[float]]]:
+        return self.similarity_search_batch(datas, embedding_query, top_k=top_k, **kwargs)
+
     def load_local(
             self,
             memory_path: str = None,
@@ -85,13 +299,17 @@ class BasicMemory(BaseMemory):
         if memory_path is None:
             memory_path = self.memory_path
 
-        """Load the memory from the local file."""
-        with open(os.path.join(memory_path, "memory.json"), "r") as rf:
-            memory = json.load(rf)
+        """Load the memory from the local file, a legacy memory.json is converted on the fly."""
+        memory, embedding_keys, embeddings = load_records(memory_path)
 
         self.memory_path = memory_path
         self.vectorstore = vectorstore
         self.memory = memory
+        self.embedding_keys = embedding_keys
+        self.embeddings = embeddings
+
+        if getattr(vectorstore, "needs_times", False):
+            vectorstore.set_times({name: data.get(self.time_key, None) for name, data in memory.items()})
 
     def save_local(self, memory_path = None) -> None:
 
@@ -99,6 +317,8 @@ class BasicMemory(BaseMemory):
             memory_path = self.memory_path
 
         """Save the memory to the local file."""
-        with open(os.path.join(memory_path, "memory.json"), "w") as f:
-            json.dump(self.memory, f, indent=2)
+        save_records(memory_path, self.memory, self.embedding_keys, self.embeddings)
+        # an old memory.json next to the new files would be stale
+        if os.path.exists(os.path.join(memory_path, LEGACY_MEMORY_FILE)):
+            os.remove(os.path.join(memory_path, LEGACY_MEMORY_FILE))
         self.vectorstore.save_local(memory_path)
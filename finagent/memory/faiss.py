@@ -8,6 +8,7 @@ from typing import (
 import os
 import numpy as np
 import pickle
+from datetime import date, datetime
 from pathlib import Path
 
 from finagent.memory.base import VectorStore
@@ -39,6 +40,23 @@ def dependable_faiss_import(no_avx2: Optional[bool] = None) -> Any:
         )
     return faiss
 
+INDEX_TYPES = ["flat", "ivf_flat", "hnsw", "ivf_pq"]
+
+# ids are (day << TIME_SHIFT) | sequence, so a date range is an id range
+TIME_SHIFT = 24
+SEQUENCE_MASK = (1 << TIME_SHIFT) - 1
+EPOCH = date(1900, 1, 1)
+
+def time_to_day(value: Any) -> int:
+    """Days since EPOCH of a date, datetime or ISO date string, 0 for None."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value[:10])
+    if isinstance(value, datetime):
+        value = value.date()
+    return max((value - EPOCH).days, 0)
+
 class FAISS(VectorStore):
     def __init__(
         self,
@@ -46,27 +64,238 @@ class FAISS(VectorStore):
         memory_path: str,
         index: Optional[Any] = None,
         index_to_key: Optional[Dict[int, str]] = None,
+        index_type: str = "flat",
+        promote_threshold: int = 10000,
+        nlist: Optional[int] = None,
+        nprobe: int = 8,
+        hnsw_m: int = 32,
+        ef_construction: int = 40,
+        ef_search: int = 64,
+        pq_m: Optional[int] = None,
+        compact_ratio: float = 0.1,
     ) -> None:
         """Initialize the Meta Faiss vectorstore.
         Code modified based on langchain.
 
+        The index is wrapped in an IndexIDMap2, every vector gets a stable 64-bit id
+        and index_to_key / key_to_ids map between ids and keys. The high bits of an
+        id hold the day of the vector, so searches restricted to a date range run
+        inside FAISS with an IDSelectorRange. Deleted ids are only
+        dropped from these maps and skipped by searches, the index is compacted once
+        they exceed compact_ratio of its vectors.
+
+        A store always starts as an exact IndexFlatL2. With another index_type it is
+        promoted once it holds promote_threshold vectors, the new index is trained
+        on the vectors stored so far.
+
         Args:
             embedding_provider: Embedding provider.
             memory_path: Path to the store memory.
             index: Faiss index.
-            index_to_key: Mapping from index to key.
+            index_to_key: Mapping from id to key.
+            index_type: One of INDEX_TYPES.
+            promote_threshold: Number of vectors at which a flat index is promoted to index_type.
+            nlist: Number of IVF cells, 4 * sqrt(number of vectors) by default.
+            nprobe: Number of IVF cells visited by a search, higher is slower with better recall.
+            hnsw_m: Number of neighbors of a HNSW node.
+            ef_construction: HNSW candidate list size when adding.
+            ef_search: HNSW candidate list size when searching, higher is slower with better recall.
+            pq_m: Number of IVF-PQ sub-quantizers, must divide embedding_dim.
+            compact_ratio: Fraction of deleted vectors at which they are removed from the index.
         """
+        assert index_type in INDEX_TYPES, f"index_type = {index_type} should be one of {INDEX_TYPES}."
+
         faiss = dependable_faiss_import()
-        if index is None:
-            self.index = faiss.IndexFlatL2(embedding_dim)
-        if index_to_key is None:
-            self.index_to_key = {}
+        self.embedding_dim = embedding_dim
         self.memory_path = memory_path
 
+        self.index_type = index_type
+        self.promote_threshold = promote_threshold
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.pq_m = pq_m
+        self.compact_ratio = compact_ratio
+
+        self._set_index(index if index is not None else faiss.IndexIDMap2(faiss.IndexFlatL2(embedding_dim)),
+                        index_to_key if index_to_key is not None else {})
+
+    def _set_index(self, index: Any, index_to_key: Dict[int, str]) -> None:
+        """Use index, converting an index without ids, whose ids are its positions, to an IndexIDMap2."""
+        faiss = dependable_faiss_import()
+        if not isinstance(index, faiss.IndexIDMap2):
+            if isinstance(index, faiss.IndexIVF):
+                index.make_direct_map()
+            vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal > 0 else None
+            base = faiss.clone_index(index)
+            base.reset()
+            index = faiss.IndexIDMap2(base)
+            if vectors is not None:
+                index.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+
+        self.index = index
+        self.index_to_key = dict(index_to_key)
+        self.key_to_ids: Dict[str, List[int]] = {}
+        for id_, key in self.index_to_key.items():
+            self.key_to_ids.setdefault(key, []).append(id_)
+
+        ids = faiss.vector_to_array(index.id_map)
+        # ids of an old store are positions without days, see set_times
+        self.needs_times = len(ids) > 0 and int(ids.max()) <= SEQUENCE_MASK
+        self.next_id = int((ids & SEQUENCE_MASK).max()) + 1 if len(ids) > 0 else 0
+        # ids still in the index but no longer in index_to_key
+        self.deleted_ids = set(int(id_) for id_ in ids) - set(self.index_to_key.keys())
+        self._set_search_params()
+
+    def _base_index(self) -> Any:
+        faiss = dependable_faiss_import()
+        return faiss.downcast_index(self.index.index)
+
+    def _is_flat(self) -> bool:
+        faiss = dependable_faiss_import()
+        return isinstance(self._base_index(), faiss.IndexFlat)
+
+    def _set_search_params(self) -> None:
+        faiss = dependable_faiss_import()
+        try:
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+        except RuntimeError:
+            pass
+        base = self._base_index()
+        if isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = self.ef_search
+
+    def _build_index(self, num_vectors: int) -> Any:
+        faiss = dependable_faiss_import()
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(self.embedding_dim, self.hnsw_m)
+            index.hnsw.efConstruction = self.ef_construction
+            return index
+
+        # a cell should receive at least about 39 training vectors
+        nlist = self.nlist if self.nlist is not None else int(4 * np.sqrt(num_vectors))
+        nlist = max(1, min(nlist, num_vectors // 39))
+        quantizer = faiss.IndexFlatL2(self.embedding_dim)
+        if self.index_type == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, self.embedding_dim, nlist)
+
+        pq_m = self.pq_m
+        if pq_m is None:
+            pq_m = max(m for m in range(1, 65) if self.embedding_dim % m == 0)
+        assert self.embedding_dim % pq_m == 0, f"pq_m = {pq_m} should divide embedding_dim = {self.embedding_dim}."
+        # every sub-quantizer has 2 ** nbits centroids, which need about 39 training vectors each
+        nbits = int(np.clip(np.floor(np.log2(max(num_vectors, 1) / 39)), 1, 8))
+        return faiss.IndexIVFPQ(quantizer, self.embedding_dim, nlist, pq_m, nbits)
+
+    def _get_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the ids and vectors that are not deleted."""
+        ids = np.array(sorted(self.index_to_key.keys()), dtype=np.int64)
+        vectors = np.vstack([self.index.reconstruct(int(id_)) for id_ in ids]) if len(ids) > 0 \
+            else np.zeros((0, self.embedding_dim), dtype=np.float32)
+        return ids, vectors
+
+    def _rebuild(self, base: Any) -> None:
+        """Refill base, trained if needed, with the vectors that are not deleted."""
+        faiss = dependable_faiss_import()
+        ids, vectors = self._get_vectors()
+        if not base.is_trained:
+            base.train(vectors)
+        index = faiss.IndexIDMap2(base)
+        if len(ids) > 0:
+            index.add_with_ids(vectors, ids)
+        self.index = index
+        self.deleted_ids = set()
+        self._set_search_params()
+
+    def _compact(self) -> None:
+        """Remove the deleted ids from the index."""
+        if len(self.deleted_ids) == 0:
+            return
+        faiss = dependable_faiss_import()
+        if self._is_flat():
+            self.index.remove_ids(faiss.IDSelectorBatch(np.array(sorted(self.deleted_ids), dtype=np.int64)))
+            self.deleted_ids = set()
+            return
+
+        # IndexIDMap2 only handles removal from indexes that renumber in order, HNSW does
+        # not remove at all, so refill a trained copy instead
+        base = self._base_index()
+        if isinstance(base, faiss.IndexIVF):
+            base.make_direct_map()
+        empty = faiss.clone_index(base)
+        empty.reset()
+        self._rebuild(empty)
+
+    def _maybe_promote(self) -> None:
+        """Replace the flat index by index_type once it crossed promote_threshold."""
+        if self.index_type == "flat" or not self._is_flat() or len(self.index_to_key) < self.promote_threshold:
+            return
+
+        self._rebuild(self._build_index(len(self.index_to_key)))
+        print(f"Promote the flat index of {self.memory_path} to {self.index_type} with {self.index.ntotal} vectors.")
+
+    def _make_ids(self, times: List[Any]) -> np.ndarray:
+        ids = []
+        for time in times:
+            ids.append((time_to_day(time) << TIME_SHIFT) | (self.next_id & SEQUENCE_MASK))
+            self.next_id += 1
+        return np.array(ids, dtype=np.int64)
+
+    def set_times(self, key_to_time: Dict[str, Any]) -> None:
+        """Give the vectors of an old store, whose ids carry no days, the days of their keys."""
+        faiss = dependable_faiss_import()
+        base = self._base_index()
+        if isinstance(base, faiss.IndexIVF):
+            base.make_direct_map()
+        old_ids, vectors = self._get_vectors()
+        keys = [self.index_to_key[int(id_)] for id_ in old_ids]
+
+        self.next_id = 0
+        ids = self._make_ids([key_to_time.get(key, None) for key in keys])
+
+        empty = faiss.clone_index(base)
+        empty.reset()
+        index = faiss.IndexIDMap2(empty)
+        if len(ids) > 0:
+            index.add_with_ids(vectors, ids)
+        self.index = index
+        self.deleted_ids = set()
+        self.index_to_key = {}
+        self.key_to_ids = {}
+        for id_, key in zip(ids.tolist(), keys):
+            self.index_to_key[id_] = key
+            self.key_to_ids.setdefault(key, []).append(id_)
+        self.needs_times = False
+        self._set_search_params()
+
+    def _get_search_params(self, start_time: Any = None, end_time: Any = None) -> Optional[Any]:
+        """Search parameters restricting a search to start_time <= day < end_time."""
+        if start_time is None and end_time is None:
+            return None
+        faiss = dependable_faiss_import()
+        imin = time_to_day(start_time) << TIME_SHIFT if start_time is not None else 0
+        imax = time_to_day(end_time) << TIME_SHIFT if end_time is not None else np.iinfo(np.int64).max
+        selector = faiss.IDSelectorRange(imin, imax)
+
+        # the parameters have to match the type of the wrapped index
+        base = self._base_index()
+        if isinstance(base, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+        elif isinstance(base, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        # the parameters only keep a raw pointer to the selector
+        params.selector_ref = selector
+        return params
+
     def add_embeddings(
         self,
         keys: List[str],
         embeddings: List[List[float]],
+        times: Optional[List[Any]] = None,
         **kwargs,
     ) -> None:
         """Add embeddings to the vectorstore.
@@ -74,18 +303,25 @@ class FAISS(VectorStore):
         Args:
             keys: List of metadatas associated with the embedding.
             embeddings: List of embeddings to add to the vectorstore.
+            times: Dates of the embeddings, used by searches restricted to a date range.
             **kwargs: Other keyword arguments.
         """
         assert len(keys) == len(
             embeddings
         ), f"keys: {len(keys)}, embeddings: {len(embeddings)} expected to be equal length"
 
+        if len(keys) == 0:
+            return
+
         vector = np.array(embeddings, dtype=np.float32)
-        self.index.add(vector)
+        ids = self._make_ids(times if times is not None else [None] * len(keys))
+        self.index.add_with_ids(vector, ids)
+
+        for id_, key in zip(ids.tolist(), keys):
+            self.index_to_key[id_] = key
+            self.key_to_ids.setdefault(key, []).append(id_)
 
-        starting_len = len(self.index_to_key)
-        index_to_key = {starting_len + j: id_ for j, id_ in enumerate(keys)}
-        self.index_to_key.update(index_to_key)
+        self._maybe_promote()
 
     def delete(
         self,
@@ -102,23 +338,20 @@ class FAISS(VectorStore):
             bool: True if deletion is successful,
             False otherwise, None if not implemented.
         """
-        missing_keys = set(keys).difference(self.index_to_key.values())
+        missing_keys = set(key for key in keys if key not in self.key_to_ids)
         if missing_keys:
             raise ValueError(
                 f"Some specified keys do not exist in the current store: "
                 f"{missing_keys}"
             )
 
-        reversed_index = {id_: idx for idx, id_ in self.index_to_key.items()}
-        index_to_delete = [reversed_index[id_] for id_ in keys]
-        self.index.remove_ids(np.array(index_to_delete, dtype=np.int64))
+        for key in set(keys):
+            for id_ in self.key_to_ids.pop(key):
+                del self.index_to_key[id_]
+                self.deleted_ids.add(id_)
 
-        remaining_ids = [
-            id_
-            for i, id_ in sorted(self.index_to_key.items())
-            if i not in index_to_delete
-        ]
-        self.index_to_key = {i: id_ for i, id_ in enumerate(remaining_ids)}
+        if len(self.deleted_ids) > self.compact_ratio * max(self.index.ntotal, 1):
+            self._compact()
 
         return True
 
@@ -136,7 +369,19 @@ class FAISS(VectorStore):
             **kwargs: Other keyword arguments.
         """
         self.delete(keys)
-        self.add_embeddings(keys, embeddings)
+        self.add_embeddings(keys, embeddings, **kwargs)
+
+    def upsert(
+        self,
+        keys: List[str],
+        embeddings: List[List[float]],
+        **kwargs,
+    ) -> None:
+        """Update the embeddings of existing keys and add the others."""
+        existing_keys = [key for key in keys if key in self.key_to_ids]
+        if len(existing_keys) > 0:
+            self.delete(existing_keys)
+        self.add_embeddings(keys, embeddings, **kwargs)
 
     def similarity_search(
         self,
@@ -149,20 +394,56 @@ class FAISS(VectorStore):
         Args:
             embedding: Query embedding.
             top_k: Number of keys to return.
-            **kwargs: Other keyword arguments.
+            **kwargs: Other keyword arguments, see similarity_search_batch.
 
         Returns:
             List of (key, score) tuples.
         """
+        return self.similarity_search_batch([embedding], top_k, **kwargs)[0]
 
-        vector = np.array([embedding], dtype=np.float32)
-        scores, indices = self.index.search(vector, min(top_k, len(self.index_to_key)))
+    def similarity_search_batch(
+        self,
+        embeddings: List[List[float]],
+        top_k: int,
+        start_time: Any = None,
+        end_time: Any = None,
+        **kwargs,
+    ) -> List[List[Tuple[str, float]]]:
+        """Return keys most similar to every query with a single index search.
 
-        key_and_score = []
-        for idx, score in zip(indices[0], scores[0]):
-            key_and_score.append((self.index_to_key[idx], score))
+        Args:
+            embeddings: Query embeddings.
+            top_k: Number of keys to return per query.
+            start_time: Only return embeddings of this day or later.
+            end_time: Only return embeddings before this day.
+            **kwargs: Other keyword arguments.
 
-        return key_and_score
+        Returns:
+            One list of (key, score) tuples per query.
+        """
+        if len(embeddings) == 0:
+            return []
+
+        vectors = np.array(embeddings, dtype=np.float32).reshape(len(embeddings), self.embedding_dim)
+        # deleted ids may take some of the places
+        k = min(top_k + len(self.deleted_ids), self.index.ntotal)
+        if k == 0:
+            return [[] for _ in range(len(embeddings))]
+        scores, indices = self.index.search(vectors, k, params=self._get_search_params(start_time, end_time))
+
+        results = []
+        for row_indices, row_scores in zip(indices, scores):
+            key_and_score = []
+            for idx, score in zip(row_indices, row_scores):
+                # approximate indexes return -1 when fewer than k neighbors were found
+                if idx < 0 or idx not in self.index_to_key:
+                    continue
+                key_and_score.append((self.index_to_key[idx], score))
+                if len(key_and_score) == top_k:
+                    break
+            results.append(key_and_score)
+
+        return results
 
     def load_local(
         self,
@@ -187,10 +468,10 @@ class FAISS(VectorStore):
         with open(os.path.join(memory_path, "index2key.pkl"), "rb") as f:
             index_to_key = pickle.load(f)
 
-        self.index = index
-        self.index_to_key = index_to_key
         self.memory_path = memory_path
         self.embedding_dim = embedding_dim
+        self._set_index(index, index_to_key)
+        self._maybe_promote()
 
     def save_local(self, memory_path = None) -> None:
 
@@ -200,6 +481,7 @@ class FAISS(VectorStore):
         """Save FAISS index and index_to_key to disk."""
 
         os.makedirs(memory_path, exist_ok=True)
+        self._compact()
         # save index separately since it is not picklable
         faiss = dependable_faiss_import()
         faiss.write_index(self.index, os.path.join(memory_path, "index.faiss"))
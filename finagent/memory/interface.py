@@ -1,18 +1,25 @@
 import os
+import shutil
+import threading
 from typing import (
     Any,
     List,
     Dict,
+    Optional,
     Union,
     Tuple,
 )
-from collections import deque
+from collections import deque, OrderedDict
 
 from finagent.memory.base import VectorStore, Image
 from finagent.memory.faiss import FAISS
 from finagent.memory.basic_memory import BasicMemory
+from finagent.memory.journal import MemoryJournal
+from finagent.memory.retention import RetentionPolicy
 from finagent.registry import MEMORY
 
+MEMORY_TYPES = ["market_intelligence", "low_level_reflection", "high_level_reflection"]
+
 @MEMORY.register_module(force=True)
 class MemoryInterface():
     def __init__(
@@ -22,49 +29,88 @@ class MemoryInterface():
         memory_path: str,
         embedding_dim: int,
         max_recent_steps = 5,
+        max_resident_memorys: Optional[int] = None,
+        index_params: Optional[Dict[str, Any]] = None,
+        retention_params: Optional[Dict[str, Dict[str, Any]]] = None,
         workdir = None,
         tag = None,
     ) -> None:
+        """The memories of every (type, symbol) pair are only built and loaded on first access.
+
+        Args:
+            max_resident_memorys: Maximum number of (type, symbol) memories kept in
+                RAM. The least recently used one is saved to memory_path and dropped
+                when the bound is exceeded. None keeps all of them.
+            index_params: Keyword arguments of every FAISS store, e.g. index_type,
+                promote_threshold, nprobe and ef_search.
+            retention_params: Keyword arguments of the RetentionPolicy of every
+                memory type, e.g. dict(market_intelligence=dict(max_items=20000,
+                max_age_days=730, duplicate_threshold=0.97)). Memory types without
+                one keep every record.
+        """
 
         self.root = root
         self.symbols = symbols
         self.embedding_dim = embedding_dim
         self.max_recent_steps = max_recent_steps
+        self.max_resident_memorys = max_resident_memorys
+        self.index_params = index_params if index_params is not None else dict()
+        self.retention_params = retention_params if retention_params is not None else dict()
+        for type in self.retention_params:
+            assert type in MEMORY_TYPES, f"type = {type} of retention_params should be one of {MEMORY_TYPES}."
         self.workdir = workdir
         self.tag = tag
         self.memory_path = os.path.join(self.root, self.workdir, self.tag, memory_path)
         os.makedirs(self.memory_path, exist_ok=True)
 
-        self.market_intelligence_memorys = dict()
-        self.low_level_reflection_memorys = dict()
-        self.high_level_reflection_memorys = dict()
-        self._init_memorys()
+        # resident memories in least recently used order
+        self.memorys: OrderedDict = OrderedDict()
+        # where a non resident memory is loaded from, memories without one start empty
+        self.memory_sources: Dict[Tuple[str, str], str] = dict()
+        self._lock = threading.RLock()
+
+        # what the memories were loaded from, the base of a journal opened afterwards
+        self.loaded_from: Optional[Dict[str, Any]] = None
+        self.journal: Optional[MemoryJournal] = None
 
         self.market_intelligence_recent_histories = dict()
         self.low_level_reflection_recent_histories = dict()
         self.high_level_reflection_recent_histories = dict()
         self._init_recent_histories()
 
-    def _init_memorys(self):
-        for symbol in self.symbols:
-            if symbol not in self.market_intelligence_memorys:
-                memory_path = os.path.join(self.memory_path, symbol, "market_intelligence")
-                os.makedirs(memory_path, exist_ok=True)
-                vecstore = FAISS(memory_path = memory_path, embedding_dim = self.embedding_dim)
-                self.market_intelligence_memorys[symbol] = BasicMemory(memory_path = memory_path,
-                                                         vectorstore = vecstore)
-            if symbol not in self.low_level_reflection_memorys:
-                memory_path = os.path.join(self.memory_path, symbol, "low_level_reflection")
-                os.makedirs(memory_path, exist_ok=True)
-                vecstore = FAISS(memory_path = memory_path, embedding_dim=self.embedding_dim)
-                self.low_level_reflection_memorys[symbol] = BasicMemory(memory_path = memory_path,
-                                                         vectorstore = vecstore)
-            if symbol not in self.high_level_reflection_memorys:
-                memory_path = os.path.join(self.memory_path, symbol, "high_level_reflection")
-                os.makedirs(memory_path, exist_ok=True)
-                vecstore = FAISS(memory_path = memory_path, embedding_dim=self.embedding_dim)
-                self.high_level_reflection_memorys[symbol] = BasicMemory(memory_path = memory_path,
-                                                         vectorstore = vecstore)
+    def _build_memory(self, type: str, symbol: str) -> BasicMemory:
+        memory_path = os.path.join(self.memory_path, symbol, type)
+        os.makedirs(memory_path, exist_ok=True)
+        vecstore = FAISS(memory_path = memory_path, embedding_dim = self.embedding_dim, **self.index_params)
+        retention = RetentionPolicy(**self.retention_params[type]) if type in self.retention_params else None
+        memory = BasicMemory(memory_path = memory_path, vectorstore = vecstore, retention = retention)
+
+        source = self.memory_sources.get((type, symbol), None)
+        if source is not None:
+            try:
+                vecstore = FAISS(memory_path=source, embedding_dim=self.embedding_dim, **self.index_params)
+                vecstore.load_local(memory_path=source, embedding_dim=self.embedding_dim)
+
+                # print length of index
+                print(f"symbols: {symbol}, memory_path: {source}, vecstore length: {vecstore.index.ntotal}")
+
+                memory.load_local(
+                    memory_path=source,
+                    vectorstore=vecstore,
+                )
+            except Exception as e:
+                print(f"Failed to load {type} memory of {symbol}: {e}")
+        return memory
+
+    def _evict(self) -> None:
+        while self.max_resident_memorys is not None and len(self.memorys) > self.max_resident_memorys:
+            (type, symbol), memory = self.memorys.popitem(last=False)
+            path = os.path.join(self.memory_path, symbol, type)
+            os.makedirs(path, exist_ok=True)
+            memory.save_local(path)
+            self.memory_sources[(type, symbol)] = path
+            print(f"Evict {type} memory of {symbol} to {path}.")
+
     def _init_recent_histories(self):
         for symbol in self.symbols:
             if symbol not in self.market_intelligence_recent_histories:
@@ -79,15 +125,18 @@ class MemoryInterface():
 
     def _get_memory(self, type: str, symbol: str):
 
-        assert type in ["market_intelligence", "low_level_reflection", "high_level_reflection"],\
-            f"type = {type} should be one of ['market_intelligence', 'low_level_reflection', 'high_level_reflection']."
+        assert type in MEMORY_TYPES, f"type = {type} should be one of {MEMORY_TYPES}."
+        assert symbol in self.symbols, f"symbol = {symbol} should be one of the memory symbols."
 
-        if type == "market_intelligence":
-            return self.market_intelligence_memorys[symbol]
-        elif type == "low_level_reflection":
-            return self.low_level_reflection_memorys[symbol]
-        elif type == "high_level_reflection":
-            return self.high_level_reflection_memorys[symbol]
+        with self._lock:
+            key = (type, symbol)
+            if key in self.memorys:
+                self.memorys.move_to_end(key)
+                return self.memorys[key]
+            memory = self._build_memory(type, symbol)
+            self.memorys[key] = memory
+            self._evict()
+            return memory
 
     def _get_recent_history(self, type: str, symbol: str):
 
@@ -108,26 +157,69 @@ class MemoryInterface():
         data: Dict,
         embedding_key: str,
     ) -> None:
-        memory = self._get_memory(type, symbol)
-        memory.add(data = data, embedding_key = embedding_key)
+        with self._lock:
+            memory = self._get_memory(type, symbol)
+            key = memory.add(data = data, embedding_key = embedding_key)
+            if self.journal is not None and key is not None:
+                self.journal.append(type, symbol, [key], [data], embedding_key)
         print(f"Add memory for {type} {symbol}.")
 
+    def add_memories(
+        self,
+        type: str,
+        symbol: str,
+        datas: List[Dict],
+        embedding_key: str,
+    ) -> None:
+        with self._lock:
+            memory = self._get_memory(type, symbol)
+            keys = memory.add_batch(datas = datas, embedding_key = embedding_key)
+            # duplicates dropped by the retention policy are not journaled
+            added = [(key, data) for key, data in zip(keys, datas) if key is not None]
+            if self.journal is not None and len(added) > 0:
+                self.journal.append(type, symbol, [key for key, _ in added], [data for _, data in added], embedding_key)
+        print(f"Add {len(added)} of {len(datas)} memories for {type} {symbol}.")
+
     def query_memory(
         self,
         type: str,
         symbol: str,
         data: Dict,
         embedding_query: str,
-        top_k: int = 3)-> Tuple[List[Dict[str, Any]], List[float]]:
+        top_k: int = 3,
+        start_date: Any = None,
+        end_date: Any = None)-> Tuple[List[Dict[str, Any]], List[float]]:
         memory = self._get_memory(type, symbol)
         res = memory.query(
             data = data,
             embedding_query = embedding_query,
             top_k = top_k,
+            start_date = start_date,
+            end_date = end_date,
         )
         print(f"Query memory for {type} {symbol}.")
         return res
 
+    def query_memories(
+        self,
+        type: str,
+        symbol: str,
+        datas: List[Dict],
+        embedding_query: str,
+        top_k: int = 3,
+        start_date: Any = None,
+        end_date: Any = None)-> List[Tuple[List[Dict[str, Any]], List[float]]]:
+        memory = self._get_memory(type, symbol)
+        res = memory.query_batch(
+            datas = datas,
+            embedding_query = embedding_query,
+            top_k = top_k,
+            start_date = start_date,
+            end_date = end_date,
+        )
+        print(f"Query {len(datas)} memories for {type} {symbol}.")
+        return res
+
     def add_recent_history(
         self,
         type: str,
@@ -168,69 +260,101 @@ class MemoryInterface():
         if memory_path is None:
             memory_path = self.memory_path
 
-        """Load the memory from the local file."""
-        for symbol in self.symbols:
-
-            try:
-                path = os.path.join(memory_path, symbol, "market_intelligence")
-                os.makedirs(path, exist_ok=True)
-                vecstore = FAISS(memory_path=path, embedding_dim=self.embedding_dim)
-                vecstore.load_local(memory_path=path, embedding_dim=self.embedding_dim)
-
-                # print length of index
-                print(f"symbols: {symbol}, memory_path: {path}, vecstore length: {vecstore.index.ntotal}")
-
-                self.market_intelligence_memorys[symbol].load_local(
-                    memory_path=path,
-                    vectorstore=vecstore,
-                )
-            except Exception as e:
-                print(f"Failed to load market_intelligence_memorys: {e}")
-
-            try:
-                path = os.path.join(memory_path, symbol, "low_level_reflection")
-                os.makedirs(path, exist_ok=True)
-                vecstore = FAISS(memory_path=path, embedding_dim=self.embedding_dim)
-                vecstore.load_local(memory_path=path, embedding_dim=self.embedding_dim)
-
-                # print length of index
-                print(f"symbols: {symbol}, memory_path: {path}, vecstore length: {vecstore.index.ntotal}")
-
-                self.low_level_reflection_memorys[symbol].load_local(
-                    memory_path=path,
-                    vectorstore=vecstore,
-                )
-            except Exception as e:
-                print(f"Failed to load low_level_reflection_memorys: {e}")
-
-            try:
-                path = os.path.join(memory_path, symbol, "high_level_reflection")
-                os.makedirs(path, exist_ok=True)
-                vecstore = FAISS(memory_path=path, embedding_dim=self.embedding_dim)
-                vecstore.load_local(memory_path=path, embedding_dim=self.embedding_dim)
-
-                # print length of index
-                print(f"symbols: {symbol}, memory_path: {path}, vecstore length: {vecstore.index.ntotal}")
+        """Point every memory at memory_path, they are loaded from it on first access."""
+        with self._lock:
+            self.memorys.clear()
+            for symbol in self.symbols:
+                for type in MEMORY_TYPES:
+                    self.memory_sources[(type, symbol)] = os.path.join(memory_path, symbol, type)
+            self.loaded_from = {"path": os.path.abspath(memory_path), "checkpoint": None}
 
-                self.high_level_reflection_memorys[symbol].load_local(
-                    memory_path=path,
-                    vectorstore=vecstore,
-                )
-            except Exception as e:
-                print(f"Failed to load high_level_reflection_memorys: {e}")
+    def load_journal(
+        self,
+        journal_path: str,
+        checkpoint: str = None,
+    ) -> None:
+        """Restore the memory of the last journal checkpoint named checkpoint or before it.
+
+        The base memory of the journal is loaded first, which may itself be
+        another journal, then the records up to the checkpoint are replayed.
+        """
+        journal = MemoryJournal(journal_path, embedding_dim=self.embedding_dim)
+        meta = journal.load_meta()
+        marker = journal.find_checkpoint(checkpoint)
+
+        base = meta["base"]
+        if base is not None:
+            if MemoryJournal.exists(base["path"]):
+                self.load_journal(base["path"], checkpoint=base["checkpoint"])
+            else:
+                self.load_local(base["path"])
+        else:
+            with self._lock:
+                self.memorys.clear()
+                self.memory_sources.clear()
+
+        with self._lock:
+            if marker is not None:
+                batches: Dict[Tuple[str, str, str], Tuple[List[str], List[Dict]]] = dict()
+                for type, symbol, key, embedding_key, data in journal.read(marker):
+                    keys, datas = batches.setdefault((type, symbol, embedding_key), ([], []))
+                    keys.append(key)
+                    datas.append(data)
+                for (type, symbol, embedding_key), (keys, datas) in batches.items():
+                    self._get_memory(type, symbol).add_batch(datas = datas, embedding_key = embedding_key, names = keys,
+                                                             if_check_duplicates = False)
+                print(f"Replay {marker['num_records']} journal records up to {marker['name']} from {journal_path}.")
+            self.loaded_from = {"path": os.path.abspath(journal_path),
+                                "checkpoint": marker["name"] if marker is not None else None}
+
+    def open_journal(
+        self,
+        journal_path: str,
+    ) -> None:
+        """Log every memory added from now on to a journal in journal_path.
+
+        A new journal based on the loaded memory is started. If the memory was
+        restored from this journal, e.g. when resuming a run, it is continued
+        after the restored checkpoint instead.
+        """
+        with self._lock:
+            journal = MemoryJournal(journal_path, embedding_dim=self.embedding_dim)
+            base = self.loaded_from
+
+            marker = None
+            if base is not None and base["path"] == os.path.abspath(journal_path):
+                if base["checkpoint"] is not None:
+                    marker = journal.find_checkpoint(base["checkpoint"])
+                # the journal is about to be rewritten, so it can not be its own base
+                base = journal.load_meta()["base"]
+
+            if marker is not None:
+                journal.reset(checkpoint=marker)
+            else:
+                journal.reset(base=base)
+            self.journal = journal
+
+    def checkpoint(self, name: str) -> None:
+        """Mark the current state of the journal, it can be restored with load_journal."""
+        assert self.journal is not None, "open_journal should be called before checkpoint."
+        with self._lock:
+            self.journal.checkpoint(name)
 
     def save_local(self, memory_path = None) -> None:
         """Save the memory to the local file."""
         if memory_path is None:
             memory_path = self.memory_path
 
-        for symbol in self.symbols:
-            path = os.path.join(memory_path, symbol, "market_intelligence")
-            os.makedirs(path, exist_ok=True)
-            self.market_intelligence_memorys[symbol].save_local(path)
-            path = os.path.join(memory_path, symbol, "low_level_reflection")
-            os.makedirs(path, exist_ok=True)
-            self.low_level_reflection_memorys[symbol].save_local(path)
-            path = os.path.join(memory_path, symbol, "high_level_reflection")
-            os.makedirs(path, exist_ok=True)
-            self.high_level_reflection_memorys[symbol].save_local(path)
+        with self._lock:
+            for symbol in self.symbols:
+                for type in MEMORY_TYPES:
+                    path = os.path.join(memory_path, symbol, type)
+                    key = (type, symbol)
+                    if key in self.memorys:
+                        os.makedirs(path, exist_ok=True)
+                        self.memorys[key].save_local(path)
+                    elif key in self.memory_sources:
+                        # never accessed or evicted, its files are still up to date
+                        source = self.memory_sources[key]
+                        if os.path.exists(source) and os.path.abspath(source) != os.path.abspath(path):
+                            shutil.copytree(source, path, dirs_exist_ok=True)
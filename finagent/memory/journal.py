@@ -0,0 +1,153 @@
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import os
+import json
+import threading
+import numpy as np
+
+class MemoryJournal():
+    """Append-only log of the memories added during a run.
+
+    Files in journal_path:
+        journal.json: embedding_dim and the memory the journal starts from.
+        records.jsonl: one line per added memory, without its embedding.
+        vectors.f32: the embeddings as raw float32 rows, row i belongs to record i.
+        checkpoints.jsonl: named markers (records byte offset, number of records).
+
+    A checkpoint only appends a marker, restoring a checkpoint loads the base
+    memory and replays the records up to the marker.
+    """
+
+    META_FILE = "journal.json"
+    RECORDS_FILE = "records.jsonl"
+    VECTORS_FILE = "vectors.f32"
+    CHECKPOINTS_FILE = "checkpoints.jsonl"
+
+    def __init__(self,
+                 journal_path: str,
+                 embedding_dim: int) -> None:
+        self.journal_path = journal_path
+        self.embedding_dim = embedding_dim
+        self._lock = threading.Lock()
+        os.makedirs(journal_path, exist_ok=True)
+
+    @classmethod
+    def exists(cls, journal_path: str) -> bool:
+        return os.path.exists(os.path.join(journal_path, cls.META_FILE))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.journal_path, name)
+
+    def load_meta(self) -> Dict[str, Any]:
+        with open(self._path(self.META_FILE), "r") as f:
+            return json.load(f)
+
+    def get_checkpoints(self) -> List[Dict[str, Any]]:
+        checkpoints = []
+        if not os.path.exists(self._path(self.CHECKPOINTS_FILE)):
+            return checkpoints
+        with open(self._path(self.CHECKPOINTS_FILE), "r") as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    checkpoints.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a partially written last line from an interrupted run
+                    continue
+        return checkpoints
+
+    def find_checkpoint(self, name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Return the last checkpoint named name or before it, the last checkpoint if name is None."""
+        found = None
+        for checkpoint in self.get_checkpoints():
+            if name is None or checkpoint["name"] <= name:
+                found = checkpoint
+        return found
+
+    def reset(self,
+              base: Optional[Dict[str, Any]] = None,
+              checkpoint: Optional[Dict[str, Any]] = None) -> None:
+        """Start appending after checkpoint, dropping everything written after it.
+
+        Without a checkpoint the journal is emptied and will start from base.
+        Records after the last checkpoint were never committed, e.g. by an
+        interrupted run, so they are dropped in both cases.
+        """
+        with self._lock:
+            if checkpoint is None:
+                with open(self._path(self.META_FILE), "w") as f:
+                    json.dump({"embedding_dim": self.embedding_dim, "base": base}, f, indent=4)
+                records_offset, num_records, checkpoints = 0, 0, []
+            else:
+                records_offset, num_records = checkpoint["records_offset"], checkpoint["num_records"]
+                checkpoints = []
+                for item in self.get_checkpoints():
+                    checkpoints.append(item)
+                    if item["name"] == checkpoint["name"]:
+                        break
+
+            for name, size in [(self.RECORDS_FILE, records_offset),
+                               (self.VECTORS_FILE, num_records * self.embedding_dim * 4)]:
+                with open(self._path(name), "ab") as f:
+                    f.truncate(size)
+            with open(self._path(self.CHECKPOINTS_FILE), "w") as f:
+                for item in checkpoints:
+                    f.write(json.dumps(item) + "\n")
+
+    def append(self,
+               type: str,
+               symbol: str,
+               keys: List[str],
+               datas: List[Dict],
+               embedding_key: str) -> None:
+        records = []
+        vectors = []
+        for key, data in zip(keys, datas):
+            records.append(json.dumps({
+                "type": type,
+                "symbol": symbol,
+                "key": key,
+                "embedding_key": embedding_key,
+                "data": {k: v for k, v in data.items() if k != embedding_key},
+            }, ensure_ascii=False) + "\n")
+            vectors.append(data[embedding_key])
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(records), self.embedding_dim)
+
+        with self._lock:
+            with open(self._path(self.RECORDS_FILE), "a", encoding="utf-8") as f:
+                f.write("".join(records))
+            with open(self._path(self.VECTORS_FILE), "ab") as f:
+                f.write(vectors.tobytes())
+
+    def checkpoint(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            records_path = self._path(self.RECORDS_FILE)
+            records_offset = os.path.getsize(records_path) if os.path.exists(records_path) else 0
+            vectors_path = self._path(self.VECTORS_FILE)
+            num_records = (os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0) // (self.embedding_dim * 4)
+            checkpoint = {"name": name, "records_offset": records_offset, "num_records": num_records}
+            with open(self._path(self.CHECKPOINTS_FILE), "a") as f:
+                f.write(json.dumps(checkpoint) + "\n")
+        return checkpoint
+
+    def read(self, checkpoint: Dict[str, Any]) -> Iterator[Tuple[str, str, str, str, Dict]]:
+        """Yield (type, symbol, key, embedding_key, data) of the records up to checkpoint, data includes its embedding."""
+        num_records = checkpoint["num_records"]
+        if num_records == 0:
+            return
+        vectors = np.memmap(self._path(self.VECTORS_FILE), dtype=np.float32, mode="r",
+                            shape=(num_records, self.embedding_dim))
+        with open(self._path(self.RECORDS_FILE), "r", encoding="utf-8") as f:
+            for i in range(num_records):
+                record = json.loads(f.readline())
+                data = record["data"]
+                data[record["embedding_key"]] = vectors[i].tolist()
+                yield record["type"], record["symbol"], record["key"], record["embedding_key"], data
@@ -0,0 +1,97 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+import numpy as np
+
+from finagent.memory.base import VectorStore
+from finagent.memory.faiss import time_to_day
+
+class RetentionPolicy():
+    """Bound the size of a memory that is added to for a long time.
+
+    Records are expected to be added in chronological order, the oldest
+    records are the first ones of the memory and are dropped first.
+
+    Args:
+        max_items: Keep at most this many records.
+        max_age_days: Drop the records dated more than max_age_days days before
+            the newest added record. Records without a date never expire.
+        duplicate_threshold: Do not add a record whose cosine similarity to a
+            kept record, or to a record added before it in the same batch, is at
+            least duplicate_threshold.
+        duplicate_candidates: Number of nearest neighbours in the index checked
+            for a duplicate.
+    """
+
+    def __init__(self,
+                 max_items: Optional[int] = None,
+                 max_age_days: Optional[int] = None,
+                 duplicate_threshold: Optional[float] = None,
+                 duplicate_candidates: int = 4) -> None:
+        assert max_items is None or max_items > 0, f"max_items = {max_items} should be positive."
+        self.max_items = max_items
+        self.max_age_days = max_age_days
+        self.duplicate_threshold = duplicate_threshold
+        self.duplicate_candidates = duplicate_candidates
+
+    def find_duplicates(self,
+                        vectorstore: VectorStore,
+                        stored: Dict[str, np.ndarray],
+                        embeddings: List[np.ndarray]) -> List[bool]:
+        """Return for every embedding whether it is a near duplicate of a kept or earlier one.
+
+        stored holds the embeddings of the kept records by name, only those of the candidates are read.
+        """
+        if self.duplicate_threshold is None or len(embeddings) == 0:
+            return [False] * len(embeddings)
+
+        def normalize(vectors: np.ndarray) -> np.ndarray:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            return vectors / np.maximum(norms, 1e-12)
+
+        vectors = normalize(np.asarray(embeddings, dtype=np.float32))
+        # the nearest neighbours by the metric of the index are the candidates
+        candidates = vectorstore.similarity_search_batch(embeddings, self.duplicate_candidates)
+
+        duplicates = []
+        kept = []
+        for vector, key_and_score in zip(vectors, candidates):
+            others = [stored[key] for key, _ in key_and_score if key in stored]
+            others = normalize(np.asarray(others, dtype=np.float32).reshape(-1, vectors.shape[1]))
+            others = np.vstack([others] + kept)
+
+            duplicate = len(others) > 0 and float((others @ vector).max()) >= self.duplicate_threshold
+            duplicates.append(duplicate)
+            if not duplicate:
+                kept.append(vector[None])
+        return duplicates
+
+    def select_expired(self,
+                       memory: Dict[str, Dict],
+                       time_key: str,
+                       latest_time: Any = None) -> List[str]:
+        """Return the names of the records to drop, oldest first."""
+        names = list(memory.keys())
+        expired = []
+
+        if self.max_age_days is not None and latest_time is not None:
+            min_day = time_to_day(latest_time) - self.max_age_days
+            for name in names:
+                time = memory[name].get(time_key, None)
+                if time is None:
+                    continue
+                if time_to_day(time) >= min_day:
+                    break
+                expired.append(name)
+
+        if self.max_items is not None and len(names) - len(expired) > self.max_items:
+            dropped = set(expired)
+            for name in names:
+                if len(names) - len(expired) <= self.max_items:
+                    break
+                if name not in dropped:
+                    expired.append(name)
+        return expired
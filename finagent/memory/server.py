@@ -0,0 +1,242 @@
+import os
+import secrets
+import threading
+from multiprocessing.managers import BaseManager
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from finagent.memory.interface import MemoryInterface
+from finagent.registry import MEMORY
+
+# only used for Unix sockets, which only local users can reach
+DEFAULT_AUTHKEY = "finagent"
+
+def parse_address(address: Union[str, Tuple[str, int]]) -> Union[str, Tuple[str, int]]:
+    """A "host:port" string is a TCP address, any other string the path of a Unix socket."""
+    if isinstance(address, str) and ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return address
+
+def get_authkey(address: Union[str, Tuple[str, int]], authkey: Optional[str] = None) -> Optional[str]:
+    """The given authkey, or the MEMORY_SERVER_AUTHKEY environment variable.
+
+    The manager unpickles what its clients send, so a TCP address has no
+    default key, anyone who can reach the port could run code on the server.
+    """
+    if authkey is None:
+        authkey = os.environ.get("MEMORY_SERVER_AUTHKEY", None)
+    if authkey is None and not isinstance(address, tuple):
+        authkey = DEFAULT_AUTHKEY
+    return authkey
+
+
+class ReadWriteLock():
+    """Many readers or a single writer, a waiting writer blocks new readers."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        with self._cond:
+            while self._writer or self._waiting_writers > 0:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self) -> None:
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class MemoryService():
+    """The memory owned by a memory server, every client connection calls it from its own thread.
+
+    Adds are serialized and exclude queries, queries run concurrently. Every
+    add is committed to the journal of the memory, if one is open, with a
+    checkpoint, so that a restarted server restores all of them. The
+    checkpoints are numbered on from the last one of the journal, a restored
+    journal keeps every checkpoint up to the one it was restored from.
+    """
+
+    def __init__(self, memory: MemoryInterface) -> None:
+        self.memory = memory
+        self._lock = ReadWriteLock()
+        self._num_writes = 0
+        if memory.journal is not None:
+            last = memory.journal.find_checkpoint()
+            if last is not None and last["name"].isdigit():
+                self._num_writes = int(last["name"])
+
+    def _commit(self) -> None:
+        self._num_writes += 1
+        if self.memory.journal is not None:
+            self.memory.checkpoint(f"{self._num_writes:012d}")
+
+    def get_info(self) -> Dict[str, Any]:
+        return {"symbols": list(self.memory.symbols), "embedding_dim": self.memory.embedding_dim}
+
+    def add_memory(self, type: str, symbol: str, data: Dict, embedding_key: str) -> None:
+        self._lock.acquire_write()
+        try:
+            self.memory.add_memory(type=type, symbol=symbol, data=data, embedding_key=embedding_key)
+            self._commit()
+        finally:
+            self._lock.release_write()
+
+    def add_memories(self, type: str, symbol: str, datas: List[Dict], embedding_key: str) -> None:
+        self._lock.acquire_write()
+        try:
+            self.memory.add_memories(type=type, symbol=symbol, datas=datas, embedding_key=embedding_key)
+            self._commit()
+        finally:
+            self._lock.release_write()
+
+    def add_recent_history(self, type: str, symbol: str, data: Dict) -> None:
+        self._lock.acquire_write()
+        try:
+            self.memory.add_recent_history(type=type, symbol=symbol, data=data)
+        finally:
+            self._lock.release_write()
+
+    def query_memory(self, **kwargs) -> Tuple[List[Dict[str, Any]], List[float]]:
+        self._lock.acquire_read()
+        try:
+            return self.memory.query_memory(**kwargs)
+        finally:
+            self._lock.release_read()
+
+    def query_memories(self, **kwargs) -> List[Tuple[List[Dict[str, Any]], List[float]]]:
+        self._lock.acquire_read()
+        try:
+            return self.memory.query_memories(**kwargs)
+        finally:
+            self._lock.release_read()
+
+    def get_recent_history(self, type: str, symbol: str, k: int = 1) -> List[Any]:
+        self._lock.acquire_read()
+        try:
+            return self.memory.get_recent_history(type=type, symbol=symbol, k=k)
+        finally:
+            self._lock.release_read()
+
+
+class MemoryManager(BaseManager):
+    pass
+
+def serve_memory(memory: MemoryInterface,
+                 address: Union[str, Tuple[str, int]],
+                 authkey: Optional[str] = None) -> None:
+    """Serve memory at address until the process is interrupted."""
+    address = parse_address(address)
+    if isinstance(address, str) and os.path.exists(address):
+        # left behind by a server that was killed
+        os.remove(address)
+
+    authkey = get_authkey(address, authkey)
+    if authkey is None:
+        authkey = secrets.token_hex(16)
+        print(f"| No authkey is given for the TCP address {address}, clients should connect with the authkey {authkey}")
+
+    service = MemoryService(memory)
+    MemoryManager.register("get_service", callable=lambda: service)
+    manager = MemoryManager(address=address, authkey=authkey.encode("utf-8"))
+    server = manager.get_server()
+    print(f"| Serve the memory of {len(memory.symbols)} symbols at {address}")
+    server.serve_forever()
+
+
+@MEMORY.register_module(force=True)
+class RemoteMemoryInterface():
+    def __init__(self,
+                 address: Union[str, Tuple[str, int]],
+                 authkey: Optional[str] = None,
+                 symbols: List[str] = None,
+                 embedding_dim: int = None,
+                 **kwargs) -> None:
+        """A MemoryInterface whose memories live in a memory server, see tools/memory_server.py.
+
+        Many processes, e.g. one per symbol or the train and valid passes, share one
+        loaded index this way. The server owns loading, journaling and saving the
+        memory, so those methods do nothing here. Other keyword arguments of a
+        MemoryInterface config are ignored, so only its type and address need to change.
+        """
+        self.address = parse_address(address)
+        self.symbols = symbols
+        self.embedding_dim = embedding_dim
+        # the server journals the shared memory
+        self.journal = None
+
+        authkey = get_authkey(self.address, authkey)
+        if authkey is None:
+            raise ValueError(f"The memory server at the TCP address {address} needs an authkey, "
+                             f"set authkey or the MEMORY_SERVER_AUTHKEY environment variable.")
+
+        MemoryManager.register("get_service")
+        manager = MemoryManager(address=self.address, authkey=authkey.encode("utf-8"))
+        manager.connect()
+        self._service = manager.get_service()
+
+        info = self._service.get_info()
+        assert embedding_dim is None or embedding_dim == info["embedding_dim"], \
+            f"embedding_dim = {embedding_dim} differs from the embedding_dim = {info['embedding_dim']} of the memory server."
+        missing = [symbol for symbol in (symbols or []) if symbol not in info["symbols"]]
+        assert len(missing) == 0, f"symbols {missing} are not served by the memory server at {address}."
+
+    def add_memory(self, type: str, symbol: str, data: Dict, embedding_key: str) -> None:
+        self._service.add_memory(type, symbol, data, embedding_key)
+
+    def add_memories(self, type: str, symbol: str, datas: List[Dict], embedding_key: str) -> None:
+        self._service.add_memories(type, symbol, datas, embedding_key)
+
+    def query_memory(self, type: str, symbol: str, data: Dict, embedding_query: str, top_k: int = 3,
+                     start_date: Any = None, end_date: Any = None) -> Tuple[List[Dict[str, Any]], List[float]]:
+        return self._service.query_memory(type=type, symbol=symbol, data=data, embedding_query=embedding_query,
+                                          top_k=top_k, start_date=start_date, end_date=end_date)
+
+    def query_memories(self, type: str, symbol: str, datas: List[Dict], embedding_query: str, top_k: int = 3,
+                       start_date: Any = None, end_date: Any = None) -> List[Tuple[List[Dict[str, Any]], List[float]]]:
+        return self._service.query_memories(type=type, symbol=symbol, datas=datas, embedding_query=embedding_query,
+                                            top_k=top_k, start_date=start_date, end_date=end_date)
+
+    def add_recent_history(self, type: str, symbol: str, data: Dict) -> None:
+        self._service.add_recent_history(type, symbol, data)
+
+    def get_recent_history(self, type: str, symbol: str, k: int = 1) -> List[Any]:
+        return self._service.get_recent_history(type, symbol, k)
+
+    def load_local(self, memory_path: str = None) -> None:
+        print(f"The memory is loaded by the memory server at {self.address}, skip loading {memory_path}.")
+
+    def load_journal(self, journal_path: str, checkpoint: str = None) -> None:
+        print(f"The memory is loaded by the memory server at {self.address}, skip loading {journal_path}.")
+
+    def open_journal(self, journal_path: str) -> None:
+        print(f"The memory is journaled by the memory server at {self.address}.")
+
+    def save_local(self, memory_path = None) -> None:
+        """The shared memory is saved by the server, a client saving it would race with the other clients."""
+        pass
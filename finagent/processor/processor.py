@@ -1,10 +1,16 @@
 import multiprocessing
+import traceback
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from finagent.registry import PROCESSOR
+from finagent.utils import collapse_near_duplicates
 import os
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm.auto import tqdm
 from langchain_community.document_loaders import PlaywrightURLLoader
 import backoff
@@ -37,6 +43,76 @@ def langchain_parse_url(url):
 def my_rank(x):
    return pd.Series(x).rank(pct=True).iloc[-1]
 
+def _rolling_windows(x, w):
+    """Return the (n - w + 1, w) windows of x and the mask of windows without NaN."""
+    windows = sliding_window_view(x, w)
+    valid = ~np.isnan(windows).any(axis=1)
+    return windows, valid
+
+def _align_to_rows(values, n, w):
+    """Pad the per-window values with NaN for the first w - 1 rows, like rolling(w) does."""
+    res = np.full(n, np.nan)
+    res[w - 1:] = values
+    return res
+
+def rolling_rank(x, w):
+    """Vectorized rolling(w).apply(my_rank), the percentile rank of the last value in each window."""
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n < w:
+        return np.full(n, np.nan)
+    windows, valid = _rolling_windows(x, w)
+    last = windows[:, -1:]
+    less = (windows < last).sum(axis=1)
+    equal = (windows == last).sum(axis=1)
+    # average rank of ties, as pd.Series.rank(pct=True) does
+    rank = (less + (equal + 1) / 2) / w
+    return _align_to_rows(np.where(valid, rank, np.nan), n, w)
+
+def rolling_argmax(x, w):
+    """Vectorized rolling(w).apply(np.argmax)."""
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n < w:
+        return np.full(n, np.nan)
+    windows, valid = _rolling_windows(x, w)
+    return _align_to_rows(np.where(valid, windows.argmax(axis=1), np.nan), n, w)
+
+def rolling_argmin(x, w):
+    """Vectorized rolling(w).apply(np.argmin)."""
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if n < w:
+        return np.full(n, np.nan)
+    windows, valid = _rolling_windows(x, w)
+    return _align_to_rows(np.where(valid, windows.argmin(axis=1), np.nan), n, w)
+
+def cal_window_factors(df, window):
+    """Compute the rank_, imax_, imin_ and imxd_ factors of all windows in one pass.
+
+    Produces the same columns as the rolling(w).apply(...) callbacks, the argmax and
+    argmin of each window are computed once and reused for imxd_.
+    """
+    close = df["close"].to_numpy(dtype=np.float64)
+    high = df["high"].to_numpy(dtype=np.float64)
+    low = df["low"].to_numpy(dtype=np.float64)
+
+    factors = {}
+    for w in window:
+        factors['rank_{}'.format(w)] = rolling_rank(close, w) / w
+    imaxs = {w: rolling_argmax(high, w) for w in window}
+    imins = {w: rolling_argmin(low, w) for w in window}
+    for w in window:
+        factors['imax_{}'.format(w)] = imaxs[w] / w
+    for w in window:
+        factors['imin_{}'.format(w)] = imins[w] / w
+    for w in window:
+        factors['imxd_{}'.format(w)] = (imaxs[w] - imins[w]) / w
+
+    for name, values in factors.items():
+        df[name] = values
+    return df
+
 def cal_news(df):
     df["title"] = df["title"].fillna("").str.replace("\n", " ").replace("\r", " ").replace("\t", " ")
     df["text"] = df["text"].fillna("").str.replace("\n", " ").replace("\r", " ").replace("\t", " ")
@@ -98,17 +174,7 @@ def cal_factor(df, level="day"):
     for w in window:
         df['qtld_{}'.format(w)] = df['close'].rolling(w).quantile(0.2) / df['close']
 
-    for w in window:
-        df['rank_{}'.format(w)] = df['close'].rolling(w).apply(my_rank) / w
-
-    for w in window:
-        df['imax_{}'.format(w)] = df['high'].rolling(w).apply(np.argmax) / w
-
-    for w in window:
-        df['imin_{}'.format(w)] = df['low'].rolling(w).apply(np.argmin) / w
-
-    for w in window:
-        df['imxd_{}'.format(w)] = (df['high'].rolling(w).apply(np.argmax) - df['low'].rolling(w).apply(np.argmin)) / w
+    df = cal_window_factors(df, window)
 
     for w in window:
         shift = df['close'].shift(w)
@@ -194,12 +260,42 @@ def cal_factor(df, level="day"):
 
     return df
 
+# longest look-back of cal_factor, shift(60) and 60-row windows over one-row differences
+FACTOR_WARMUP = 60
+
+def cal_factor_incremental(price_df, features_df, level="day"):
+    """Extend features_df, computed on the first len(features_df) rows of price_df, to all rows of price_df.
+
+    Only the new rows plus a FACTOR_WARMUP tail are recomputed. The last old row is
+    recomputed as well, because its target looks one row ahead.
+    """
+    start = max(len(features_df) - 1, 0)
+    tail = deepcopy(price_df.iloc[max(start - FACTOR_WARMUP, 0):])
+    tail = cal_target(cal_factor(tail, level=level))
+    tail = tail.iloc[start - max(start - FACTOR_WARMUP, 0):]
+    return pd.concat([features_df.iloc[:start], tail[features_df.columns]], ignore_index=True)
+
+def file_fingerprint(path):
+    with open(path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": sha256}
+
 def cal_target(df):
     df['ret1'] = df['close'].pct_change(1).shift(-1)
     df['mov1'] = (df['ret1'] > 0)
     df['mov1'] = df['mov1'].astype(int)
     return df
 
+def _process_stock(args):
+    """Run one per-symbol step of a processor in a worker, returning the traceback instead of raising."""
+    processor, method, stock, start_date, end_date = args
+    try:
+        getattr(processor, method)(stock, start_date, end_date)
+        return stock, None
+    except Exception:
+        return stock, traceback.format_exc()
+
 @PROCESSOR.register_module(force=True)
 class Processor():
     def __init__(self,
@@ -211,7 +307,10 @@ class Processor():
                  interval="day",
                  if_parse_url = False,
                  workdir = None,
-                 tag = None
+                 tag = None,
+                 num_workers = 1,
+                 if_incremental = False,
+                 near_duplicate_params = None
                  ):
         self.root = root
         self.path_params = path_params
@@ -222,14 +321,100 @@ class Processor():
         self.if_parse_url = if_parse_url
         self.workdir = workdir
         self.tag = tag
+        self.num_workers = num_workers
+        self.if_incremental = if_incremental
+        # NearDuplicateIndex arguments for collapsing syndicated news, None only drops exact duplicates
+        self.near_duplicate_params = near_duplicate_params
 
         self.stocks = self._init_stocks()
+        self.failures = {}
 
     def _init_stocks(self):
         with open(self.stocks_path) as op:
             stocks = [line.strip() for line in op.readlines()]
         return stocks
 
+    def _map_stocks(self, method, stocks, start_date, end_date):
+        """Run a per-symbol step for every stock.
+
+        With num_workers > 1 the stocks are fanned out over a process pool in chunks.
+        Every stock writes its own files, so the outputs do not depend on the
+        scheduling. A failing stock does not stop the others, its traceback is
+        recorded in self.failures under the name of the step.
+        """
+        tasks = [(self, method, stock, start_date, end_date) for stock in stocks]
+
+        if self.num_workers is None or self.num_workers <= 1 or len(tasks) <= 1:
+            results = [_process_stock(task) for task in tqdm(tasks)]
+        else:
+            num_workers = min(self.num_workers, len(tasks))
+            chunksize = max(1, len(tasks) // (num_workers * 4))
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                results = list(tqdm(pool.map(_process_stock, tasks, chunksize=chunksize), total=len(tasks)))
+
+        failures = {stock: error for stock, error in results if error is not None}
+        for stock, error in failures.items():
+            print(f"| Failed {method} for {stock}:\n{error}")
+        self.failures.update({(method, stock): error for stock, error in failures.items()})
+
+        return failures
+
+    def _get_sources(self, name, stock):
+        return [os.path.join(self.root, item["path"], "{}.csv".format(stock)) for item in self.path_params[name]]
+
+    def _load_manifest(self, stock):
+        path = os.path.join(self.root, self.workdir, self.tag, "manifest", "{}.json".format(stock))
+        if not os.path.exists(path):
+            return {}
+        with open(path) as op:
+            return json.load(op)
+
+    def _update_manifest(self, name, stock, sources, start_date, end_date, last_timestamp, params=None):
+        """Record what the outputs of a step were built from, the manifest of a stock only is written by its own worker."""
+        manifest = self._load_manifest(stock)
+        manifest[name] = {
+            "sources": {source: file_fingerprint(source) for source in sources},
+            "start_date": start_date.strftime("%Y-%m-%d"),
+            "end_date": end_date.strftime("%Y-%m-%d"),
+            "interval": self.interval,
+            "last_timestamp": str(last_timestamp) if last_timestamp is not None else None,
+            "params": params,
+        }
+        outpath = os.path.join(self.root, self.workdir, self.tag, "manifest")
+        os.makedirs(outpath, exist_ok=True)
+        with open(os.path.join(outpath, "{}.json".format(stock)), "w") as op:
+            json.dump(manifest, op, indent=4)
+
+    def _get_manifest_entry(self, name, stock, start_date, outputs, params=None):
+        """Return the manifest entry of a step if its outputs can be reused from start_date on, otherwise None."""
+        if not self.if_incremental:
+            return None
+        entry = self._load_manifest(stock).get(name, None)
+        if entry is None:
+            return None
+        if entry["start_date"] != start_date.strftime("%Y-%m-%d") or entry["interval"] != self.interval:
+            return None
+        if entry.get("params", None) != params:
+            return None
+        if not all(os.path.exists(output) for output in outputs):
+            return None
+        return entry
+
+    def _is_up_to_date(self, entry, sources, end_date):
+        if entry is None or entry["end_date"] != end_date.strftime("%Y-%m-%d"):
+            return False
+        if sorted(entry["sources"].keys()) != sorted(sources):
+            return False
+        for source in sources:
+            fingerprint = entry["sources"][source]
+            stat = os.stat(source)
+            if stat.st_mtime == fingerprint["mtime"] and stat.st_size == fingerprint["size"]:
+                continue
+            # touched but maybe not modified
+            if file_fingerprint(source)["sha256"] != fingerprint["sha256"]:
+                return False
+        return True
+
     def _process_price_and_features(self,
                 stocks = None,
                 start_date = None,
@@ -240,6 +425,13 @@ class Processor():
 
         stocks = stocks if stocks else self.stocks
 
+        return self._map_stocks("_process_price_and_features_stock", stocks, start_date, end_date)
+
+    def _process_price_and_features_stock(self,
+                                          stock,
+                                          start_date,
+                                          end_date):
+
         price_columns = [
             "open",
             "high",
@@ -249,63 +441,83 @@ class Processor():
             "adj_close"
         ]
 
-        for stock in tqdm(stocks):
-            price = self.path_params["prices"][0]
-            price_type = price["type"]
-            price_path = price["path"]
-
-            price_path = os.path.join(self.root, price_path, "{}.csv".format(stock))
-
-            if price_type == "fmp":
-                price_column_map = {
-                    "open": "open",
-                    "high": "high",
-                    "low": "low",
-                    "close": "close",
-                    "volume": "volume",
-                    "adjClose": "adj_close",
-                }
-            elif price_type == "yahoofinance":
-                price_column_map = {
-                    "Open": "open",
-                    "High": "high",
-                    "Low": "low",
-                    "Close": "close",
-                    "Volume": "volume",
-                    "Date": "timestamp",
-                    "Adj Close": "adj_close",
-                }
-            else:
-                price_column_map = {
-                    "open": "open",
-                    "high": "high",
-                    "low": "low",
-                    "close": "close",
-                    "volume": "volume",
-                    "adjClose": "adj_close",
-                }
-
-            assert os.path.exists(price_path), "Price path {} does not exist".format(price_path)
-            price_df = pd.read_csv(price_path)
-
-            price_df = price_df.rename(columns=price_column_map)[["timestamp"] + price_columns]
-
-            price_df["timestamp"] = pd.to_datetime(price_df["timestamp"])
-            price_df = price_df[(price_df["timestamp"] >= start_date) & (price_df["timestamp"] < end_date)]
-
-            price_df = price_df.sort_values(by="timestamp")
-            price_df = price_df.drop_duplicates(subset=["timestamp"], keep="first")
-            price_df = price_df.reset_index(drop=True)
-
-            outpath = os.path.join(self.root, self.workdir, self.tag, "price")
-            os.makedirs(outpath, exist_ok=True)
-            price_df.to_parquet(os.path.join(outpath, "{}.parquet".format(stock)), index=False)
+        price = self.path_params["prices"][0]
+        price_type = price["type"]
+        price_path = price["path"]
+
+        price_path = os.path.join(self.root, price_path, "{}.csv".format(stock))
+
+        price_outpath = os.path.join(self.root, self.workdir, self.tag, "price", "{}.parquet".format(stock))
+        features_outpath = os.path.join(self.root, self.workdir, self.tag, "features", "{}.parquet".format(stock))
+        entry = self._get_manifest_entry("prices", stock, start_date, [price_outpath, features_outpath])
+        if self._is_up_to_date(entry, [price_path], end_date):
+            return
+
+        if price_type == "fmp":
+            price_column_map = {
+                "open": "open",
+                "high": "high",
+                "low": "low",
+                "close": "close",
+                "volume": "volume",
+                "adjClose": "adj_close",
+            }
+        elif price_type == "yahoofinance":
+            price_column_map = {
+                "Open": "open",
+                "High": "high",
+                "Low": "low",
+                "Close": "close",
+                "Volume": "volume",
+                "Date": "timestamp",
+                "Adj Close": "adj_close",
+            }
+        else:
+            price_column_map = {
+                "open": "open",
+                "high": "high",
+                "low": "low",
+                "close": "close",
+                "volume": "volume",
+                "adjClose": "adj_close",
+            }
+
+        assert os.path.exists(price_path), "Price path {} does not exist".format(price_path)
+        price_df = pd.read_csv(price_path)
+
+        price_df = price_df.rename(columns=price_column_map)[["timestamp"] + price_columns]
+
+        price_df["timestamp"] = pd.to_datetime(price_df["timestamp"])
+        price_df = price_df[(price_df["timestamp"] >= start_date) & (price_df["timestamp"] < end_date)]
+
+        price_df = price_df.sort_values(by="timestamp")
+        price_df = price_df.drop_duplicates(subset=["timestamp"], keep="first")
+        price_df = price_df.reset_index(drop=True)
+
+        features_df = None
+        if entry is not None:
+            # reuse the old rows if the source only got new rows appended
+            old_price_df = pd.read_parquet(price_outpath)
+            old_features_df = pd.read_parquet(features_outpath)
+            num_old = len(old_price_df)
+            if (num_old > 0 and num_old == len(old_features_df) and len(price_df) >= num_old
+                    and price_df.iloc[:num_old].equals(old_price_df)):
+                if len(price_df) == num_old:
+                    features_df = old_features_df
+                else:
+                    features_df = cal_factor_incremental(price_df, old_features_df, level=self.interval)
 
+        if features_df is None:
             features_df = cal_factor(deepcopy(price_df), level=self.interval)
             features_df = cal_target(features_df)
-            outpath = os.path.join(self.root, self.workdir, self.tag, "features")
-            os.makedirs(outpath, exist_ok=True)
-            features_df.to_parquet(os.path.join(outpath, "{}.parquet".format(stock)), index=False)
+
+        os.makedirs(os.path.dirname(price_outpath), exist_ok=True)
+        price_df.to_parquet(price_outpath, index=False)
+        os.makedirs(os.path.dirname(features_outpath), exist_ok=True)
+        features_df.to_parquet(features_outpath, index=False)
+
+        self._update_manifest("prices", stock, [price_path], start_date, end_date,
+                              price_df["timestamp"].max() if len(price_df) > 0 else None)
 
     def _process_guidance(self,
                           stocks = None,
@@ -316,69 +528,82 @@ class Processor():
 
         stocks = stocks if stocks else self.stocks
 
+        return self._map_stocks("_process_guidance_stock", stocks, start_date, end_date)
+
+    def _process_guidance_stock(self,
+                                stock,
+                                start_date,
+                                end_date):
+
+        outpath = os.path.join(self.root, self.workdir, self.tag, "guidance", "{}.parquet".format(stock))
+        sources = self._get_sources("guidance", stock)
+        # text sources are cheap to rebuild, only skip the unchanged ones
+        if self._is_up_to_date(self._get_manifest_entry("guidance", stock, start_date, [outpath]), sources, end_date):
+            return
+
         guidance_columns = [
             "title",
             "text",
             "sentiment",
             "url",
         ]
-        
-        for stock in tqdm(stocks):
 
-            guidances = self.path_params["guidance"]
-            guidances_df = []
+        guidances = self.path_params["guidance"]
+        guidances_df = []
 
-            for guidance in guidances:
-                guidance_type = guidance["type"]
-                guidance_path = guidance["path"]
+        for guidance in guidances:
+            guidance_type = guidance["type"]
+            guidance_path = guidance["path"]
 
-                guidance_path = os.path.join(self.root, guidance_path, "{}.csv".format(stock))
+            guidance_path = os.path.join(self.root, guidance_path, "{}.csv".format(stock))
+
+            if guidance_type == "rapidapi_seekingalpha":
+                guidance_column_map = {
+                    "title": "title",
+                    "summary": "text",
+                    "sentiment": "sentiment",
+                    "url": "url",
+                }
 
-                if guidance_type == "rapidapi_seekingalpha":
-                    guidance_column_map = {
-                        "title": "title",
-                        "summary": "text",
-                        "sentiment": "sentiment",
-                        "url": "url",
-                    }
+            assert os.path.exists(guidance_path), "guidance path {} does not exist".format(guidance_path)
 
-                assert os.path.exists(guidance_path), "guidance path {} does not exist".format(guidance_path)
+            guidance_df = pd.read_csv(guidance_path)
+            guidance_df = guidance_df.rename(columns=guidance_column_map)[["timestamp"] + guidance_columns]
+            guidance_df["timestamp"] = pd.to_datetime(guidance_df["timestamp"])
 
-                guidance_df = pd.read_csv(guidance_path)
-                guidance_df = guidance_df.rename(columns=guidance_column_map)[["timestamp"] + guidance_columns]
-                guidance_df["timestamp"] = pd.to_datetime(guidance_df["timestamp"])
+            guidance_df = guidance_df[(guidance_df["timestamp"] >= start_date) & (guidance_df["timestamp"] < end_date)]
+            guidance_df = guidance_df.sort_values(by="timestamp")
+            guidance_df = guidance_df.drop_duplicates(subset=["timestamp", "title", "text"], keep="first")
 
-                guidance_df = guidance_df[(guidance_df["timestamp"] >= start_date) & (guidance_df["timestamp"] < end_date)]
-                guidance_df = guidance_df.sort_values(by="timestamp")
-                guidance_df = guidance_df.drop_duplicates(subset=["timestamp", "title", "text"], keep="first")
+            if guidance_type == "rapidapi_seekingalpha":
+                guidance_df["type"] = "rapidapi"
+                guidance_df["source"] = "seekingalpha"
 
-                if guidance_type == "rapidapi_seekingalpha":
-                    guidance_df["type"] = "rapidapi"
-                    guidance_df["source"] = "seekingalpha"
+            guidance_df = guidance_df.reset_index(drop=True)
+            guidance_df = cal_guidance(guidance_df)
+            guidance_df["timestamp"] = pd.to_datetime(guidance_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
+            guidances_df.append(guidance_df)
 
-                guidance_df = guidance_df.reset_index(drop=True)
-                guidance_df = cal_guidance(guidance_df)
-                guidance_df["timestamp"] = pd.to_datetime(guidance_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
-                guidances_df.append(guidance_df)
+        guidances_df = pd.concat(guidances_df)
 
-            guidances_df = pd.concat(guidances_df)
+        if self.if_parse_url:
+            urls = guidances_df["url"].values
+            max_process = 10
+            pool = multiprocessing.Pool(processes=max_process)
+            contents = pool.map(langchain_parse_url, urls)
+            pool.close()
+            pool.join()
+            guidances_df["content"] = contents
 
-            if self.if_parse_url:
-                urls = guidances_df["url"].values
-                max_process = 10
-                pool = multiprocessing.Pool(processes=max_process)
-                contents = pool.map(langchain_parse_url, urls)
-                pool.close()
-                pool.join()
-                guidances_df["content"] = contents
+        guidances_df = guidances_df.sort_values(by="timestamp")
+        guidances_df = guidances_df.reset_index(drop=True)
+        guidances_df = guidances_df[["timestamp", "type", "sentiment", "title", "text", "url"]]
 
-            guidances_df = guidances_df.sort_values(by="timestamp")
-            guidances_df = guidances_df.reset_index(drop=True)
-            guidances_df = guidances_df[["timestamp", "type", "sentiment", "title", "text", "url"]]
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        guidances_df.to_parquet(outpath, index=False)
 
-            outpath = os.path.join(self.root, self.workdir, self.tag, "guidance")
-            os.makedirs(outpath, exist_ok=True)
-            guidances_df.to_parquet(os.path.join(outpath, "{}.parquet".format(stock)), index=False)
+        self._update_manifest("guidance", stock, sources, start_date, end_date,
+                              guidances_df["timestamp"].max() if len(guidances_df) > 0 else None)
 
     def _process_news(self,
                 stocks = None,
@@ -390,6 +615,19 @@ class Processor():
 
         stocks = stocks if stocks else self.stocks
 
+        return self._map_stocks("_process_news_stock", stocks, start_date, end_date)
+
+    def _process_news_stock(self,
+                            stock,
+                            start_date,
+                            end_date):
+
+        outpath = os.path.join(self.root, self.workdir, self.tag, "news", "{}.parquet".format(stock))
+        sources = self._get_sources("news", stock)
+        if self._is_up_to_date(self._get_manifest_entry("news", stock, start_date, [outpath],
+                                                        params=self.near_duplicate_params), sources, end_date):
+            return
+
         news_columns = [
             "title",
             "text",
@@ -397,79 +635,84 @@ class Processor():
             "url"
         ]
 
-        for stock in tqdm(stocks):
-
-            newses = self.path_params["news"]
-            newses_df = []
-
-            for news in newses:
-                news_type = news["type"]
-                news_path = news["path"]
-
-                news_path = os.path.join(self.root, news_path, "{}.csv".format(stock))
-
-                if news_type == "fmp":
-                    news_column_map = {
-                        "title": "title",
-                        "text": "text",
-                        "site": "source",
-                        "url": "url",
-                    }
-                elif news_type == "yahoofinance":
-                    news_column_map = {
-                        "headline": "title",
-                        "summary": "text",
-                        "datetime": "timestamp",
-                        "source": "source",
-                        "url": "url",
-                    }
-                else:
-                    news_column_map = {
-                        "title": "title",
-                        "text": "text",
-                        "site": "source",
-                        "url": "url",
-                    }
-
-                assert os.path.exists(news_path), "News path {} does not exist".format(news_path)
-
-                news_df = pd.read_csv(news_path)
-                news_df = news_df.rename(columns=news_column_map)[["timestamp"] + news_columns]
-                news_df["timestamp"] = pd.to_datetime(news_df["timestamp"])
-
-                news_df = news_df[(news_df["timestamp"] >= start_date) & (news_df["timestamp"] < end_date)]
-                news_df = news_df.sort_values(by="timestamp")
-                news_df = news_df.drop_duplicates(subset=["timestamp", "title", "text"], keep="first")
-
-                if news_type == "fmp":
-                    news_df["type"] = "fmp"
-                elif news_type == "yahoofinance":
-                    news_df["type"] = "yahoofinance"
-
-                news_df = news_df.reset_index(drop=True)
-                news_df = cal_news(news_df)
-                news_df["timestamp"] = pd.to_datetime(news_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
-                newses_df.append(news_df)
-
-            newses_df = pd.concat(newses_df)
-
-            if self.if_parse_url:
-                urls = newses_df["url"].values
-                max_process = 10
-                pool = multiprocessing.Pool(processes=max_process)
-                contents = pool.map(langchain_parse_url, urls)
-                pool.close()
-                pool.join()
-                newses_df["content"] = contents
-
-            newses_df = newses_df.sort_values(by="timestamp")
-            newses_df = newses_df.drop_duplicates(subset=["timestamp", "title"], keep="first")
-            newses_df = newses_df.reset_index(drop=True)
-            newses_df = newses_df[["timestamp", "type", "source", "title", "text", "url"]]
-
-            outpath = os.path.join(self.root, self.workdir, self.tag, "news")
-            os.makedirs(outpath, exist_ok=True)
-            newses_df.to_parquet(os.path.join(outpath, "{}.parquet".format(stock)), index=False)
+        newses = self.path_params["news"]
+        newses_df = []
+
+        for news in newses:
+            news_type = news["type"]
+            news_path = news["path"]
+
+            news_path = os.path.join(self.root, news_path, "{}.csv".format(stock))
+
+            if news_type == "fmp":
+                news_column_map = {
+                    "title": "title",
+                    "text": "text",
+                    "site": "source",
+                    "url": "url",
+                }
+            elif news_type == "yahoofinance":
+                news_column_map = {
+                    "headline": "title",
+                    "summary": "text",
+                    "datetime": "timestamp",
+                    "source": "source",
+                    "url": "url",
+                }
+            else:
+                news_column_map = {
+                    "title": "title",
+                    "text": "text",
+                    "site": "source",
+                    "url": "url",
+                }
+
+            assert os.path.exists(news_path), "News path {} does not exist".format(news_path)
+
+            news_df = pd.read_csv(news_path)
+            news_df = news_df.rename(columns=news_column_map)[["timestamp"] + news_columns]
+            news_df["timestamp"] = pd.to_datetime(news_df["timestamp"])
+
+            news_df = news_df[(news_df["timestamp"] >= start_date) & (news_df["timestamp"] < end_date)]
+            news_df = news_df.sort_values(by="timestamp")
+            news_df = news_df.drop_duplicates(subset=["timestamp", "title", "text"], keep="first")
+
+            if news_type == "fmp":
+                news_df["type"] = "fmp"
+            elif news_type == "yahoofinance":
+                news_df["type"] = "yahoofinance"
+
+            news_df = news_df.reset_index(drop=True)
+            news_df = cal_news(news_df)
+            news_df["timestamp"] = pd.to_datetime(news_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
+            newses_df.append(news_df)
+
+        newses_df = pd.concat(newses_df)
+
+        if self.if_parse_url:
+            urls = newses_df["url"].values
+            max_process = 10
+            pool = multiprocessing.Pool(processes=max_process)
+            contents = pool.map(langchain_parse_url, urls)
+            pool.close()
+            pool.join()
+            newses_df["content"] = contents
+
+        newses_df = newses_df.sort_values(by="timestamp")
+        newses_df = newses_df.drop_duplicates(subset=["timestamp", "title"], keep="first")
+        if self.near_duplicate_params is not None:
+            newses_df = collapse_near_duplicates(newses_df, **self.near_duplicate_params)
+        else:
+            newses_df["source_count"] = 1
+        newses_df = newses_df.reset_index(drop=True)
+        newses_df = newses_df[["timestamp", "type", "source", "title", "text", "url", "source_count"]]
+
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        newses_df.to_parquet(outpath, index=False)
+
+        self._update_manifest("news", stock, sources, start_date, end_date,
+                              newses_df["timestamp"].max() if len(newses_df) > 0 else None,
+                              params=self.near_duplicate_params)
 
     def _process_sentiment(self,
                            stocks = None,
@@ -488,6 +731,18 @@ class Processor():
 
         stocks = stocks if stocks else self.stocks
 
+        return self._map_stocks("_process_sentiment_stock", stocks, start_date, end_date)
+
+    def _process_sentiment_stock(self,
+                                 stock,
+                                 start_date,
+                                 end_date):
+
+        outpath = os.path.join(self.root, self.workdir, self.tag, "sentiment", "{}.parquet".format(stock))
+        sources = self._get_sources("sentiment", stock)
+        if self._is_up_to_date(self._get_manifest_entry("sentiment", stock, start_date, [outpath]), sources, end_date):
+            return
+
         sentiment_columns = [
             "stocktwits_posts",
             "stocktwits_comments",
@@ -496,60 +751,60 @@ class Processor():
             "stocktwits_sentiment",
         ]
 
-        for stock in tqdm(stocks):
+        sentiments = self.path_params["sentiment"]
+        sentiments_df = []
 
-            sentiments = self.path_params["sentiment"]
-            sentiments_df = []
+        for sentiment in sentiments:
+            sentiment_type = sentiment["type"]
+            sentiment_path = sentiment["path"]
 
-            for sentiment in sentiments:
-                sentiment_type = sentiment["type"]
-                sentiment_path = sentiment["path"]
+            sentiment_path = os.path.join(self.root, sentiment_path, "{}.csv".format(stock))
 
-                sentiment_path = os.path.join(self.root, sentiment_path, "{}.csv".format(stock))
+            if sentiment_type == "fmp":
+                sentiment_column_map = {}
 
-                if sentiment_type == "fmp":
-                    sentiment_column_map = {}
+            assert os.path.exists(sentiment_path), "sentiment path {} does not exist".format(sentiment_path)
 
-                assert os.path.exists(sentiment_path), "sentiment path {} does not exist".format(sentiment_path)
+            sentiment_df = pd.read_csv(sentiment_path)
+            sentiment_df = sentiment_df.rename(columns=sentiment_column_map)[["timestamp"] + sentiment_columns]
+            sentiment_df["timestamp"] = pd.to_datetime(sentiment_df["timestamp"])
 
-                sentiment_df = pd.read_csv(sentiment_path)
-                sentiment_df = sentiment_df.rename(columns=sentiment_column_map)[["timestamp"] + sentiment_columns]
-                sentiment_df["timestamp"] = pd.to_datetime(sentiment_df["timestamp"])
+            sentiment_df = sentiment_df[ (sentiment_df["timestamp"] >= start_date) & (sentiment_df["timestamp"] < end_date)]
+            sentiment_df = sentiment_df.sort_values(by="timestamp")
+            sentiment_df["timestamp"] = pd.to_datetime(sentiment_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
 
-                sentiment_df = sentiment_df[ (sentiment_df["timestamp"] >= start_date) & (sentiment_df["timestamp"] < end_date)]
-                sentiment_df = sentiment_df.sort_values(by="timestamp")
-                sentiment_df["timestamp"] = pd.to_datetime(sentiment_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
+            if sentiment_type == "rapidapi_seekingalpha":
+                sentiment_df["type"] = "rapidapi"
+                sentiment_df["source"] = "seekingalpha"
 
-                if sentiment_type == "rapidapi_seekingalpha":
-                    sentiment_df["type"] = "rapidapi"
-                    sentiment_df["source"] = "seekingalpha"
+            sentiment_df = cal_sentiment(sentiment_df, sentiment_columns)
+            sentiment_df = sentiment_df.drop_duplicates(subset=["timestamp"], keep="first")
+            sentiment_df = sentiment_df.reset_index(drop=True)
+            sentiment_df["timestamp"] = pd.to_datetime(sentiment_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
+            sentiments_df.append(sentiment_df)
 
-                sentiment_df = cal_sentiment(sentiment_df, sentiment_columns)
-                sentiment_df = sentiment_df.drop_duplicates(subset=["timestamp"], keep="first")
-                sentiment_df = sentiment_df.reset_index(drop=True)
-                sentiment_df["timestamp"] = pd.to_datetime(sentiment_df["timestamp"]).apply(lambda x: x.strftime("%Y-%m-%d"))
-                sentiments_df.append(sentiment_df)
+        sentiments_df = pd.concat(sentiments_df)
 
-            sentiments_df = pd.concat(sentiments_df)
+        if self.if_parse_url:
+            urls = sentiments_df["url"].values
+            max_process = 10
+            pool = multiprocessing.Pool(processes=max_process)
+            contents = pool.map(langchain_parse_url, urls)
+            pool.close()
+            pool.join()
+            sentiments_df["content"] = contents
 
-            if self.if_parse_url:
-                urls = sentiments_df["url"].values
-                max_process = 10
-                pool = multiprocessing.Pool(processes=max_process)
-                contents = pool.map(langchain_parse_url, urls)
-                pool.close()
-                pool.join()
-                sentiments_df["content"] = contents
+        sentiments_df["type"] = "sentiment"
 
-            sentiments_df["type"] = "sentiment"
+        sentiments_df = sentiments_df.sort_values(by="timestamp")
+        sentiments_df = sentiments_df.reset_index(drop=True)
+        sentiments_df = sentiments_df[["timestamp", "type"] + sentiment_columns]
 
-            sentiments_df = sentiments_df.sort_values(by="timestamp")
-            sentiments_df = sentiments_df.reset_index(drop=True)
-            sentiments_df = sentiments_df[["timestamp", "type"] + sentiment_columns]
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        sentiments_df.to_parquet(outpath, index=False)
 
-            outpath = os.path.join(self.root, self.workdir, self.tag, "sentiment")
-            os.makedirs(outpath, exist_ok=True)
-            sentiments_df.to_parquet(os.path.join(outpath, "{}.parquet".format(stock)), index=False)
+        self._update_manifest("sentiment", stock, sources, start_date, end_date,
+                              sentiments_df["timestamp"].max() if len(sentiments_df) > 0 else None)
 
     def _process_economic(self,
                           stocks = None,
@@ -612,6 +867,8 @@ class Processor():
                 start_date = None,
                 end_date = None):
 
+        self.failures = {}
+
         print(">" * 30 + "Running price and features..." + ">" * 30)
         self._process_price_and_features(stocks=stocks, start_date=start_date, end_date=end_date)
         print("<" * 30 + "Finish price and features..." + "<" * 30)
@@ -633,4 +890,11 @@ class Processor():
         if "economic" in self.path_params:
             print(">" * 30 + "Running economic..." + ">" * 30)
             self._process_economic(stocks=stocks, start_date=start_date, end_date=end_date)
-            print("<" * 30 + "Finish economic..." + "<" * 30)
\ No newline at end of file
+            print("<" * 30 + "Finish economic..." + "<" * 30)
+
+        if len(self.failures) > 0:
+            failed_stocks = sorted(set(stock for _, stock in self.failures.keys()))
+            print(f"| {len(failed_stocks)} of {len(stocks if stocks else self.stocks)} stocks failed: {', '.join(failed_stocks)}")
+            for method, stock in self.failures.keys():
+                print(f"|   {stock}: {method}")
+        return self.failures
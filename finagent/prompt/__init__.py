@@ -2,6 +2,8 @@ from .helper import generate_prompt_html
 from .helper import content_replace
 from .helper import text_replace
 from .helper import str2html
+from .helper import inline_modules
+from .template import CompiledTemplate, compile_template
 from .custom import Prompt
 from .helper import prepared_tools_params
 from .helper import prepare_latest_market_intelligence_params
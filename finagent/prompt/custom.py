@@ -2,16 +2,26 @@ import json
 import os
 
 import backoff
-from typing import Dict, Any
+from bs4 import BeautifulSoup
+from typing import Any, Callable, Dict
 from finagent.registry import PROMPT
-from finagent.provider.provider import encode_image
-from finagent.prompt.helper import generate_prompt_html, content_replace
-from finagent.utils import parse_semi_formatted_xml, parse_semi_formatted_json
+from finagent.provider import ImagePayloadCache
+from finagent.prompt.helper import generate_prompt_html
+from finagent.prompt.template import compile_template
+from finagent.utils import parse_semi_formatted_xml, parse_semi_formatted_json, format_diagnostics
+
+IMAGE_CACHE = ImagePayloadCache()
+
+REPAIR_PROMPT = """Your response above is incomplete, the fields {keys} are missing or cut off.
+{diagnostics}
+Return ONLY these fields as a valid XML object, in the XML output format given above and inside <output></output>. Do not repeat the other fields."""
 
 @PROMPT.register_module(force=True)
 class Prompt():
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, if_save_html: bool = False, **kwargs):
         super().__init__(*args, **kwargs)
+        # save the rendered prompt and response as html next to the json results
+        self.if_save_html = if_save_html
 
     def _replace_keys(self, text: str, params: Dict):
         keys = params.keys()
@@ -29,76 +39,43 @@ class Prompt():
     def to_message(self, *args,
                    params: Dict = None,
                    template: Any = None,
+                   provider: Any = None,
                    **kwargs):
 
         assert params is not None, "params is None"
         assert template is not None, "template is None"
 
-        html = generate_prompt_html(params, template)
-
-        system_message = None
-        system_div_tag = html.find("div", class_="message", role="system")
-        if system_div_tag is not None:
-            p_tag = system_div_tag.find("p")
-            content = p_tag.text
-
-            content = content_replace(content)
-
-            message = {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": content
-                    }
-                ]
-            }
-            system_message = message
-
-        assert system_message is not None, "system_message is None"
+        compiled_template = compile_template(template)
+        messages = compiled_template.render(params)
 
-        user_messages = []
-        user_div_tags = html.find_all("div", class_="message", role="user")
+        # the provider downscales images as configured, a chart shared by several stages is encoded once
+        image_cache = getattr(provider, "image_cache", None) or IMAGE_CACHE
 
-        for user_div_tag in user_div_tags:
-            tags = user_div_tag.find_all(["p", "img"])
+        assert len(messages) > 0 and messages[0]["role"] == "system", "system_message is None"
 
-            message = {
-                "role": "user",
-                "content": []
-            }
+        for message in messages:
+            for index, content in enumerate(message["content"]):
+                if content["type"] != "image_path":
+                    continue
+                image_path = content["image_path"]
 
-            for tag in tags:
-
-                if tag.name == "p":
-                    content = tag.get_text(separator='\n')
-                    content = content_replace(content)
-                    message["content"].append({
+                if image_path is None or not os.path.exists(image_path):
+                    message["content"][index] = {
                         "type": "text",
-                        "text": content
-                    })
+                        "text": "There is no figure as it is trading initialised."
+                    }
+                else:
+                    message["content"][index] = {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_cache.get(image_path)
+                        }
+                    }
 
-                elif tag.name == "img":
-                    image_path = tag.attrs["src"]
+        assert len(messages) > 1, "user_messages is None"
 
-                    if image_path is None or not os.path.exists(image_path):
-                        message["content"].append({
-                            "type": "text",
-                            "text": "There is no figure as it is trading initialised."
-                        })
-                    else:
-                        image_base64 = encode_image(image_path)
-                        message["content"].append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        })
-            user_messages.append(message)
-
-        assert len(user_messages) > 0, "user_messages is None"
-
-        messages = [system_message] + user_messages
+        # the rendered html is only a debug artifact, building it parses the template again
+        html = generate_prompt_html(params, template) if self.if_save_html else None
 
         return messages, html
 
@@ -106,16 +83,59 @@ class Prompt():
                           provider,
                           model,
                           messages,
-                          check_keys=["decision", "reasoning"]):
-
-        response, info = provider.create_completion(messages, model=model)
+                          check_keys=["decision", "reasoning"],
+                          repair: bool = True,
+                          on_field: Callable[[str, Any], None] = None):
+
+        if on_field is not None and hasattr(provider, "create_completion_stream"):
+            # report every field of the response as soon as it is generated
+            response, info = provider.create_completion_stream(messages, model=model, on_field=on_field)
+        else:
+            response, info = provider.create_completion(messages, model=model)
         print("response from llm model {}: \ninfo: {}\nresponse: \n{}".format(model, info, response))
 
-        response_dict, soup = parse_semi_formatted_xml(response)
+        response_dict, diagnostics = parse_semi_formatted_xml(response)
+        if len(diagnostics) > 0:
+            print("response diagnostics: \n{}".format(format_diagnostics(diagnostics)))
+
+        missing_keys = [key for key in check_keys if key not in response_dict]
+        if len(missing_keys) > 0 and repair:
+            # ask only for the missing fields instead of generating the whole response again
+            repair_messages = messages + [
+                {
+                    "role": "assistant",
+                    "content": response
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": REPAIR_PROMPT.format(keys=", ".join(missing_keys),
+                                                         diagnostics=format_diagnostics(diagnostics))
+                        }
+                    ]
+                }
+            ]
+            repair_response, repair_info = provider.create_completion(repair_messages, model=model)
+            print("repair response from llm model {}: \ninfo: {}\nresponse: \n{}".format(model, repair_info, repair_response))
+
+            repair_dict, _ = parse_semi_formatted_xml(repair_response)
+            for key in missing_keys:
+                if key in repair_dict:
+                    response_dict[key] = repair_dict[key]
+                    if on_field is not None:
+                        on_field(key, repair_dict[key])
+            missing_keys = [key for key in check_keys if key not in response_dict]
 
         print("response_dict: \n{}\n".format(response_dict))
 
-        for key in check_keys:
-            if key not in response_dict:
-                raise KeyError(f"Key {key} not in response: {response_dict}")
-        return response_dict, soup
\ No newline at end of file
+        if len(missing_keys) > 0:
+            # do not replay an unusable response from the completion cache on retry
+            if hasattr(provider, "discard_completion"):
+                provider.discard_completion(messages, model=model)
+            raise KeyError(f"Keys {missing_keys} not in response: {response_dict}")
+
+        # the response as a document is only a debug artifact
+        res_html = BeautifulSoup(response, "html.parser") if self.if_save_html else None
+        return response_dict, res_html
\ No newline at end of file
@@ -1,5 +1,5 @@
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 from bs4 import BeautifulSoup,Tag
 import pandas as pd
 from copy import deepcopy
@@ -9,6 +9,7 @@ from finagent.provider import EmbeddingProvider
 from finagent.query import DiverseQuery, extract_query_type
 from finagent.tools import StrategyAgents
 from finagent.asset import ASSET
+from finagent.utils import fit_items, record_token_usage
 import os
 from pathlib import Path
 ROOT = str(Path(__file__).resolve().parents[2])
@@ -55,9 +56,7 @@ def content_replace(content: str):
         content = content.replace(key, maps[key])
     return content
 
-def generate_prompt_html(params: Dict[str, Any], template: str):
-    template = str2html(template)
-
+def inline_modules(template: BeautifulSoup) -> BeautifulSoup:
     # replace tags by iframe tags
     iframes = template.find_all("iframe")
     for iframe in iframes:
@@ -69,6 +68,11 @@ def generate_prompt_html(params: Dict[str, Any], template: str):
         new_iframe = ASSET.get_module(iframe_name)
         iframe.replace_with(new_iframe)
 
+    return template
+
+def generate_prompt_html(params: Dict[str, Any], template: str):
+    template = inline_modules(str2html(template))
+
     p_tags = template.find_all("p", class_="placeholder")
 
     for p_tag in p_tags:
@@ -94,6 +98,22 @@ def generate_prompt_html(params: Dict[str, Any], template: str):
 
     return template
 
+def fit_type_lists(type_lists: Dict[str, List[str]], budget: Optional[int] = None) -> Tuple[Dict[str, List[str]], Dict[str, Any]]:
+    """Fit the ranked items of every query type into one token budget, the query types in order."""
+    res = {}
+    total = {"budget": budget, "tokens": 0, "items": 0, "dropped": 0, "truncated": False}
+    for query_type, items in type_lists.items():
+        remaining = budget - total["tokens"] if budget is not None else None
+        if remaining is not None and remaining <= 0:
+            res[query_type] = []
+            total["dropped"] += len(items)
+            continue
+        _, res[query_type], usage = fit_items(items, budget=remaining, separator="\n\n")
+        for key in ["tokens", "items", "dropped"]:
+            total[key] += usage[key]
+        total["truncated"] = total["truncated"] or usage["truncated"]
+    return res, total
+
 def prepared_tools_params(state: Dict,
                           info: Dict,
                           params: Dict,
@@ -257,7 +277,7 @@ def prepare_latest_market_intelligence_params(state: Dict,
 
     latest_market_intelligence_query = params["latest_market_intelligence_query"]
 
-    query_res = {}
+    requests = []
     for query_type, quey_text in latest_market_intelligence_query.items():
 
         if len(quey_text) == 0 or len(quey_text.split(" ")) <= 5:
@@ -269,18 +289,20 @@ def prepare_latest_market_intelligence_params(state: Dict,
             "query_text": quey_text,
         }
 
-        query_type = extract_query_type(query_type)
-        query_items = diverse_query.query(params=query_params,
-                                          query_types=[query_type],
-                                          top_k=3)[query_type]["query_items"]
+        requests.append((query_params, extract_query_type(query_type)))
 
-        for item in query_items:
-            id = item["id"]
-            if id not in query_res:
-                query_res[id] = item
+    # one embedding call and one index search for all query types, only over the memories before today
+    results = diverse_query.batch_query(requests, top_k=3, end_date=info["date"])
 
-    query_res = sorted(query_res.items(), key=lambda x: x[0], reverse=False)
-    query_res = [item[1] for item in query_res]
+    # rank the items by their best rank in any query, the best items of every query first
+    query_res = {}
+    for rank in range(max([len(result["query_items"]) for result in results], default=0)):
+        for result in results:
+            if rank < len(result["query_items"]):
+                item = result["query_items"][rank]
+                if item["id"] not in query_res:
+                    query_res[item["id"]] = item
+    query_res = list(query_res.values())
 
     print(f"Number of queried past market intelligence: {len(query_res)}")
 
@@ -309,6 +331,14 @@ def prepare_latest_market_intelligence_params(state: Dict,
 
         past_market_intelligence_list.append(past_market_intelligence_query_item)
 
+    # keep the best ranked items that fit into the token budget, shown in the order of their ids
+    token_budgets = params.get("token_budgets", None) or {}
+    positions, past_market_intelligence_list, usage = fit_items(past_market_intelligence_list,
+                                                                budget=token_budgets.get("past_market_intelligence", None))
+    record_token_usage(res_params, "past_market_intelligence", usage)
+    past_market_intelligence_list = [item for _, item in sorted(zip([query_res[position]["id"] for position in positions],
+                                                                    past_market_intelligence_list))]
+
     if len(past_market_intelligence_list) == 0:
         past_market_intelligence_text = "There is no past market_intelligence.\n"
     else:
@@ -348,9 +378,10 @@ def prepare_low_level_reflection_params(state: Dict,
         "query_text": query_text,
     }
 
-    query_res = diverse_query.query(params=query_params, query_types=["plain"])
+    query_res = diverse_query.query(params=query_params, query_types=["plain"], end_date=info["date"])
 
     past_low_level_reflection_list = []
+    type_lists = {}
 
     for query_type, values in query_res.items():
         query_items = values["query_items"]
@@ -368,6 +399,13 @@ def prepare_low_level_reflection_params(state: Dict,
             type_text = f"Date: {item['date']}\nShort-Term reasoning: {past_low_level_short_term_reasoning_item}\nMedium-Term reasoning: {past_low_level_medium_term_reasoning_item}\nLong-Term reasoning: {past_low_level_long_term_reasoning_item}\n"
             type_list.append(type_text)
 
+        type_lists[query_type] = type_list
+
+    token_budgets = params.get("token_budgets", None) or {}
+    type_lists, usage = fit_type_lists(type_lists, budget=token_budgets.get("past_low_level_reflection", None))
+    record_token_usage(res_params, "past_low_level_reflection", usage)
+
+    for query_type, type_list in type_lists.items():
         if len(type_list) != 0:
             type_text = "\n\n".join(type_list)
             type_text = "The past low level reflection for " + query_type + " is:\n" + type_text
@@ -411,9 +449,10 @@ def prepare_high_level_reflection_params(state: Dict,
         "query_text": query_text,
     }
 
-    query_res = diverse_query.query(params=query_params, query_types=["plain"])
+    query_res = diverse_query.query(params=query_params, query_types=["plain"], end_date=info["date"])
 
     past_high_level_reflection_list = []
+    type_lists = {}
 
     for query_type, values in query_res.items():
         query_items = values["query_items"]
@@ -428,6 +467,13 @@ def prepare_high_level_reflection_params(state: Dict,
             type_text = f"Date: {item['date']}\nReasoning: {past_high_level_reasoning_item}\nImprovement: {past_high_level_improvement_item}\nSummary: {past_high_level_summary_item}\n"
             type_list.append(type_text)
 
+        type_lists[query_type] = type_list
+
+    token_budgets = params.get("token_budgets", None) or {}
+    type_lists, usage = fit_type_lists(type_lists, budget=token_budgets.get("past_high_level_reflection", None))
+    record_token_usage(res_params, "past_high_level_reflection", usage)
+
+    for query_type, type_list in type_lists.items():
         if len(type_list) != 0:
             type_text = "\n\n".join(type_list)
             type_text = "The past high level reflection for " + query_type + " is:\n" + type_text
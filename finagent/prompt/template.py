@@ -0,0 +1,124 @@
+"""Prompt templates compiled once into flat segments, rendering the messages of a call is string concatenation."""
+import json
+import re
+from functools import lru_cache
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Union,
+)
+
+from bs4 import Tag
+
+from finagent.prompt.helper import str2html, inline_modules, content_replace
+
+PLACEHOLDER_PATTERN = re.compile(r"\$\$(\w+)\$\$")
+
+def value_to_text(value: Any) -> str:
+    if isinstance(value, list) or isinstance(value, dict):
+        return json.dumps(value, indent=4)
+    return str(value)
+
+
+class CompiledParagraph():
+    """A <p> of a template, literals alternating with the names of the params filled in between them.
+
+    Rendering matches generate_prompt_html followed by reading the text of the
+    tag with separator: a placeholder paragraph whose params include a None is
+    left unfilled, and a $$name$$ missing from the params is kept as it is.
+    """
+
+    def __init__(self, tag: Tag, separator: str) -> None:
+        self.separator = separator
+        self.fallback = content_replace(tag.get_text(separator=separator))
+
+        self.placeholder = "placeholder" in tag.get("class", [])
+        pieces = PLACEHOLDER_PATTERN.split(tag.text)
+        self.literals = pieces[0::2]
+        self.keys = pieces[1::2]
+
+    def render(self, params: Dict[str, Any]) -> str:
+        if not self.placeholder:
+            return self.fallback
+
+        values = []
+        for key in self.keys:
+            if key not in params:
+                values.append(f"$${key}$$")
+                continue
+            value = params[key]
+            if value is None:
+                return self.fallback
+            values.append(value_to_text(value))
+
+        pieces = [self.literals[0]]
+        for value, literal in zip(values, self.literals[1:]):
+            pieces.append(value)
+            pieces.append(literal)
+        text = "".join(pieces)
+
+        # every line of a filled paragraph becomes its own string of the tag
+        if self.separator != "\n":
+            text = self.separator.join(text.split("\n"))
+        return content_replace(text)
+
+
+class CompiledImage():
+    def __init__(self, tag: Tag) -> None:
+        self.key = tag["src"].replace("$$", "")
+
+    def render(self, params: Dict[str, Any]) -> Optional[str]:
+        return params[self.key]
+
+
+class CompiledTemplate():
+    """A message template parsed once, with its iframe modules inlined.
+
+    render returns the messages of Prompt.to_message, except that an image
+    is a {"type": "image_path", "image_path": ...} part, which the prompt
+    encodes.
+    """
+
+    def __init__(self, template: str) -> None:
+        html = inline_modules(str2html(template))
+
+        self.system = None
+        system_div_tag = html.find("div", class_="message", role="system")
+        if system_div_tag is not None and system_div_tag.find("p") is not None:
+            self.system = CompiledParagraph(system_div_tag.find("p"), separator="")
+
+        self.users: List[List[Union[CompiledParagraph, CompiledImage]]] = []
+        for user_div_tag in html.find_all("div", class_="message", role="user"):
+            parts = []
+            for tag in user_div_tag.find_all(["p", "img"]):
+                if tag.name == "p":
+                    parts.append(CompiledParagraph(tag, separator="\n"))
+                else:
+                    parts.append(CompiledImage(tag))
+            self.users.append(parts)
+
+    def render(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        messages = []
+        if self.system is not None:
+            messages.append({
+                "role": "system",
+                "content": [{"type": "text", "text": self.system.render(params)}],
+            })
+
+        for parts in self.users:
+            content = []
+            for part in parts:
+                if isinstance(part, CompiledParagraph):
+                    content.append({"type": "text", "text": part.render(params)})
+                else:
+                    content.append({"type": "image_path", "image_path": part.render(params)})
+            messages.append({"role": "user", "content": content})
+        return messages
+
+
+@lru_cache(maxsize=None)
+def compile_template(template: str) -> CompiledTemplate:
+    """The compiled template of the text of a template file, every template is compiled once per process."""
+    return CompiledTemplate(template)
@@ -1,5 +1,5 @@
 import os
-from typing import Dict, List, Any
+from typing import Any, Callable, Dict, List
 import pandas as pd
 from copy import deepcopy
 import backoff
@@ -11,14 +11,18 @@ from finagent.provider import EmbeddingProvider
 from finagent.utils import init_path, save_html, save_json, load_json
 from finagent.query import DiverseQuery
 
+def clean_action(action: str) -> str:
+    return action.replace(" ", "").replace("\n", "").replace("\t", "").replace("\r", "")
+
 @PROMPT.register_module(force=True)
 class DecisionTrading(Prompt):
     def __init__(self,
                  *args,
                  model: Any = None,
+                 if_save_html: bool = False,
                  **kwargs):
         self.model = model
-        super(DecisionTrading, self).__init__()
+        super(DecisionTrading, self).__init__(if_save_html=if_save_html)
 
     def convert_to_params(self,
                          state: Dict,
@@ -65,7 +69,7 @@ class DecisionTrading(Prompt):
         return res_params
 
     @backoff.on_exception(backoff.constant, (KeyError), max_tries=3, interval=10)
-    def get_response_dict(self, provider, model, messages, check_keys: List[str] = None):
+    def get_response_dict(self, provider, model, messages, check_keys: List[str] = None, on_field: Callable = None):
 
         check_keys = [
             "action",
@@ -75,8 +79,9 @@ class DecisionTrading(Prompt):
         response_dict, res_html = super(DecisionTrading, self).get_response_dict(provider = provider,
                                                                        messages = messages,
                                                                        model = model,
-                                                                       check_keys=check_keys)
-        response_dict["action"] = response_dict["action"].replace(" ", "").replace("\n", "").replace("\t", "").replace("\r", "")
+                                                                       check_keys=check_keys,
+                                                                       on_field=on_field)
+        response_dict["action"] = clean_action(response_dict["action"])
 
         return response_dict, res_html
 
@@ -91,7 +96,15 @@ class DecisionTrading(Prompt):
             exp_path: str = None,
             save_dir: str = None,
             call_provider: bool = True,
+            on_action: Callable[[str], None] = None,
             **kwargs):
+        """Run the decision prompt.
+
+        If on_action is given, the response is streamed and on_action(action) is
+        called as soon as the action is generated, before the reasoning. The
+        action reported this way is the action of the decision, even if a retry
+        generates a different one.
+        """
 
         print(">" * 50 + f"{info['date']} - Running Decision Trading Prompt" + ">" * 50)
 
@@ -107,16 +120,33 @@ class DecisionTrading(Prompt):
                                                    memory=memory,
                                                    provider=provider,
                                                    diverse_query=diverse_query)
-            message, html = self.to_message(params=task_params, template=template)
+            message, html = self.to_message(params=task_params, template=template, provider=provider)
+            early_action = {}
+
+            def on_field(name, value):
+                if name == "action" and "action" not in early_action:
+                    early_action["action"] = clean_action(value)
+                    on_action(early_action["action"])
+
             response_dict, res_html = self.get_response_dict(provider = provider,
                                                             model = self.model,
-                                                            messages = message)
+                                                            messages = message,
+                                                            on_field=on_field if on_action is not None else None)
+            if "action" in early_action and response_dict["action"] != early_action["action"]:
+                print(f"Keep the action {early_action['action']} reported early instead of {response_dict['action']}")
+                response_dict["action"] = early_action["action"]
+                # the cached response holds the other action, replaying it would not repeat this run
+                if hasattr(provider, "discard_completion"):
+                    provider.discard_completion(message, model=self.model)
 
             reasoning = response_dict["reasoning"]
             action = response_dict["action"]
 
-            html = html.prettify()
-            res_html = res_html.prettify()
+            if self.if_save_html:
+                html = html.prettify()
+                res_html = res_html.prettify()
+            else:
+                html, res_html = None, None
 
             res = {
                 "params": params,
@@ -143,8 +173,9 @@ class DecisionTrading(Prompt):
             "decision_action": action,
         })
 
-        save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
-        save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
+        if self.if_save_html and html is not None:
+            save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
+            save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
         save_json(res, os.path.join(res_json_path, f"res_{info['date']}.json"))
 
         print("<" * 50 + f"{info['date']} - Finish Running Decision Trading Prompt" + "<" * 50)
@@ -16,11 +16,12 @@ class HighLevelReflectionTrading(Prompt):
     def __init__(self,
                  *args,
                  model: Any = None,
+                 if_save_html: bool = False,
                  previous_action_look_back_days: int = 14,
                  **kwargs):
         self.model = model
         self.previous_action_look_back_days = previous_action_look_back_days
-        super(HighLevelReflectionTrading, self).__init__()
+        super(HighLevelReflectionTrading, self).__init__(if_save_html=if_save_html)
 
     def convert_to_params(self,
                          state: Dict,
@@ -132,7 +133,7 @@ class HighLevelReflectionTrading(Prompt):
                                                    memory=memory,
                                                    provider=provider,
                                                    diverse_query=diverse_query)
-            message, html = self.to_message(params=task_params, template=template)
+            message, html = self.to_message(params=task_params, template=template, provider=provider)
             response_dict, res_html = self.get_response_dict(provider=provider,
                                                    model=self.model,
                                                    messages=message)
@@ -142,8 +143,11 @@ class HighLevelReflectionTrading(Prompt):
             summary = response_dict["summary"]
             query = response_dict["query"]
 
-            html = html.prettify()
-            res_html = res_html.prettify()
+            if self.if_save_html:
+                html = html.prettify()
+                res_html = res_html.prettify()
+            else:
+                html, res_html = None, None
 
             res = {
                 "params": task_params,
@@ -174,8 +178,9 @@ class HighLevelReflectionTrading(Prompt):
             "high_level_query": query,
         })
 
-        save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
-        save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
+        if self.if_save_html and html is not None:
+            save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
+            save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
         save_json(res, os.path.join(res_json_path, f"res_{info['date']}.json"))
 
         print("<" * 50 + f"{info['date']} - Finish Running High Level Reflection Trading Prompt" + "<" * 50)
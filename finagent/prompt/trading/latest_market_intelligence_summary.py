@@ -13,15 +13,21 @@ from finagent.query import DiverseQuery
 from finagent.utils import init_path
 from finagent.utils import save_html
 from finagent.utils import save_json, load_json
+from finagent.utils import collapse_near_duplicates
+from finagent.utils import fit_items, record_token_usage
 
 @PROMPT.register_module(force=True)
 class LatestMarketIntelligenceSummaryTrading(Prompt):
     def __init__(self,
                  *args,
                  model: Any = None,
+                 if_save_html: bool = False,
+                 near_duplicate_params: Dict = None,
                  **kwargs):
         self.model = model
-        super(LatestMarketIntelligenceSummaryTrading, self).__init__()
+        # keyword arguments of collapse_near_duplicates for the news of a day, None keeps every story
+        self.near_duplicate_params = near_duplicate_params
+        super(LatestMarketIntelligenceSummaryTrading, self).__init__(if_save_html=if_save_html)
 
     def convert_to_params(self,
                             state: Dict,
@@ -49,9 +55,6 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
         price = price[price.index == current_date]
         news = news[news.index == current_date]
 
-        if len(news) > 20:
-            news = news.sample(n=20)
-
         latest_market_intelligence_text = f"Date: Today is {current_date}.\n"
 
         if len(price) > 0:
@@ -67,7 +70,12 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
         if len(news) == 0:
             latest_market_intelligence_text = "There is no latest market_intelligence.\n"
         else:
+            # the stories reported by the most sources first, in their original order otherwise
+            if "source_count" in news.columns:
+                news = news.sort_values(by="source_count", ascending=False, kind="stable")
+
             latest_market_intelligence_list = []
+            ids = []
 
             for row in news.iterrows():
                 row = row[1]
@@ -80,6 +88,17 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
                                                   f"Content: {text}\n"
 
                 latest_market_intelligence_list.append(latest_market_intelligence_item)
+                ids.append(id)
+
+            # keep the best ranked news that fit into the token budget, instead of a random sample of 20
+            token_budgets = params.get("token_budgets", None) or {}
+            positions, latest_market_intelligence_list, usage = fit_items(latest_market_intelligence_list,
+                                                                          budget=token_budgets.get("latest_market_intelligence", None),
+                                                                          max_items=20,
+                                                                          model=self.model)
+            record_token_usage(res_params, "latest_market_intelligence", usage)
+            latest_market_intelligence_list = [item for _, item in sorted(zip([ids[position] for position in positions],
+                                                                              latest_market_intelligence_list))]
 
             if len(latest_market_intelligence_list) == 0:
                 latest_market_intelligence_text = "There is no latest market_intelligence.\n"
@@ -137,6 +156,9 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
 
         price = price[price.index == current_date]
         news = news[news.index == current_date]
+        # syndicated copies of a story are embedded and stored once
+        if self.near_duplicate_params is not None:
+            news = collapse_near_duplicates(news, timestamp_column=None, **self.near_duplicate_params)
 
         if len(price) > 0:
             open = price["open"].values[0]
@@ -151,6 +173,8 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
             close = math.nan
             adj_close = math.nan
 
+        datas = []
+        embedding_texts = []
         for row in news.iterrows():
             date = row[0] if isinstance(row[0], str) else row[0].strftime("%Y-%m-%d")
             row = row[1]
@@ -158,17 +182,17 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
             id = row["id"]
             title = row["title"]
             text = row["text"]
+            source_count = int(row["source_count"])
 
             embedding_text = f"Heading: {title}\n" + \
                              f"Content: {text}\n"
 
-            embedding = provider.embed_query(embedding_text)
-
             data = {
                 "date": date,
                 "id": id,
                 "title": title,
                 "text": text,
+                "source_count": source_count,
                 "open": open,
                 "high": high,
                 "low": low,
@@ -177,13 +201,23 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
                 "query": response_dict["query"],
                 "summary": response_dict["summary"],
                 "embedding_text": embedding_text,
-                "embedding": embedding,
             }
 
-            memory.add_memory(type="market_intelligence",
-                              symbol=stock_symbol,
-                              data=data,
-                              embedding_key="embedding")
+            datas.append(data)
+            embedding_texts.append(embedding_text)
+
+        if len(datas) == 0:
+            return
+
+        # embed all of today's news in one request and insert them in one batch
+        embeddings = provider.embed_documents(embedding_texts)
+        for data, embedding in zip(datas, embeddings):
+            data["embedding"] = embedding
+
+        memory.add_memories(type="market_intelligence",
+                            symbol=stock_symbol,
+                            datas=datas,
+                            embedding_key="embedding")
 
     def run(self,
             state: Dict,
@@ -212,7 +246,7 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
                                                  memory=memory,
                                                  provider=provider,
                                                  diverse_query=diverse_query)
-            message, html = self.to_message(params=task_params, template=template)
+            message, html = self.to_message(params=task_params, template=template, provider=provider)
             response_dict, res_html = self.get_response_dict(provider = provider,
                                                           model=self.model,
                                                           messages=message)
@@ -220,8 +254,11 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
             query = response_dict["query"]
             summary = response_dict["summary"]
 
-            html = html.prettify()
-            res_html = res_html.prettify()
+            if self.if_save_html:
+                html = html.prettify()
+                res_html = res_html.prettify()
+            else:
+                html, res_html = None, None
 
             res = {
                 "params": task_params,
@@ -249,8 +286,9 @@ class LatestMarketIntelligenceSummaryTrading(Prompt):
             "latest_market_intelligence_summary": summary,
         })
 
-        save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
-        save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
+        if self.if_save_html and html is not None:
+            save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
+            save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
         save_json(res, os.path.join(res_json_path, f"res_{info['date']}.json"))
 
         print("<" * 50 + f"{info['date']} - Finish Running Latest Market Intelligence Summary Trading Prompt" + "<" * 50)
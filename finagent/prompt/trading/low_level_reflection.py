@@ -16,6 +16,7 @@ class LowLevelReflectionTrading(Prompt):
     def __init__(self,
                  *args,
                  model: Any = None,
+                 if_save_html: bool = False,
                  short_term_past_date_range: int = 1,
                  medium_term_past_date_range: int = 7,
                  long_term_past_date_range: int = 14,
@@ -36,7 +37,7 @@ class LowLevelReflectionTrading(Prompt):
         self.look_back_days = look_back_days
         self.look_forward_days = look_forward_days
 
-        super(LowLevelReflectionTrading, self).__init__()
+        super(LowLevelReflectionTrading, self).__init__(if_save_html=if_save_html)
 
     def _convert_to_price_movement(self, state: Dict, current_date: str = None):
 
@@ -180,7 +181,7 @@ class LowLevelReflectionTrading(Prompt):
                                                  memory=memory,
                                                  provider=provider,
                                                  diverse_query=diverse_query,)
-            message, html = self.to_message(params=task_params, template=template)
+            message, html = self.to_message(params=task_params, template=template, provider=provider)
             response_dict, res_html = self.get_response_dict(provider = provider,
                                                    model = self.model,
                                                    messages = message)
@@ -188,8 +189,11 @@ class LowLevelReflectionTrading(Prompt):
             reasoning = response_dict["reasoning"]
             query = response_dict["query"]
 
-            html = html.prettify()
-            res_html = res_html.prettify()
+            if self.if_save_html:
+                html = html.prettify()
+                res_html = res_html.prettify()
+            else:
+                html, res_html = None, None
 
             res = {
                 "params": task_params,
@@ -215,8 +219,9 @@ class LowLevelReflectionTrading(Prompt):
             "low_level_reflection_query": query,
         })
 
-        save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
-        save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
+        if self.if_save_html and html is not None:
+            save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
+            save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
         save_json(res, os.path.join(res_json_path, f"res_{info['date']}.json"))
 
         print("<" * 50 + f"{info['date']} - Finish Running Low Level Reflection Trading Prompt" + "<" * 50)
@@ -19,9 +19,10 @@ class PastMarketIntelligenceSummaryTrading(Prompt):
     def __init__(self,
                  *args,
                  model: Any = None,
+                 if_save_html: bool = False,
                  **kwargs):
         self.model = model
-        super(PastMarketIntelligenceSummaryTrading, self).__init__()
+        super(PastMarketIntelligenceSummaryTrading, self).__init__(if_save_html=if_save_html)
     def convert_to_params(self,
                             state: Dict,
                             info: Dict,
@@ -86,15 +87,18 @@ class PastMarketIntelligenceSummaryTrading(Prompt):
                                                  provider=provider,
                                                  diverse_query=diverse_query,
                                                  )
-            message, html = self.to_message(params=task_params, template=template)
+            message, html = self.to_message(params=task_params, template=template, provider=provider)
             response_dict, res_html = self.get_response_dict(provider = provider,
                                                         model = self.model,
                                                         messages = message)
 
             summary = response_dict["summary"]
 
-            html = html.prettify()
-            res_html = res_html.prettify()
+            if self.if_save_html:
+                html = html.prettify()
+                res_html = res_html.prettify()
+            else:
+                html, res_html = None, None
 
             res = {
                 "params": params,
@@ -119,8 +123,9 @@ class PastMarketIntelligenceSummaryTrading(Prompt):
             "past_market_intelligence_summary": summary,
         })
 
-        save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
-        save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
+        if self.if_save_html and html is not None:
+            save_html(html, os.path.join(html_path, f"prompt_{info['date']}.html"))
+            save_html(res_html, os.path.join(html_path, f"res_{info['date']}.html"))
         save_json(res, os.path.join(res_json_path, f"res_{info['date']}.json"))
 
         print("<" * 50 + f"{info['date']} - Finish Running Past Market Intelligence Summary Trading Prompt" + "<" * 50)
@@ -1,9 +1,15 @@
 from .base_embedding import EmbeddingProvider
 from .base_llm import LLMProvider
+from .cache import EmbeddingCache, CompletionCache, ImagePayloadCache
+from .rate_limit import RateLimiter
 from .provider import OpenAIProvider
 
 __all__ = [
     "LLMProvider",
     "EmbeddingProvider",
     "OpenAIProvider",
+    "EmbeddingCache",
+    "CompletionCache",
+    "ImagePayloadCache",
+    "RateLimiter",
 ]
@@ -12,6 +12,10 @@ class EmbeddingProvider(abc.ABC):
     def embed_query(self, text: str) -> List[float]:
         """Embed query text."""
 
+    @abc.abstractmethod
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch of texts in as few requests as possible."""
+
     @abc.abstractmethod
     def get_embedding_dim(self) -> int:
         """Get the embedding dimensions."""
@@ -0,0 +1,312 @@
+"""Persistent, content-addressed caches for provider calls."""
+import os
+import io
+import json
+import base64
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
+
+
+def hash_text(model: str, text: str) -> str:
+    """Return the cache key of a (model, text) pair."""
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache():
+    """On-disk embedding cache keyed by (model, text hash).
+
+    Vectors are stored as float32 blobs in a SQLite file with an in-process
+    LRU in front of it, so repeated texts never reach the embedding endpoint.
+    """
+
+    def __init__(self,
+                 cache_path: str,
+                 max_size: int = 100000) -> None:
+        """Initialize the cache.
+
+        Args:
+            cache_path: Path of the SQLite file.
+            max_size: Maximum number of vectors kept in the in-process LRU.
+        """
+        self.cache_path = cache_path
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _lru_put(self, key: str, vector: List[float]) -> None:
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Look up the embeddings of texts, None for every miss."""
+        keys = [hash_text(model, text) for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+
+        with self._lock:
+            missing: Dict[str, List[int]] = {}
+            for i, key in enumerate(keys):
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    results[i] = self._lru[key]
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if len(missing) > 0:
+                missing_keys = list(missing.keys())
+                # stay below the default SQLite host parameter limit
+                for j in range(0, len(missing_keys), 500):
+                    chunk = missing_keys[j: j + 500]
+                    rows = self._conn.execute(
+                        "SELECT key, vector FROM embeddings WHERE key IN ({})".format(",".join("?" * len(chunk))),
+                        chunk,
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                        self._lru_put(key, vector)
+                        for i in missing[key]:
+                            results[i] = vector
+
+            hits = sum(1 for result in results if result is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        return results
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]) -> None:
+        """Store the embeddings of texts."""
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = hash_text(model, text)
+                self._lru_put(key, list(embedding))
+                rows.append((key, model, np.asarray(embedding, dtype=np.float32).tobytes()))
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        """Return the hit/miss counters of this process."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits / total) if total > 0 else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def hash_request(**kwargs: Any) -> str:
+    """Return the cache key of a completion request."""
+    request = json.dumps(kwargs, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+class CompletionCache():
+    """Deterministic LLM completion cache backed by an append-only log.
+
+    Every completion is appended to a JSONL file as one record keyed by the
+    hash of the request. Discarded entries are appended as tombstones, so the
+    log is never rewritten and replaying it gives the latest state.
+
+    Modes:
+        read_write: return cached completions and store new ones.
+        replay: only return cached completions, a miss raises an error.
+    """
+
+    MODES = ["read_write", "replay"]
+
+    def __init__(self,
+                 cache_path: str,
+                 mode: str = "read_write") -> None:
+        """Initialize the cache.
+
+        Args:
+            cache_path: Path of the JSONL log.
+            mode: One of CompletionCache.MODES.
+        """
+        assert mode in self.MODES, f"mode = {mode} should be one of {self.MODES}."
+
+        self.cache_path = cache_path
+        self.mode = mode
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: Dict[str, Tuple[str, Dict[str, int]]] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a partially written last line from an interrupted run
+                    continue
+                if record.get("deleted", False):
+                    self._entries.pop(record["key"], None)
+                else:
+                    self._entries[record["key"]] = (record["message"], record["info"])
+
+    def _append(self, record: Dict) -> None:
+        with open(self.cache_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, int]]]:
+        """Look up a completion, None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None and self.mode == "replay":
+            raise RuntimeError(f"Completion {key} is not cached and the completion cache is in replay mode.")
+        return entry
+
+    def put(self, key: str, message: str, info: Dict[str, int]) -> None:
+        """Store a completion."""
+        with self._lock:
+            self._entries[key] = (message, info)
+            self._append({"key": key, "message": message, "info": info})
+
+    def discard(self, key: str) -> None:
+        """Drop a completion, e.g. when it could not be parsed."""
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+                self._append({"key": key, "deleted": True})
+
+    def stats(self) -> Dict[str, float]:
+        """Return the hit/miss counters of this process."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits / total) if total > 0 else 0.0,
+        }
+
+
+class ImagePayloadCache():
+    """In-process cache of the base64 data urls of the images sent to a vision model.
+
+    The same chart is embedded by several stages of a trading step, so an
+    image is read and encoded once and reused while its file is unchanged;
+    the key is the path with the mtime and size of the file. Only a few
+    images are kept, those of the current step.
+
+    If max_pixels or jpeg_quality is set, an image is re-encoded as JPEG, after
+    being downscaled to at most max_pixels pixels, which lowers both the vision
+    tokens and the request size. Otherwise the file is sent as it is.
+    """
+
+    def __init__(self,
+                 max_pixels: Optional[int] = None,
+                 jpeg_quality: Optional[int] = None,
+                 max_size: int = 16) -> None:
+        """Initialize the cache.
+
+        Args:
+            max_pixels: Maximum width * height of a sent image, None keeps the size.
+            jpeg_quality: JPEG quality of re-encoded images, 85 if only max_pixels is set.
+            max_size: Maximum number of payloads kept.
+        """
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _encode(self, image_path: str) -> str:
+        if self.max_pixels is None and self.jpeg_quality is None:
+            with open(image_path, "rb") as image_file:
+                data = image_file.read()
+            return "data:image/jpeg;base64," + base64.b64encode(data).decode("utf-8")
+
+        from PIL import Image
+
+        with Image.open(image_path) as image:
+            image = image.convert("RGB")
+            width, height = image.size
+            if self.max_pixels is not None and width * height > self.max_pixels:
+                scale = (self.max_pixels / (width * height)) ** 0.5
+                size = (max(int(width * scale), 1), max(int(height * scale), 1))
+                image = image.resize(size, Image.LANCZOS)
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=self.jpeg_quality or 85, optimize=True)
+        return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+    def get(self, image_path: str) -> str:
+        """Return the data url of the image at image_path."""
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return self._lru[key]
+
+        url = self._encode(image_path)
+
+        with self._lock:
+            self.misses += 1
+            self._lru[key] = url
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+        return url
+
+    def stats(self) -> Dict[str, float]:
+        """Return the hit/miss counters of this process."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits / total) if total > 0 else 0.0,
+        }
@@ -2,6 +2,7 @@ import os
 import base64
 from typing import (
     Any,
+    Callable,
     Dict,
     List,
     Literal,
@@ -18,8 +19,10 @@ import numpy as np
 from openai import OpenAI, AzureOpenAI, APIError, RateLimitError, BadRequestError, APITimeoutError
 
 from finagent.provider import LLMProvider, EmbeddingProvider
+from finagent.provider.cache import EmbeddingCache, CompletionCache, ImagePayloadCache, hash_request
+from finagent.provider.rate_limit import RateLimiter
 from finagent.registry import PROVIDER
-from finagent.utils import assemble_project_path, load_json
+from finagent.utils import assemble_project_path, load_json, get_encoding, count_tokens, StructuredResponseParser
 
 MAX_TOKENS = {
     "gpt-3.5-turbo-0301": 4097,
@@ -34,6 +37,15 @@ PROVIDER_SETTING_IS_AZURE = "is_azure"
 PROVIDER_SETTING_BASE_VAR = "base_var"       # Azure-speficic setting
 PROVIDER_SETTING_API_VERSION = "api_version" # Azure-speficic setting
 PROVIDER_SETTING_DEPLOYMENT_MAP = "models"   # Azure-speficic setting
+PROVIDER_SETTING_EMB_CACHE_PATH = "emb_cache_path" # Optional, on-disk embedding cache
+PROVIDER_SETTING_EMB_CACHE_SIZE = "emb_cache_size" # Optional, in-process LRU size
+PROVIDER_SETTING_COMP_CACHE_PATH = "comp_cache_path" # Optional, append-only completion log
+PROVIDER_SETTING_COMP_CACHE_MODE = "comp_cache_mode" # Optional, "read_write" or "replay"
+PROVIDER_SETTING_MAX_CONCURRENCY = "max_concurrency" # Optional, max in-flight requests
+PROVIDER_SETTING_REQUESTS_PER_MINUTE = "requests_per_minute" # Optional, request rate limit
+PROVIDER_SETTING_IMAGE_MAX_PIXELS = "image_max_pixels" # Optional, downscale sent images to this many pixels
+PROVIDER_SETTING_IMAGE_JPEG_QUALITY = "image_jpeg_quality" # Optional, re-encode sent images as JPEG
+# the image settings change the bytes of every vision prompt, so completions cached without them are not found
 
 @PROVIDER.register_module(force=True)
 class OpenAIProvider(LLMProvider, EmbeddingProvider):
@@ -53,6 +65,11 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
     """Whether to skip empty strings when embedding or raise an error."""
     skip_empty: bool = False
 
+    embedding_cache: Optional[EmbeddingCache] = None
+    completion_cache: Optional[CompletionCache] = None
+    rate_limiter: RateLimiter = RateLimiter()
+    image_cache: ImagePayloadCache = ImagePayloadCache()
+
 
     def __init__(self, provider_cfg_path) -> None:
         """Initialize a class instance
@@ -100,10 +117,30 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
         self.embedding_model = conf_dict[PROVIDER_SETTING_EMB_MODEL]
         self.llm_model = conf_dict[PROVIDER_SETTING_COMP_MODEL]
 
-        try:
-            self.encoding = tiktoken.encoding_for_model(self.llm_model)
-        except KeyError:
-            self.encoding = tiktoken.get_encoding("cl100k_base")
+        # the client and the limiter are shared by every thread using this provider
+        self.rate_limiter = RateLimiter(
+            max_concurrency=conf_dict.get(PROVIDER_SETTING_MAX_CONCURRENCY, None),
+            requests_per_minute=conf_dict.get(PROVIDER_SETTING_REQUESTS_PER_MINUTE, None),
+        )
+
+        self.image_cache = ImagePayloadCache(
+            max_pixels=conf_dict.get(PROVIDER_SETTING_IMAGE_MAX_PIXELS, None),
+            jpeg_quality=conf_dict.get(PROVIDER_SETTING_IMAGE_JPEG_QUALITY, None),
+        )
+
+        if conf_dict.get(PROVIDER_SETTING_EMB_CACHE_PATH, None) is not None:
+            self.embedding_cache = EmbeddingCache(
+                cache_path=assemble_project_path(conf_dict[PROVIDER_SETTING_EMB_CACHE_PATH]),
+                max_size=conf_dict.get(PROVIDER_SETTING_EMB_CACHE_SIZE, 100000),
+            )
+
+        if conf_dict.get(PROVIDER_SETTING_COMP_CACHE_PATH, None) is not None:
+            self.completion_cache = CompletionCache(
+                cache_path=assemble_project_path(conf_dict[PROVIDER_SETTING_COMP_CACHE_PATH]),
+                mode=conf_dict.get(PROVIDER_SETTING_COMP_CACHE_MODE, "read_write"),
+            )
+
+        self.encoding = get_encoding(self.llm_model)
 
         return conf_dict
 
@@ -138,7 +175,12 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
             jitter=None,
         )
         def _embed_with_retry(**kwargs: Any) -> Any:
-            response = self.client.embeddings.create(**kwargs)
+            try:
+                with self.rate_limiter:
+                    response = self.client.embeddings.create(**kwargs)
+            except RateLimitError:
+                self.rate_limiter.backoff(10)
+                raise
             if any(len(d.embedding) == 1 for d in response.data):
                 raise RuntimeError("OpenAI API returned an empty embedding")
             return response
@@ -225,7 +267,21 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
         """
         # NOTE: to keep things simple, we assume the list may contain texts longer
         #       than the maximum context and use length-safe embedding function.
-        return self._get_len_safe_embeddings(texts)
+        if self.embedding_cache is None:
+            return self._get_len_safe_embeddings(texts)
+
+        embeddings = self.embedding_cache.get_many(self.embedding_model, texts)
+
+        # only embed the unique texts that are not cached yet
+        missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        if len(missing_texts) > 0:
+            missing_embeddings = self._get_len_safe_embeddings(missing_texts)
+            self.embedding_cache.put_many(self.embedding_model, missing_texts, missing_embeddings)
+            missing_map = dict(zip(missing_texts, missing_embeddings))
+            embeddings = [missing_map[text] if embedding is None else embedding
+                          for text, embedding in zip(texts, embeddings)]
+
+        return embeddings
 
 
     def embed_query(self, text: str) -> List[float]:
@@ -240,6 +296,12 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
         return self.embed_documents([text])[0]
 
 
+    def get_embedding_cache_stats(self) -> Dict[str, float]:
+        """Get the hit/miss counters of the embedding cache."""
+        if self.embedding_cache is None:
+            return {}
+        return self.embedding_cache.stats()
+
     def get_embedding_dim(self) -> int:
         """Get the embedding dimension."""
         if self.embedding_model == "text-embedding-ada-002":
@@ -290,11 +352,60 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
         )
         """
 
+        return self._complete(messages, model, temperature, seed, max_tokens)
+
+    def create_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str | None = None,
+        temperature: float = 1.0,
+        seed: int | None = 42,
+        max_tokens: int = 4096,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+    ) -> Tuple[str, Dict[str, int]]:
+        """Create a chat completion like create_completion, parsing the <output> response while it is generated.
+
+        on_field(name, value) is called as soon as a top level field of the
+        response is closed, e.g. the action of a decision before its reasoning
+        is generated. Every field is reported at most once, also if the request
+        is retried, so a reported value may differ from the returned response.
+        A cached completion reports all of its fields at once.
+        """
+        return self._complete(messages, model, temperature, seed, max_tokens, stream=True, on_field=on_field)
+
+    def _complete(
+        self,
+        messages: List[Dict[str, str]],
+        model: str | None,
+        temperature: float,
+        seed: int | None,
+        max_tokens: int,
+        stream: bool = False,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+    ) -> Tuple[str, Dict[str, int]]:
+        """Look a completion up in the completion cache, or request it from the API and cache it."""
+
         if model is None:
             model = self.llm_model
 
         # print(f"Creating chat completion with model {model}, temperature {temperature}, max_tokens {max_tokens}")
 
+        reported = set()
+
+        def feed(parser: StructuredResponseParser, text: str) -> None:
+            for name in parser.feed(text):
+                if on_field is not None and name not in reported:
+                    reported.add(name)
+                    on_field(name, parser.fields[name])
+
+        if self.completion_cache is not None:
+            cache_key = self._completion_cache_key(messages, model, temperature, seed, max_tokens)
+            cached = self.completion_cache.get(cache_key)
+            if cached is not None:
+                if stream:
+                    feed(StructuredResponseParser(), cached[0])
+                return cached
+
         @backoff.on_exception(
             backoff.constant,
             (
@@ -312,36 +423,64 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
             max_tokens: int = 512,
         ) -> Tuple[str, Dict[str, int]]:
             
-            """Send a request to the OpenAI API."""
-
+            """Send a request to the OpenAI API, streamed if stream is set."""
+
+            request = dict(model=model,
+                           messages=messages,
+                           temperature=temperature,
+                           seed=seed,
+                           max_tokens=max_tokens,)
+            if stream:
+                request.update(stream=True, stream_options={"include_usage": True})
             if self.provider_cfg[PROVIDER_SETTING_IS_AZURE]:
-                response = self.client.chat.completions.create(deployment_id=self.get_azure_deployment_id_for_model(model),
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                seed=seed,
-                max_tokens=max_tokens,)
+                request["deployment_id"] = self.get_azure_deployment_id_for_model(model)
+
+            try:
+                with self.rate_limiter:
+                    response = self.client.chat.completions.create(**request)
+
+                    if stream:
+                        parser = StructuredResponseParser()
+                        pieces = []
+                        usage = None
+                        for chunk in response:
+                            if getattr(chunk, "usage", None) is not None:
+                                usage = chunk.usage
+                            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                                piece = chunk.choices[0].delta.content
+                                pieces.append(piece)
+                                feed(parser, piece)
+                        message = "".join(pieces)
+            except RateLimitError:
+                self.rate_limiter.backoff(10)
+                raise
+
+            if not stream:
+                if response is None:
+                    print("Failed to get a response from OpenAI. Try again.")
+
+                message = response.choices[0].message.content
+                usage = response.usage
+
+            if usage is not None:
+                info = {
+                    "prompt_tokens" : usage.prompt_tokens, 
+                    "completion_tokens" : usage.completion_tokens, 
+                    "total_tokens" : usage.total_tokens,
+                }
             else:
-                response = self.client.chat.completions.create(model=model,
-                messages=messages,
-                temperature=temperature,
-                seed=seed,
-                max_tokens=max_tokens,)
-
-            if response is None:
-                print("Failed to get a response from OpenAI. Try again.")
-
-            message = response.choices[0].message.content
-
-            info = {
-                "prompt_tokens" : response.usage.prompt_tokens, 
-                "completion_tokens" : response.usage.completion_tokens, 
-                "total_tokens" : response.usage.total_tokens,
-            }
+                # the endpoint does not report the usage of streamed requests
+                prompt_tokens = self.num_tokens_from_messages(messages, model=model)
+                completion_tokens = count_tokens(message, model)
+                info = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
 
             return message, info
 
-        return _generate_response_with_retry(
+        message, info = _generate_response_with_retry(
             messages,
             model,
             temperature,
@@ -349,6 +488,51 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
             max_tokens,
         )
 
+        if self.completion_cache is not None and message is not None:
+            self.completion_cache.put(cache_key, message, info)
+
+        return message, info
+
+    def _completion_cache_key(self,
+                              messages: List[Dict[str, str]],
+                              model: str,
+                              temperature: float,
+                              seed: int | None,
+                              max_tokens: int) -> str:
+        return hash_request(model=model,
+                            messages=messages,
+                            temperature=temperature,
+                            seed=seed,
+                            max_tokens=max_tokens)
+
+    def discard_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str | None = None,
+        temperature: float = 1.0,
+        seed: int | None = 42,
+        max_tokens: int = 4096,
+    ) -> None:
+        """Drop a cached completion, so that the next identical request queries the API again."""
+        if self.completion_cache is None:
+            return
+
+        if model is None:
+            model = self.llm_model
+
+        cache_key = self._completion_cache_key(messages, model, temperature, seed, max_tokens)
+        self.completion_cache.discard(cache_key)
+
+    def encode_image_url(self, image_path: str) -> str:
+        """Get the data url of an image, encoded once per step and downscaled as configured."""
+        return self.image_cache.get(image_path)
+
+    def get_completion_cache_stats(self) -> Dict[str, float]:
+        """Get the hit/miss counters of the completion cache."""
+        if self.completion_cache is None:
+            return {}
+        return self.completion_cache.stats()
+
     def num_tokens_from_messages(self, messages, model = None) -> int:
         """Return the number of tokens used by a list of messages.
         Borrowed from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
@@ -356,43 +540,26 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
 
         model = self.provider_cfg[PROVIDER_SETTING_COMP_MODEL] if model is None else model
 
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-
-        if model in {
-            "gpt-4-1106-vision-preview",
-        }:
-            raise ValueError("We don't support counting tokens of GPT-4V yet.")
-
-        if model in {
-            "gpt-3.5-turbo-1106",
-            "gpt-3.5-turbo-0613",
-            "gpt-3.5-turbo-16k-0613",
-            "gpt-4-0314",
-            "gpt-4-32k-0314",
-            "gpt-4-0613",
-            "gpt-4-32k-0613",
-            "gpt-4-1106-preview",
-        }:
-            tokens_per_message = 3
-            tokens_per_name = 1
-        elif model == "gpt-3.5-turbo-0301":
+        encoding = get_encoding(model)
+
+        if model == "gpt-3.5-turbo-0301":
             tokens_per_message = (
                 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
             )
             tokens_per_name = -1  # if there's a name, the role is omitted
         else:
-            raise NotImplementedError(
-                f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-            )
+            # all later chat models, the images of vision models are not counted
+            tokens_per_message = 3
+            tokens_per_name = 1
 
         num_tokens = 0
         for message in messages:
             num_tokens += tokens_per_message
             for key, value in message.items():
                 if key == "content":
+                    if isinstance(value, str):
+                        num_tokens += len(encoding.encode(value))
+                        continue
                     for content in value:
                         if content["type"] == "text":
                             num_tokens += len(encoding.encode(content["text"]))
@@ -408,7 +575,7 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
         return self.provider_cfg[PROVIDER_SETTING_DEPLOYMENT_MAP][model_label]
 
     def assemble_prompt(self, system_prompts: List[str], user_inputs: List[str], image_filenames: List[str]) -> List[str]:
-        encoded_images = [encode_image(image_path) for image_path in image_filenames]
+        image_urls = [self.encode_image_url(image_path) for image_path in image_filenames]
 
         messages = [
             {
@@ -438,13 +605,13 @@ class OpenAIProvider(LLMProvider, EmbeddingProvider):
             }
         ]
 
-        for image in encoded_images:
+        for image_url in image_urls:
             messages[1]["content"].append(
                 {
                     "type": "image_url",
                     "image_url":
                         {
-                            "url": f"data:image/jpeg;base64,{image}"
+                            "url": image_url
                         }
                 },
             )
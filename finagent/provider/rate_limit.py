@@ -0,0 +1,64 @@
+"""Request scheduling shared by every user of a provider."""
+import time
+import threading
+from typing import Optional
+
+
+class RateLimiter():
+    """Bound the number of in-flight requests and the request rate of a provider.
+
+    A semaphore caps the concurrent requests, a token bucket spreads the requests
+    so that at most requests_per_minute are sent in any minute. Both are optional,
+    a limiter without limits is a no-op.
+    """
+
+    def __init__(self,
+                 max_concurrency: Optional[int] = None,
+                 requests_per_minute: Optional[float] = None) -> None:
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+        self._lock = threading.Lock()
+        if requests_per_minute:
+            self._capacity = float(requests_per_minute)
+            self._rate = float(requests_per_minute) / 60.0
+            self._tokens = self._capacity
+            self._updated_at = time.monotonic()
+
+    def _take_token(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+                self._updated_at = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def backoff(self, seconds: float) -> None:
+        """Drain the bucket after the server reported a rate limit, so that all workers pause."""
+        if not self.requests_per_minute:
+            return
+        with self._lock:
+            self._tokens = min(self._tokens, 1.0 - seconds * self._rate)
+
+    def __enter__(self):
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        if self.requests_per_minute:
+            try:
+                self._take_token()
+            except BaseException:
+                if self._semaphore is not None:
+                    self._semaphore.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._semaphore is not None:
+            self._semaphore.release()
+        return False
@@ -1,55 +1,86 @@
 from finagent.memory import MemoryInterface
 from finagent.provider import EmbeddingProvider
 from finagent.query import QUERY_TYPES
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
+from datetime import timedelta
+import pandas as pd
 class DiverseQuery():
     def __init__(self,
                  memory: MemoryInterface,
                  provider: EmbeddingProvider,
-                 top_k: int = 5):
+                 top_k: int = 5,
+                 lookback_days: int = None):
         self.memory = memory
         self.provider = provider
         self.top_k = top_k
+        # only query the memories of the last lookback_days days before end_date, all of them if None
+        self.lookback_days = lookback_days
+
+    def _date_range(self, end_date: Any = None) -> Tuple[Any, Any]:
+        if end_date is None or self.lookback_days is None:
+            return None, end_date
+        start_date = pd.Timestamp(end_date).to_pydatetime() - timedelta(days=self.lookback_days)
+        return start_date, end_date
 
     def query(self,
               params: Dict= None,
               query_types: List[str] = ["plain", "short_term", "long_term"],
-              top_k: int = None):
+              top_k: int = None,
+              end_date: Any = None):
 
-        return self.diverse_query(params, query_types=query_types, top_k=top_k)
+        return self.diverse_query(params, query_types=query_types, top_k=top_k, end_date=end_date)
 
     def diverse_query(self,
                       params: Dict,
                       query_types: List[str] = ["plain", "short_term",  "long_term"],
-                      top_k: int = None):
-
-        top_k = top_k if top_k is not None else self.top_k
+                      top_k: int = None,
+                      end_date: Any = None):
 
-        type = params["type"]
-        symbol = params["symbol"]
+        results = self.batch_query([(params, query_type) for query_type in query_types], top_k=top_k, end_date=end_date)
 
         res = {}
+        for query_type, result in zip(query_types, results):
+            res[query_type] = result
 
-        for query_type in query_types:
+        return res
+
+    def batch_query(self,
+                    requests: List[Tuple[Dict, str]],
+                    top_k: int = None,
+                    end_date: Any = None) -> List[Dict[str, Any]]:
+        """Run several (params, query_type) queries at once.
+
+        All query texts are embedded in one provider call, then the queries of every
+        (type, symbol) memory are answered by one index search. The results are
+        returned in the order of the requests. With end_date only memories dated
+        before it, and within lookback_days of it, are returned.
+        """
+        top_k = top_k if top_k is not None else self.top_k
+        start_date, end_date = self._date_range(end_date)
 
-            query_text = QUERY_TYPES[query_type](params)
-            embedding = self.provider.embed_query(query_text)
-            query_items, _ = self.memory.query_memory(type=type,
-                                                      symbol=symbol,
-                                                      data={"embedding": embedding},
-                                                      embedding_query="embedding",
-                                                      top_k=top_k)
+        if len(requests) == 0:
+            return []
 
-            pre_query_items = query_items
+        query_texts = [QUERY_TYPES[query_type](params) for params, query_type in requests]
+        embeddings = self.provider.embed_documents(query_texts)
 
-            if len(pre_query_items) == 0:
-                post_query_items = []
-            else:
-                post_query_items = pre_query_items
+        groups: Dict[Tuple[str, str], List[int]] = {}
+        for i, (params, _) in enumerate(requests):
+            groups.setdefault((params["type"], params["symbol"]), []).append(i)
 
-            res[query_type] = {
-                "query_text": query_text,
-                "query_items": post_query_items
-            }
+        results = [None] * len(requests)
+        for (type, symbol), indices in groups.items():
+            query_res = self.memory.query_memories(type=type,
+                                                   symbol=symbol,
+                                                   datas=[{"embedding": embeddings[i]} for i in indices],
+                                                   embedding_query="embedding",
+                                                   top_k=top_k,
+                                                   start_date=start_date,
+                                                   end_date=end_date)
+            for i, (query_items, _) in zip(indices, query_res):
+                results[i] = {
+                    "query_text": query_texts[i],
+                    "query_items": query_items
+                }
 
-        return res
\ No newline at end of file
+        return results
@@ -1,7 +1,11 @@
 from .utils import get_attr
+from .xml_utils import StructuredResponseParser, parse_structured_response, format_diagnostics
 from .json_utils import load_json, save_json, parse_semi_formatted_xml, convert_to_json_serializable, parse_semi_formatted_json
 from .file_utils import assemble_project_path
 from .file_utils import read_resource_file
 from .singleton import Singleton
 from .file_utils import init_path
 from .file_utils import save_html
+from .step_executor import StepExecutor
+from .near_duplicate import NearDuplicateIndex, collapse_near_duplicates
+from .token_utils import get_encoding, count_tokens, truncate_to_tokens, fit_items, record_token_usage
@@ -2,7 +2,8 @@ import json
 import json5
 import numpy as np
 import re
-from bs4 import BeautifulSoup
+
+from finagent.utils.xml_utils import parse_structured_response
 
 def load_json(file_path):
     with open(file_path, mode='r', encoding='utf8') as fp:
@@ -63,43 +64,8 @@ def parse_semi_formatted_json(json_string):
     return obj
 
 def parse_semi_formatted_xml(text):
-    text = text.strip().replace('\r', '').replace('\t', '').replace('\n', '')
-
-    # text = text.replace('```xml', '').replace('```', '')
-
-    soup = BeautifulSoup(text, 'html.parser')
-
-    obj = {}
-
-    output = soup.find('output')
-    all_children = output.find_all(recursive=False)
-
-    for child in all_children:
-        tag_name = child.name
-        name = child.get('name').lower()
-
-        if tag_name == 'string':
-            contents = child.text.replace('\r', '').replace('\t', '').split('\n')
-            contents = [content for content in contents if content != '']
-            content = "\n".join(contents)
-            obj[name] = content
-        elif tag_name == "list":
-            obj[name] = []
-            for item_tag in child.find_all('item'):
-                item = {}
-                for item_child in item_tag.find_all(recursive=False):
-                    item_name = item_child.name.lower()
-                    item_content = item_child.text.replace('\r', '').replace('\t', '').replace('\n', '')
-                    item[item_name] = item_content
-                obj[name].append(item)
-
-        elif tag_name == "map":
-            obj[name] = {}
-            for item_tag in child.find_all('string'):
-                item_name = item_tag.get('name').lower()
-                item_content = item_tag.text.replace('\r', '').replace('\t', '').replace('\n', '')
-                obj[name][item_name] = item_content
-    return obj, soup
+    """Parse an <output> response of a prompt, return its complete fields and the diagnostics of the parser."""
+    return parse_structured_response(text)
 
 def convert_to_json_serializable(data):
     """
@@ -0,0 +1,133 @@
+"""MinHash near-duplicate detection for news, e.g. one wire story syndicated by several sources."""
+import re
+import zlib
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+import numpy as np
+import pandas as pd
+
+# hash functions are (a * x + b) % HASH_PRIME of the crc32 x of a shingle, a * x + b fits into uint64
+HASH_PRIME = (1 << 31) - 1
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def shingles(text: str, k: int = 3) -> List[str]:
+    """Word k-shingles of the lower cased text, the tokens themselves for texts shorter than k words."""
+    tokens = TOKEN_PATTERN.findall(str(text).lower())
+    if len(tokens) < k:
+        return tokens
+    return [" ".join(tokens[i:i + k]) for i in range(len(tokens) - k + 1)]
+
+
+class NearDuplicateIndex():
+    """MinHash signatures with LSH banding, adding a text returns the representative it duplicates.
+
+    Two texts are near duplicates if the estimated Jaccard similarity of their
+    shingles is at least threshold. Candidates are the texts sharing a band of
+    their signatures, so a lookup does not compare against every added text.
+
+    Args:
+        threshold: Minimum estimated Jaccard similarity of near duplicates.
+        num_perm: Number of hash functions of a signature.
+        bands: Number of LSH bands, num_perm should be divisible by it.
+        window_days: A text only duplicates a representative dated at most this
+            many days apart, so that recurring templated stories are kept. None
+            ignores the dates.
+        seed: Seed of the hash functions.
+    """
+
+    def __init__(self,
+                 threshold: float = 0.6,
+                 num_perm: int = 64,
+                 bands: int = 16,
+                 window_days: Optional[int] = 2,
+                 seed: int = 0) -> None:
+        assert num_perm % bands == 0, f"num_perm = {num_perm} should be divisible by bands = {bands}."
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.window_days = window_days
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, HASH_PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, HASH_PRIME, size=num_perm).astype(np.uint64)
+
+        self.signatures: List[np.ndarray] = []
+        self.timestamps: List[Any] = []
+        self.buckets: Dict[tuple, List[int]] = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        values = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in set(shingles(text))], dtype=np.uint64)
+        if len(values) == 0:
+            return np.full(self.num_perm, HASH_PRIME, dtype=np.uint64)
+        return ((np.outer(values, self._a) + self._b) % np.uint64(HASH_PRIME)).min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> List[tuple]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _in_window(self, timestamp: Any, other: Any) -> bool:
+        if self.window_days is None or timestamp is None or other is None:
+            return True
+        return abs((pd.Timestamp(timestamp) - pd.Timestamp(other)).days) <= self.window_days
+
+    def add(self, text: str, timestamp: Any = None) -> Optional[int]:
+        """Return the position of the representative text duplicates, or add text as a new representative and return None."""
+        signature = self.signature(text)
+        band_keys = self._band_keys(signature)
+
+        candidates = set()
+        for band_key in band_keys:
+            candidates.update(self.buckets.get(band_key, []))
+
+        best, best_similarity = None, self.threshold
+        for candidate in sorted(candidates):
+            if not self._in_window(timestamp, self.timestamps[candidate]):
+                continue
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is not None:
+            return best
+
+        position = len(self.signatures)
+        self.signatures.append(signature)
+        self.timestamps.append(timestamp)
+        for band_key in band_keys:
+            self.buckets.setdefault(band_key, []).append(position)
+        return None
+
+
+def collapse_near_duplicates(df: pd.DataFrame,
+                             text_columns: List[str] = ["title", "text"],
+                             timestamp_column: Optional[str] = "timestamp",
+                             count_column: str = "source_count",
+                             **kwargs) -> pd.DataFrame:
+    """Keep the first row of every cluster of near duplicate rows, count_column holds the size of its cluster.
+
+    Rows are compared in their order, so sort df by time to keep the earliest
+    report of a story. A count_column already in df, from an earlier collapse,
+    is summed. kwargs are passed to NearDuplicateIndex.
+    """
+    index = NearDuplicateIndex(**kwargs)
+
+    counts = df[count_column].astype(int).tolist() if count_column in df.columns else [1] * len(df)
+    texts = df[text_columns].astype(str).agg(" ".join, axis=1).tolist() if len(df) > 0 else []
+    timestamps = df[timestamp_column].tolist() if timestamp_column is not None else [None] * len(df)
+
+    keep = []
+    kept_counts = []
+    for row, (text, timestamp, count) in enumerate(zip(texts, timestamps, counts)):
+        representative = index.add(text, timestamp)
+        if representative is None:
+            keep.append(row)
+            kept_counts.append(count)
+        else:
+            kept_counts[representative] += count
+
+    df = df.iloc[keep].copy()
+    df[count_column] = kept_counts
+    return df
@@ -0,0 +1,96 @@
+"""A small DAG executor for running the stages of a trading step concurrently."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+
+class Stage():
+    def __init__(self,
+                 name: str,
+                 func: Callable[[Dict, Dict], Any],
+                 deps: Optional[List[str]] = None):
+        """A stage of a step.
+
+        Args:
+            name: Unique name of the stage.
+            func: Called as func(params, results). params is a private copy of the
+                shared params that the stage may update in place, results holds the
+                return values of the finished stages.
+            deps: Names of the stages that must finish before this one starts.
+        """
+        self.name = name
+        self.func = func
+        self.deps = list(deps) if deps is not None else []
+
+
+class StepExecutor():
+    """Run stages as a DAG, starting every stage as soon as its dependencies finished.
+
+    Stages are plain synchronous callables, they are executed in a thread pool so
+    that blocking provider requests, plotting and memory writes overlap. Updates a
+    stage makes to its params are merged back into the shared params on the event
+    loop, before any dependent stage is started.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self.stages: Dict[str, Stage] = {}
+
+    def add_stage(self,
+                  name: str,
+                  func: Callable[[Dict, Dict], Any],
+                  deps: Optional[List[str]] = None) -> None:
+        assert name not in self.stages, f"Stage {name} is already added."
+        for dep in deps or []:
+            assert dep in self.stages, f"Dependency {dep} of stage {name} should be added before it."
+        self.stages[name] = Stage(name, func, deps)
+
+    async def arun(self, params: Dict) -> Dict[str, Any]:
+        """Run all stages, update params in place and return the results of every stage."""
+        loop = asyncio.get_running_loop()
+        results: Dict[str, Any] = {}
+
+        def call(stage: Stage, stage_params: Dict):
+            return stage.func(stage_params, results)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = dict(self.stages)
+            running: Dict[asyncio.Future, tuple] = {}
+
+            while pending or running:
+                for name in list(pending.keys()):
+                    stage = pending[name]
+                    if all(dep in results for dep in stage.deps):
+                        snapshot = dict(params)
+                        stage_params = dict(snapshot)
+                        future = loop.run_in_executor(pool, call, stage, stage_params)
+                        running[future] = (stage, snapshot, stage_params)
+                        del pending[name]
+
+                assert len(running) > 0, f"Stages {list(pending.keys())} can never be started."
+
+                done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    stage, snapshot, stage_params = running.pop(future)
+                    # re-raise after the still running stages finished, a thread can not be cancelled
+                    if future.exception() is not None:
+                        if running:
+                            await asyncio.wait(running.keys())
+                        raise future.exception()
+
+                    params.update({
+                        key: value for key, value in stage_params.items()
+                        if key not in snapshot or snapshot[key] is not value
+                    })
+                    results[stage.name] = future.result()
+
+        return results
+
+    def run(self, params: Dict) -> Dict[str, Any]:
+        return asyncio.run(self.arun(params))
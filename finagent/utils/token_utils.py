@@ -0,0 +1,88 @@
+"""Token counting with cached tiktoken encoders, and fitting prompt sections into token budgets."""
+from functools import lru_cache
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+
+@lru_cache(maxsize=None)
+def get_encoding(model: Optional[str] = None) -> Any:
+    """The encoder of model, cl100k_base for unknown models. Building an encoder is slow, so they are cached."""
+    if model is not None:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None, suffix: str = "...") -> str:
+    """Cut text to at most max_tokens tokens including suffix, text that fits is returned unchanged."""
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    suffix_tokens = len(encoding.encode(suffix, disallowed_special=()))
+    return encoding.decode(tokens[:max(max_tokens - suffix_tokens, 0)]) + suffix
+
+def fit_items(items: List[str],
+              budget: Optional[int] = None,
+              separator: str = "\n",
+              max_items: Optional[int] = None,
+              model: Optional[str] = None) -> Tuple[List[int], List[str], Dict[str, Any]]:
+    """Select items, ranked best first, that fit into a token budget when joined by separator.
+
+    Items are taken in order until the next one does not fit, later smaller items
+    are not used to fill the gap so that a lower ranked item never replaces a
+    better one. If even the best item does not fit, it is truncated to the budget.
+
+    Returns:
+        The positions and texts of the kept items, and the usage of the section:
+        its budget, the tokens of the kept items, the number of kept and dropped
+        items and whether the kept item was truncated.
+    """
+    separator_tokens = count_tokens(separator, model) if len(items) > 1 else 0
+
+    positions = []
+    texts = []
+    tokens = 0
+    truncated = False
+    for position, item in enumerate(items):
+        if max_items is not None and len(positions) >= max_items:
+            break
+        item_tokens = count_tokens(item, model) + (separator_tokens if len(positions) > 0 else 0)
+        if budget is not None and tokens + item_tokens > budget:
+            if len(positions) == 0:
+                item = truncate_to_tokens(item, budget, model)
+                positions.append(position)
+                texts.append(item)
+                tokens = count_tokens(item, model)
+                truncated = True
+            break
+        positions.append(position)
+        texts.append(item)
+        tokens += item_tokens
+
+    usage = {
+        "budget": budget,
+        "tokens": tokens,
+        "items": len(positions),
+        "dropped": len(items) - len(positions),
+        "truncated": truncated,
+    }
+    return positions, texts, usage
+
+def record_token_usage(params: Dict[str, Any], section: str, usage: Dict[str, Any]) -> None:
+    """Keep the usage of a section in params, which are saved with the result of a stage."""
+    params.setdefault("token_usage", {})[section] = usage
+    print(f"Tokens of {section}: {usage['tokens']} of budget {usage['budget']}, "
+          f"{usage['items']} items kept, {usage['dropped']} dropped" + (", truncated" if usage["truncated"] else ""))
@@ -0,0 +1,248 @@
+"""A tolerant, incremental parser of the <output><string|list|map> responses the prompts ask for."""
+import html
+import re
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+# as in html, "<" followed by a space is text, e.g. "a < b"
+TAG_PATTERN = re.compile(r"<(/)?([A-Za-z][\w\-]*)((?:\s[^<>]*?)?)(/)?\s*>")
+NAME_PATTERN = re.compile(r"""name\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.IGNORECASE)
+# an unterminated tag longer than this at the end of a chunk is text, not a tag being streamed
+MAX_TAG_LENGTH = 256
+
+CONTAINERS = ["output", "string", "map", "list", "item"]
+
+def clean_text(text: str) -> str:
+    """The text of a map or list value, without tabs or line breaks, also those written as entities, e.g. &#10;."""
+    return html.unescape(text).replace("\r", "").replace("\t", "").replace("\n", "")
+
+def clean_string(text: str) -> str:
+    """The text of a top level <string> field, without tabs, line breaks or empty lines, as the BeautifulSoup parser returned it."""
+    # line breaks written as entities, e.g. &#10;, are kept
+    text = html.unescape(text.replace("\r", "").replace("\t", "").replace("\n", ""))
+    lines = text.replace("\r", "").replace("\t", "").split("\n")
+    return "\n".join([line for line in lines if line != ""])
+
+
+class StructuredResponseParser():
+    """Parse a response chunk by chunk, every field is available as soon as its closing tag arrives.
+
+    The parser does not build a document tree and accepts the usual mistakes of
+    a model: text around the <output> element, e.g. markdown fences, a missing
+    <output> element, unclosed <string> tags followed by the next field and
+    missing closing tags of maps, lists and items. Each one is recorded as a
+    diagnostic with its position in the response. A field still open at the
+    end of the response is incomplete, it is only reported in the diagnostics
+    with its partial value.
+
+    Example:
+        parser = StructuredResponseParser()
+        for chunk in chunks:
+            for name in parser.feed(chunk):
+                print(name, parser.fields[name])
+        fields, diagnostics = parser.close()
+    """
+
+    def __init__(self) -> None:
+        self.fields: Dict[str, Any] = {}
+        self.diagnostics: List[Dict[str, Any]] = []
+
+        self._buffer = ""
+        # position of the start of the buffer in the whole response
+        self._offset = 0
+        self._stack: List[Dict[str, Any]] = []
+        self._seen_output = False
+        self._done = False
+        self._completed: List[str] = []
+
+    def _diagnose(self, position: int, message: str, name: Optional[str] = None, **kwargs) -> None:
+        diagnostic = {"position": position, "name": name, "message": message}
+        diagnostic.update(kwargs)
+        self.diagnostics.append(diagnostic)
+
+    def _top(self, kinds: List[str]) -> bool:
+        return len(self._stack) > 0 and self._stack[-1]["kind"] in kinds
+
+    def _open(self, kind: str, tag: str, name: Optional[str], position: int) -> None:
+        frame = {"kind": kind, "tag": tag, "name": name, "position": position, "text": []}
+        if kind == "map":
+            frame["value"] = {}
+        elif kind == "list":
+            frame["value"] = []
+        elif kind == "item":
+            frame["value"] = {}
+        self._stack.append(frame)
+
+    def _close_top(self, position: int, implicit: bool = False) -> None:
+        frame = self._stack.pop()
+        if implicit:
+            self._diagnose(frame["position"], f"<{frame['tag']}> is not closed, closed at the next tag", name=frame["name"],
+                           closed_at=position)
+
+        if frame["kind"] == "output":
+            self._done = True
+            return
+
+        parent = self._stack[-1] if len(self._stack) > 0 else None
+        parent_kind = parent["kind"] if parent is not None else "output"
+
+        if frame["kind"] == "string" and parent_kind == "output":
+            value = clean_string("".join(frame["text"]))
+        elif frame["kind"] in ["string", "field"]:
+            value = clean_text("".join(frame["text"]))
+        else:
+            value = frame["value"]
+
+        if frame["kind"] in ["field"]:
+            parent["value"][frame["name"]] = value
+        elif frame["kind"] == "item":
+            parent["value"].append(value)
+        elif parent_kind == "map" and frame["kind"] == "string":
+            if frame["name"] is not None:
+                parent["value"][frame["name"]] = value
+        elif parent_kind == "output":
+            if frame["name"] is None:
+                self._diagnose(frame["position"], f"<{frame['tag']}> has no name attribute, it is dropped")
+            else:
+                if frame["name"] in self.fields:
+                    self._diagnose(frame["position"], "field is repeated, the last one is kept", name=frame["name"])
+                self.fields[frame["name"]] = value
+                self._completed.append(frame["name"])
+        else:
+            self._diagnose(frame["position"], f"<{frame['tag']}> is not expected inside <{parent['tag']}>, it is dropped",
+                           name=frame["name"])
+
+    def _close_until(self, kinds: List[str], position: int) -> None:
+        """Implicitly close the open frames above the innermost one of kinds."""
+        while len(self._stack) > 0 and self._stack[-1]["kind"] not in kinds:
+            self._close_top(position, implicit=True)
+
+    def _handle_open(self, tag: str, attrs: str, self_closing: bool, position: int) -> None:
+        match = NAME_PATTERN.search(attrs)
+        name = None
+        if match is not None:
+            name = next(group for group in match.groups() if group is not None).lower()
+
+        inside = [frame["kind"] for frame in self._stack]
+
+        if tag == "output":
+            if not self._seen_output and len(self._stack) == 0:
+                self._seen_output = True
+                self._open("output", tag, None, position)
+            return
+
+        if "item" in inside:
+            # every tag directly inside an item is one of its fields, tags inside a field are part of its text
+            if tag == "item":
+                self._close_until(["list"], position)
+                self._open("item", tag, None, position)
+            elif self._top(["item"]):
+                self._open("field", tag, tag, position)
+        elif tag == "string":
+            if self._top(["string"]):
+                self._close_top(position, implicit=True)
+            self._open("string", tag, name, position)
+        elif tag in ["map", "list"]:
+            if self._top(["string"]):
+                self._close_top(position, implicit=True)
+            self._open(tag, tag, name, position)
+        elif tag == "item" and "list" in inside:
+            self._close_until(["list"], position)
+            self._open("item", tag, None, position)
+        # any other tag inside a string is part of its text, as in a document tree
+
+        if self_closing and len(self._stack) > 0 and self._stack[-1]["position"] == position:
+            self._close_top(position)
+
+    def _handle_close(self, tag: str, position: int) -> None:
+        kind = tag if tag in CONTAINERS else "field"
+        for depth in range(len(self._stack) - 1, -1, -1):
+            frame = self._stack[depth]
+            if frame["kind"] == kind and frame["tag"] == tag:
+                while len(self._stack) > depth + 1:
+                    self._close_top(position, implicit=True)
+                self._close_top(position)
+                return
+        if not self._top(["string", "field"]):
+            self._diagnose(position, f"</{tag}> closes no open tag, it is ignored")
+
+    def _handle_text(self, text: str) -> None:
+        if self._top(["string", "field"]):
+            self._stack[-1]["text"].append(text)
+
+    def feed(self, chunk: str) -> List[str]:
+        """Parse the next chunk of the response, return the names of the fields it completes."""
+        self._completed = []
+        if self._done:
+            return []
+        self._buffer += chunk
+
+        position = 0
+        for match in TAG_PATTERN.finditer(self._buffer):
+            self._handle_text(self._buffer[position:match.start()])
+            closing, tag, attrs, self_closing = match.groups()
+            tag = tag.lower()
+            if closing:
+                self._handle_close(tag, self._offset + match.start())
+            else:
+                self._handle_open(tag, attrs, self_closing is not None, self._offset + match.start())
+            position = match.end()
+            if self._done:
+                self._buffer = ""
+                return self._completed
+
+        rest = self._buffer[position:]
+        # keep a tag that may still be arriving
+        start = rest.rfind("<")
+        if start != -1 and ">" not in rest[start:] and len(rest) - start <= MAX_TAG_LENGTH:
+            self._handle_text(rest[:start])
+            self._offset += position + start
+            self._buffer = rest[start:]
+        else:
+            self._handle_text(rest)
+            self._offset += len(self._buffer)
+            self._buffer = ""
+        return self._completed
+
+    def close(self) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Finish parsing, return the complete fields and the diagnostics."""
+        if not self._done:
+            self._handle_text(self._buffer)
+            self._offset += len(self._buffer)
+            self._buffer = ""
+
+            if not self._seen_output:
+                self._diagnose(0, "the response has no <output> element")
+
+            end = self._offset
+            for frame in self._stack:
+                if frame["kind"] == "output":
+                    self._diagnose(frame["position"], "<output> is not closed", closed_at=end)
+                elif frame["kind"] in ["string", "field"]:
+                    self._diagnose(frame["position"], f"<{frame['tag']}> is cut off by the end of the response",
+                                   name=frame["name"], partial=clean_text("".join(frame["text"])))
+                else:
+                    self._diagnose(frame["position"], f"<{frame['tag']}> is cut off by the end of the response",
+                                   name=frame["name"], partial=frame["value"])
+            self._stack = []
+            self._done = True
+        return self.fields, self.diagnostics
+
+
+def parse_structured_response(text: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Parse a whole response, return its complete fields and the diagnostics of the parser."""
+    parser = StructuredResponseParser()
+    parser.feed(text)
+    return parser.close()
+
+def format_diagnostics(diagnostics: List[Dict[str, Any]]) -> str:
+    lines = []
+    for diagnostic in diagnostics:
+        name = f" ({diagnostic['name']})" if diagnostic.get("name", None) is not None else ""
+        lines.append(f"- at {diagnostic['position']}{name}: {diagnostic['message']}")
+    return "\n".join(lines)
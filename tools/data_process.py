@@ -33,7 +33,9 @@ def parse_args():
     parser.add_argument("--workdir", type=str, default="workdir")
     parser.add_argument("--batch_size", type=int, default=None)
     parser.add_argument("--tag", type=str, default=None)
+    parser.add_argument("--num_workers", type=int, default=None, help="process the stocks on a process pool of this size")
     parser.add_argument("--if_remove", action="store_true", default=False)
+    parser.add_argument("--if_incremental", action="store_true", default=False, help="only reprocess new dates and changed sources")
     args = parser.parse_args()
     return args
 
@@ -60,6 +62,10 @@ def main():
         args.cfg_options["tag"] = args.tag
     if args.batch_size is not None:
         args.cfg_options["batch_size"] = args.batch_size
+    if args.num_workers is not None:
+        args.cfg_options["processor.num_workers"] = args.num_workers
+    if args.if_incremental:
+        args.cfg_options["processor.if_incremental"] = True
     cfg.merge_from_dict(args.cfg_options)
 
     update_data_root(cfg, root=args.root)
@@ -78,6 +84,10 @@ def main():
     processor = PROCESSOR.build(cfg.processor)
     stocks = processor.stocks
 
+    if cfg.processor.get("num_workers", 1) > 1:
+        processor.process()
+        return
+
     batch_size = cfg.batch_size if cfg.batch_size < len(stocks) else 5
     batch_size = min(len(stocks), batch_size)
 
@@ -7,6 +7,7 @@ import os
 import sys
 from pathlib import Path
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from mmengine.config import Config, DictAction
 
 from dotenv import load_dotenv
@@ -18,8 +19,9 @@ sys.path.append(ROOT)
 from finagent.registry import DATASET, ENVIRONMENT, PROVIDER, PROMPT, MEMORY, PLOTS
 from finagent.asset import ASSET
 from finagent.utils.misc import update_data_root
-from finagent.utils import read_resource_file, save_json, load_json
+from finagent.utils import read_resource_file, save_json, load_json, StepExecutor
 from finagent.query import DiverseQuery
+from finagent.memory import MemoryJournal, RemoteMemoryInterface
 from finagent.prompt import (prepare_latest_market_intelligence_params,
                              prepare_low_level_reflection_params,
                              prepare_high_level_reflection_params,
@@ -50,6 +52,9 @@ def parse_args():
     parser.add_argument("--trading_record_path", type=str, default=None)
     parser.add_argument("--if_train", action="store_true", default=False)
     parser.add_argument("--if_valid", action="store_true", default=True)
+    parser.add_argument("--if_async_step", action="store_true", default=False)
+    parser.add_argument("--if_early_action", action="store_true", default=False,
+                        help="stream the decision and step the environment as soon as its action is generated")
 
     # valid
     # parser.add_argument("--if_load_memory", action="store_true", default=True)
@@ -74,6 +79,8 @@ def main():
     args.cfg_options["memory_path"] = args.memory_path
     args.cfg_options["if_load_trading_record"] = args.if_load_trading_record
     args.cfg_options["trading_record_path"] = args.trading_record_path
+    args.cfg_options["if_async_step"] = args.if_async_step
+    args.cfg_options["if_early_action"] = args.if_early_action
 
     if args.if_train is not None:
         args.cfg_options["if_train"] = args.if_train
@@ -99,6 +106,13 @@ def main():
     provider = PROVIDER.build(cfg.provider)
 
     dataset = DATASET.build(cfg.dataset)
+
+    run_experiment(cfg, exp_path, provider, dataset)
+
+    print_provider_stats(provider)
+
+def run_experiment(cfg, exp_path, provider, dataset):
+
     cfg.train_environment["dataset"] = dataset
     train_env = ENVIRONMENT.build(cfg.train_environment)
     cfg.valid_environment["dataset"] = dataset
@@ -110,13 +124,19 @@ def main():
     cfg.memory["embedding_dim"] = provider.get_embedding_dim()
     memory = MEMORY.build(cfg.memory)
 
-    diverse_query = DiverseQuery(memory, provider, top_k=cfg.top_k)
+    diverse_query = DiverseQuery(memory, provider, top_k=cfg.top_k, lookback_days=cfg.get("memory_lookback_days", None))
     strategy_agents = StrategyAgents()
 
     if cfg.if_load_memory and cfg.memory_path is not None:
         print("load local memory...")
         memory_path = os.path.join(cfg.root, cfg.memory_path)
-        memory.load_local(memory_path=memory_path)
+        if MemoryJournal.exists(memory_path):
+            memory.load_journal(journal_path=memory_path, checkpoint=cfg.checkpoint_start_date)
+        else:
+            memory.load_local(memory_path=memory_path)
+
+    if cfg.get("if_memory_journal", True):
+        memory.open_journal(journal_path=os.path.join(exp_path, "memory_records"))
 
     if cfg.if_train:
         train_records = run(cfg,
@@ -146,6 +166,18 @@ def main():
         valid_save_path = os.path.join(exp_path, "valid_records.json")
         save_json(valid_records, valid_save_path)
 
+def print_provider_stats(provider):
+
+    embedding_cache_stats = provider.get_embedding_cache_stats()
+    if len(embedding_cache_stats) > 0:
+        print(f"Embedding cache: hits {embedding_cache_stats['hits']}, misses {embedding_cache_stats['misses']}, "
+              f"hit rate {embedding_cache_stats['hit_rate']:.2%}")
+
+    completion_cache_stats = provider.get_completion_cache_stats()
+    if len(completion_cache_stats) > 0:
+        print(f"Completion cache: hits {completion_cache_stats['hits']}, misses {completion_cache_stats['misses']}, "
+              f"hit rate {completion_cache_stats['hit_rate']:.2%}")
+
 def run(cfg, env, plots, memory, provider, diverse_query, strategy_agents,  exp_path, mode = "train"):
 
     trading_records_path = os.path.join(exp_path, "trading_records")
@@ -186,9 +218,29 @@ def run(cfg, env, plots, memory, provider, diverse_query, strategy_agents,  exp_
             else:
                 break
 
+    step_func = run_step_async if cfg.get("if_async_step", False) else run_step
+    save_dir = "train" if mode == "train" else "valid"
+
+    # with an early action the decision is streamed, and the environment is stepped and the
+    # next kline is plotted as soon as its action is generated, while its reasoning is generated
+    if_early_action = cfg.get("if_early_action", False)
+    prefetch_pool = ThreadPoolExecutor(max_workers=1) if if_early_action else None
+    prefetched = {}
+
+    def advance(action):
+        state, reward, done, truncated, info = env.step(env.action_map[action])
+        kline_path = plots.plot_kline(state=state, info=info, save_dir=save_dir) if not done else None
+        return (state, reward, done, truncated, info), kline_path
+
     while True:
 
-        action = run_step(cfg,
+        early = {}
+
+        def on_action(action):
+            if action in env.action_map.keys():
+                early["future"] = prefetch_pool.submit(advance, action)
+
+        action = step_func(cfg,
                           state,
                           info,
                           plots,
@@ -198,12 +250,19 @@ def run(cfg, env, plots, memory, provider, diverse_query, strategy_agents,  exp_
                           strategy_agents,
                           exp_path,
                           trading_records,
-                          mode)
+                          mode,
+                          prefetched=prefetched,
+                          on_action=on_action if if_early_action else None)
 
         assert action in env.action_map.keys(), f"Action {action} is not in the action map {env.action_map.keys()}"
 
-        action = env.action_map[action]
-        state, reward, done, truncated, info = env.step(action)
+        if "future" in early:
+            (state, reward, done, truncated, info), kline_path = early["future"].result()
+            prefetched = {"kline_path": kline_path}
+        else:
+            action = env.action_map[action]
+            state, reward, done, truncated, info = env.step(action)
+            prefetched = {}
 
         if trading_records["action"][-1] != info["action"]:
             trading_records["action"][-1] = info["action"]
@@ -215,21 +274,37 @@ def run(cfg, env, plots, memory, provider, diverse_query, strategy_agents,  exp_
             trading_records["price"].append(info["price"])
             break
 
-        memory_save_path = os.path.join(memory_path, f"memory_{str(info['date'])}")
-        os.makedirs(memory_save_path, exist_ok=True)
-        memory.save_local(memory_path=memory_save_path)
+        if memory.journal is not None:
+            memory.checkpoint(str(info['date']))
+        elif not isinstance(memory, RemoteMemoryInterface):
+            memory_save_path = os.path.join(memory_path, f"memory_{str(info['date'])}")
+            os.makedirs(memory_save_path, exist_ok=True)
+            memory.save_local(memory_path=memory_save_path)
 
         save_json(trading_records, os.path.join(trading_records_path, f"trading_records_{str(info['date'])}.json"))
 
+    if prefetch_pool is not None:
+        prefetch_pool.shutdown()
+
     return trading_records
 
-def run_step(cfg, state, info, plots, memory, provider, diverse_query, strategy_agents, exp_path, trading_records, mode):
+def run_step(cfg, state, info, plots, memory, provider, diverse_query, strategy_agents, exp_path, trading_records, mode,
+             prefetched=None, on_action=None):
+    """Run the stages of a trading step one after another and return the action of the decision.
+
+    prefetched holds the results of the step computed while the previous decision was generated,
+    on_action is called with the action as soon as the decision generates it.
+    """
 
     params = dict()
+    params["token_budgets"] = cfg.get("token_budgets", None)
     save_dir = "train" if mode == "train" else "valid"
 
     # plot kline
-    kline_path = plots.plot_kline(state=state, info=info, save_dir=save_dir)
+    if prefetched is not None and "kline_path" in prefetched:
+        kline_path = prefetched["kline_path"]
+    else:
+        kline_path = plots.plot_kline(state=state, info=info, save_dir=save_dir)
     params.update({
         "kline_path": kline_path
     })
@@ -385,7 +460,8 @@ def run_step(cfg, state, info, plots, memory, provider, diverse_query, strategy_
                                 provider=provider,
                                 diverse_query=diverse_query,
                                 exp_path=exp_path,
-                                save_dir=save_dir)
+                                save_dir=save_dir,
+                                on_action=on_action)
 
     # add records
     trading_records["symbol"].append(info["symbol"])
@@ -408,5 +484,145 @@ def run_step(cfg, state, info, plots, memory, provider, diverse_query, strategy_
 
     return action
 
+def run_step_async(cfg, state, info, plots, memory, provider, diverse_query, strategy_agents, exp_path, trading_records, mode,
+                   prefetched=None, on_action=None):
+    """Same stages as run_step, executed as a DAG so that independent stages overlap.
+
+    The LLM stages form a chain (latest -> past market intelligence -> low level reflection ->
+    high level reflection -> decision), the plots, the tools and the memory writes run alongside it.
+    """
+
+    params = dict()
+    params["token_budgets"] = cfg.get("token_budgets", None)
+    save_dir = "train" if mode == "train" else "valid"
+
+    def template_path(name):
+        return cfg[f"{'train' if mode == 'train' else 'valid'}_{name}_template_path"]
+
+    def run_prompt(name, **kwargs):
+        def stage(params, results):
+            prompt = PROMPT.build(cfg[name])
+            res = prompt.run(state=state,
+                             info=info,
+                             params=params,
+                             template=read_resource_file(template_path(name)),
+                             memory=memory,
+                             provider=provider,
+                             diverse_query=diverse_query,
+                             exp_path=exp_path,
+                             save_dir=save_dir,
+                             **kwargs)
+            return prompt, res
+        return stage
+
+    def prepare(func):
+        def stage(params, results):
+            params.update(func(state=state,
+                               info=info,
+                               params=params,
+                               memory=memory,
+                               provider=provider,
+                               diverse_query=diverse_query))
+        return stage
+
+    def add_to_memory(name):
+        def stage(params, results):
+            prompt, res = results[name]
+            prompt.add_to_memory(state=state,
+                                 info=info,
+                                 res=res,
+                                 memory=memory,
+                                 provider=provider)
+        return stage
+
+    def plot_kline(params, results):
+        if prefetched is not None and "kline_path" in prefetched:
+            params["kline_path"] = prefetched["kline_path"]
+        else:
+            params["kline_path"] = plots.plot_kline(state=state, info=info, save_dir=save_dir)
+
+    def tools(params, results):
+        params.update(prepared_tools_params(state=state,
+                                            info=info,
+                                            params=params,
+                                            memory=memory,
+                                            provider=provider,
+                                            diverse_query=diverse_query,
+                                            strategy_agents=strategy_agents,
+                                            cfg=cfg,
+                                            mode=mode))
+
+    def plot_trading(params, results):
+        if len(trading_records["date"]) <= 0:
+            trading_path = None
+        else:
+            trading_path = plots.plot_trading(records=trading_records, info=info, save_dir=save_dir)
+        params.update({
+            "trading_path": trading_path,
+            "previous_date": trading_records["date"],
+            "previous_action": trading_records["action"],
+            "previous_reasoning": trading_records["reasoning"],
+            "trader_preference": ASSET.get_trader(cfg.trader_preference),
+        })
+
+    executor = StepExecutor()
+    executor.add_stage("plot_kline", plot_kline)
+    executor.add_stage("tools", tools)
+    executor.add_stage("plot_trading", plot_trading)
+
+    # market intelligence
+    executor.add_stage("latest_market_intelligence_summary", run_prompt("latest_market_intelligence_summary"))
+    executor.add_stage("query_latest_market_intelligence", prepare(prepare_latest_market_intelligence_params),
+                       deps=["latest_market_intelligence_summary"])
+    # today's news is added only after the past market intelligence has been queried
+    executor.add_stage("add_latest_market_intelligence", add_to_memory("latest_market_intelligence_summary"),
+                       deps=["query_latest_market_intelligence"])
+    executor.add_stage("past_market_intelligence_summary", run_prompt("past_market_intelligence_summary"),
+                       deps=["query_latest_market_intelligence"])
+
+    # low level reflection
+    executor.add_stage("low_level_reflection", run_prompt("low_level_reflection"),
+                       deps=["past_market_intelligence_summary", "plot_kline"])
+    executor.add_stage("query_low_level_reflection", prepare(prepare_low_level_reflection_params),
+                       deps=["low_level_reflection"])
+    executor.add_stage("add_low_level_reflection", add_to_memory("low_level_reflection"),
+                       deps=["query_low_level_reflection"])
+
+    # high level reflection
+    executor.add_stage("high_level_reflection", run_prompt("high_level_reflection"),
+                       deps=["query_low_level_reflection", "plot_trading"])
+    executor.add_stage("query_high_level_reflection", prepare(prepare_high_level_reflection_params),
+                       deps=["high_level_reflection"])
+    executor.add_stage("add_high_level_reflection", add_to_memory("high_level_reflection"),
+                       deps=["query_high_level_reflection"])
+
+    # decision
+    executor.add_stage("decision", run_prompt("decision", on_action=on_action),
+                       deps=["query_high_level_reflection", "tools"])
+
+    results = executor.run(params)
+    _, decision_res = results["decision"]
+
+    # add records
+    trading_records["symbol"].append(info["symbol"])
+    trading_records["day"].append(info["day"])
+    trading_records["value"].append(info["value"])
+    trading_records["cash"].append(info["cash"])
+    trading_records["position"].append(info["position"])
+    trading_records["ret"].append(info["ret"])
+    trading_records["date"].append(info["date"])
+    trading_records["price"].append(info["price"])
+    trading_records["discount"].append(info["discount"])
+    trading_records["kline_path"].append(params["kline_path"])
+    trading_records["trading_path"].append(params["trading_path"])
+    trading_records["total_profit"].append(info["total_profit"])
+    trading_records["total_return"].append(info["total_return"])
+    trading_records["action"].append(decision_res["response_dict"]["action"])
+    trading_records["reasoning"].append(decision_res["response_dict"]["reasoning"])
+
+    action = decision_res["response_dict"]["action"]
+
+    return action
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,128 @@
+import os
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+os.environ["MKL_DEBUG_CPU_TYPE"] = '5'
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import sys
+import json
+import traceback
+from glob import glob
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+from mmengine.config import Config, DictAction
+
+from dotenv import load_dotenv
+load_dotenv(verbose=True)
+
+ROOT = str(Path(__file__).resolve().parents[1])
+sys.path.append(ROOT)
+
+from finagent.registry import DATASET, PROVIDER
+from finagent.utils.misc import update_data_root
+from main import run_experiment, print_provider_stats
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run several symbols concurrently in one process')
+    parser.add_argument("--configs", nargs='+', default=sorted(glob(os.path.join(ROOT, "configs", "exp", "trading", "*.py"))),
+                        help="config file paths, one per symbol")
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in all used configs, the key-value pair '
+        'in xxx=yyy format will be merged into every config file.')
+    parser.add_argument("--root", type=str, default=ROOT)
+    parser.add_argument("--num_workers", type=int, default=None, help="number of symbols run at the same time")
+    parser.add_argument("--if_remove", action="store_true", default=False)
+
+    parser.add_argument("--checkpoint_start_date", type=str, default=None)
+    parser.add_argument("--if_load_memory", action="store_true", default=True)
+    parser.add_argument("--memory_path", type=str, default=None)
+    parser.add_argument("--if_load_trading_record", action="store_true", default=True)
+    parser.add_argument("--trading_record_path", type=str, default=None)
+    parser.add_argument("--if_train", action="store_true", default=False)
+    parser.add_argument("--if_valid", action="store_true", default=True)
+    parser.add_argument("--if_async_step", action="store_true", default=False)
+
+    args = parser.parse_args()
+    return args
+
+def load_config(path, args):
+    cfg = Config.fromfile(path)
+
+    cfg_options = dict(args.cfg_options) if args.cfg_options is not None else dict()
+    if args.root is not None:
+        cfg_options["root"] = args.root
+
+    cfg_options["checkpoint_start_date"] = args.checkpoint_start_date
+    cfg_options["if_load_memory"] = args.if_load_memory
+    cfg_options["memory_path"] = args.memory_path
+    cfg_options["if_load_trading_record"] = args.if_load_trading_record
+    cfg_options["trading_record_path"] = args.trading_record_path
+    cfg_options["if_train"] = args.if_train
+    cfg_options["if_valid"] = args.if_valid
+    cfg_options["if_async_step"] = args.if_async_step
+    cfg.merge_from_dict(cfg_options)
+
+    update_data_root(cfg, root=args.root)
+
+    return cfg
+
+def dataset_key(cfg):
+    """Configs reading the same data share one Dataset, workdir and tag only name the output folder."""
+    dataset_cfg = {k: v for k, v in cfg.dataset.items() if k not in ["workdir", "tag"]}
+    return json.dumps(dataset_cfg, sort_keys=True, default=str)
+
+def main():
+    args = parse_args()
+
+    cfgs = [load_config(path, args) for path in args.configs]
+
+    exp_paths = []
+    for cfg in cfgs:
+        exp_path = os.path.join(cfg.root, cfg.workdir, cfg.tag)
+        if args.if_remove:
+            import shutil
+            shutil.rmtree(exp_path, ignore_errors=True)
+            print(f"| Arguments Remove work_dir: {exp_path}")
+        else:
+            print(f"| Arguments Keep work_dir: {exp_path}")
+        os.makedirs(exp_path, exist_ok=True)
+        cfg.dump(os.path.join(exp_path, 'config.py'))
+        exp_paths.append(exp_path)
+
+    # one provider, so that all symbols share its connection pool and rate limiter
+    provider = PROVIDER.build(cfgs[0].provider)
+
+    datasets = {}
+    for cfg in cfgs:
+        key = dataset_key(cfg)
+        if key not in datasets:
+            datasets[key] = DATASET.build(cfg.dataset)
+
+    num_workers = args.num_workers if args.num_workers is not None else len(cfgs)
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = {
+            pool.submit(run_experiment, cfg, exp_path, provider, datasets[dataset_key(cfg)]): cfg.selected_asset
+            for cfg, exp_path in zip(cfgs, exp_paths)
+        }
+        for future in as_completed(futures):
+            symbol = futures[future]
+            try:
+                future.result()
+                print(f"| Finish {symbol}")
+            except Exception:
+                failures[symbol] = traceback.format_exc()
+                print(f"| Failed {symbol}:\n{failures[symbol]}")
+
+    print_provider_stats(provider)
+
+    if len(failures) > 0:
+        print(f"| {len(failures)} of {len(cfgs)} symbols failed: {', '.join(failures.keys())}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import os
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+import warnings
+warnings.filterwarnings("ignore")
+import sys
+from pathlib import Path
+import argparse
+from mmengine.config import Config, DictAction
+
+from dotenv import load_dotenv
+load_dotenv(verbose=True)
+
+ROOT = str(Path(__file__).resolve().parents[1])
+sys.path.append(ROOT)
+
+from finagent.registry import MEMORY, PROVIDER
+from finagent.utils.misc import update_data_root
+from finagent.memory import MemoryJournal
+from finagent.memory.server import serve_memory
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve one memory to several processes, which use it through a RemoteMemoryInterface')
+    parser.add_argument("--config", default=os.path.join(ROOT, "configs", "exp", "trading", "AAPL.py"), help="config file path, its memory settings are used")
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    parser.add_argument("--root", type=str, default=ROOT)
+    parser.add_argument("--address", type=str, default=os.path.join(ROOT, "workdir", "memory_server.sock"),
+                        help="path of a Unix socket, or host:port")
+    parser.add_argument("--authkey", type=str, default=None,
+                        help="defaults to the MEMORY_SERVER_AUTHKEY environment variable, generated for a host:port address if neither is set")
+    parser.add_argument("--symbols", nargs='+', default=None, help="served symbols, defaults to the assets of the dataset")
+    parser.add_argument("--embedding_dim", type=int, default=None, help="defaults to the embedding dim of the provider")
+
+    parser.add_argument("--memory_path", type=str, default=None,
+                        help="memory or memory journal to load, defaults to the journal of a previous run of the server")
+    parser.add_argument("--checkpoint", type=str, default=None, help="journal checkpoint to load")
+    parser.add_argument("--if_memory_journal", action=argparse.BooleanOptionalAction, default=True)
+
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    update_data_root(cfg, root=args.root)
+
+    symbols = args.symbols
+    if symbols is None:
+        with open(os.path.join(cfg.root, cfg.dataset.assets_path)) as op:
+            symbols = [line.strip() for line in op.readlines() if len(line.strip()) > 0]
+
+    embedding_dim = args.embedding_dim
+    if embedding_dim is None:
+        embedding_dim = PROVIDER.build(cfg.provider).get_embedding_dim()
+
+    cfg.memory["symbols"] = symbols
+    cfg.memory["embedding_dim"] = embedding_dim
+    memory = MEMORY.build(cfg.memory)
+
+    journal_path = os.path.join(os.path.dirname(memory.memory_path), "memory_server_records")
+    memory_path = None
+    if args.memory_path is not None:
+        memory_path = os.path.join(cfg.root, args.memory_path)
+    elif args.if_memory_journal and MemoryJournal.exists(journal_path):
+        # a restarted server continues its journal, opening it without loading it would empty it
+        memory_path = journal_path
+
+    if memory_path is not None:
+        if MemoryJournal.exists(memory_path):
+            memory.load_journal(journal_path=memory_path, checkpoint=args.checkpoint)
+        else:
+            memory.load_local(memory_path=memory_path)
+
+    if args.if_memory_journal:
+        memory.open_journal(journal_path=journal_path)
+
+    try:
+        serve_memory(memory, address=args.address, authkey=args.authkey)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        memory.save_local()
+        print(f"| Saved the served memory to {memory.memory_path}")
+
+if __name__ == '__main__':
+    main()
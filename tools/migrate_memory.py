@@ -0,0 +1,30 @@
+import os
+import sys
+from pathlib import Path
+import argparse
+
+ROOT = str(Path(__file__).resolve().parents[1])
+sys.path.append(ROOT)
+
+from finagent.memory import migrate_memory
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert memory.json files to the binary memory format")
+    parser.add_argument("--memory_path", type=str, default=os.path.join(ROOT, "workdir"), help="directory searched recursively for memory.json files")
+    parser.add_argument("--keep_legacy", action="store_true", default=False, help="keep the memory.json files after converting them")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+
+    num_migrated = 0
+    for path in sorted(Path(args.memory_path).rglob("memory.json")):
+        if migrate_memory(str(path.parent), remove_legacy=not args.keep_legacy):
+            num_migrated += 1
+            print(f"| Migrated {path.parent}")
+
+    print(f"| Migrated {num_migrated} memories under {args.memory_path}")
+
+if __name__ == '__main__':
+    main()